@@ -8,6 +8,20 @@ export interface StatPoint {
     device: 'CPU' | 'GPU';
 }
 
+// Measured per-model GPU footprint reported by the backend tracker
+export interface ModelFootprint {
+    weights_mb: number;
+    activation_peak_mb: number;
+    cache_reserved_mb: number;
+    resident_mb: number;
+    admission_mb: number;
+    host_mb: number;
+    load_seconds: number;
+    first_inference_ms: number | null;
+    source: 'allocator' | 'nvml' | 'estimate';
+    measured_at: number;
+}
+
 export interface OtelMetrics {
     cpu: number;
     memory: number;
@@ -45,10 +59,28 @@ export interface OtelMetrics {
         vram_mb: number;
         ram_mb: number;
         loaded_at: number;
+        footprint?: ModelFootprint | null;
     }[];
+    // gpu = resident in VRAM, parked = weights in host RAM, cold = on disk
+    model_states?: Record<string, 'gpu' | 'parked' | 'cold'>;
     ghost_memory?: {
         detected: boolean;
         ghost_vram_mb: number;
+        unattributed_vram_mb?: number;
+        in_process_ghost_mb?: number;
+        method?: 'per_process' | 'device_total';
+        processes?: {
+            own_vram_mb: number;
+            orphan_vram_mb: number;
+            foreign_vram_mb: number;
+            processes: {
+                pid: number;
+                device: number;
+                used_mb: number;
+                category: 'self' | 'child' | 'orphan' | 'foreign';
+                cmdline: string;
+            }[];
+        } | null;
     };
 }
 
@@ -4,7 +4,7 @@ import { DevicePerformanceMetrics } from '../../types';
 
 /**
  * Hook for adaptive concurrency management
- * Handles dynamic scaling based on VRAM and TPS metrics, plus smart batching
+ * Follows the server's published capacity when available, else scales on VRAM and TPS metrics; plus smart batching
  */
 
 interface UseAdaptiveConcurrencyProps {
@@ -62,6 +62,22 @@ export const useAdaptiveConcurrency = ({
         // Skip adjustments during calibration
         if (calibrationRef.current.isActive) return;
 
+        // 0. Server-published capacity (X-Recommended-Concurrency) wins over the client-side guesses:
+        // the server knows its dispatch slots, queue depth and VRAM headroom
+        if (metrics?.recommendedConcurrency) {
+            const target = Math.max(1, Math.min(5, metrics.recommendedConcurrency));
+            if (target !== concurrencyLimit) {
+                logResilienceWithMetrics(target < concurrencyLimit ? 'warn' : 'info', 'Server Capacity', {
+                    Action: `Concurrency ${concurrencyLimit}→${target}`,
+                    'Server Queue': metrics.queueDepth ?? 'N/A',
+                    'Est. Wait': metrics.estimatedWaitMs !== undefined ? `${Math.round(metrics.estimatedWaitMs)}ms` : 'N/A',
+                    Queue: queueRef.current.length
+                });
+                setConcurrencyLimit(target);
+            }
+            return;
+        }
+
         if (metrics) {
             const { vramUsagePercent, tokensPerSecond } = metrics;
 
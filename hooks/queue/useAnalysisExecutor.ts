@@ -53,7 +53,7 @@ export const useAnalysisExecutor = ({ settings, setStatsHistory, setImages, setS
                 imageForAnalysis.dataUrl = await resizeImage(img.dataUrl, { maxDimension: settings.performance.maxAnalysisDimension });
             }
 
-            const metadata = await analyzeImage(imageForAnalysis, settings!, undefined, (msg) => updateNotification(img.id, { message: msg }));
+            const metadata = await analyzeImage(imageForAnalysis, settings!, undefined, (msg) => updateNotification(img.id, { message: msg }), task.priority);
             if (metadata.stats) setStatsHistory(p => [...p, { timestamp: Date.now(), tokensPerSec: metadata.stats!.tokensPerSec, device: metadata.stats!.device }]);
 
             const updated = { ...img, ...recoveredMetadata, ...metadata, analysisFailed: false };
@@ -128,7 +128,8 @@ export const useAnalysisExecutor = ({ settings, setStatsHistory, setImages, setS
 
             // Execute Batch
             const batchStartTime = Date.now();
-            const results = await batchTagImages(resizedImages, settings);
+            const priority = Math.max(...tasks.map(t => t.priority ?? 0));
+            const results = await batchTagImages(resizedImages, settings, priority);
             const batchDuration = (Date.now() - batchStartTime) / 1000; // in seconds
 
             // Handle Results
@@ -16,29 +16,46 @@ def apply_fix_persistence():
     print("Success: Persistence Mode enabled.")
 
 def apply_fix_ghost_vram():
-    """Kill processes using /dev/nvidia0 (Nuclear option)."""
-    print("Scanning for processes holding /dev/nvidia0...")
+    """Reclaim ghost VRAM without touching processes we do not own.
+
+    1. Ask the running server to reclaim inside its own process
+       (drop cached backends, empty the allocator cache, collect garbage)
+    2. Terminate only confirmed orphaned backend children of the server
+    Foreign GPU processes are listed but never killed.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from gpu_process_inspector import ChildRegistry, GpuProcessInspector, kill_orphans
+
+    print("Requesting in-process VRAM reclamation from the server...")
     try:
-        # fuser returns non-zero if no processes found, which is fine
-        pIds = subprocess.check_output(["fuser", "-v", "/dev/nvidia0"], text=True, stderr=subprocess.DEVNULL)
-        pIds = pIds.strip().split()
-        
-        if not pIds:
-            print("No ghost processes found.")
-            return
+        import urllib.request
+        port = os.environ.get("PORT", "2020")
+        req = urllib.request.Request(f"http://127.0.0.1:{port}/v1/system/reclaim-vram", method="POST")
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            print(f"Server reclaim: {resp.read().decode()}")
+    except Exception as e:
+        print(f"Server reclaim unavailable ({e}) - continuing with orphan scan.")
 
-        print(f"killing processes: {pIds}")
-        # kill -9 only the PIDs found
-        subprocess.check_call(["kill", "-9"] + pIds)
-        
-        # Also run the reset script if available as a cleanup
-        reset_script = os.path.join(os.path.dirname(__file__), "gpu_reset.py")
-        if os.path.exists(reset_script):
-             subprocess.call(["python3", reset_script])
-             
-        print("Success: Ghost VRAM processes terminated.")
-    except subprocess.CalledProcessError:
-        print("No processes found or failed to kill.")
+    registry = ChildRegistry()
+    server = registry.data.get("server") or {}
+    inspector = GpuProcessInspector(registry=registry)
+    server_info = inspector.table.info(server["pid"]) if server.get("pid") else None
+    if server_info and abs(server_info["create_time"] - server["create_time"]) < 0.01:
+        inspector.server_pid = server["pid"]
+
+    report = inspector.inspect(sync_registry=False)
+    if not report.available:
+        print("NVML unavailable - cannot attribute VRAM per process. Nothing killed.")
+        return
+
+    for proc in report.by_category("foreign"):
+        print(f"Leaving foreign process {proc['pid']} alone ({proc['used_mb']}MB): {proc['cmdline']}")
+
+    killed = kill_orphans(inspector)
+    if killed:
+        print(f"Success: terminated {len(killed)} orphaned backend process(es): {killed}")
+    else:
+        print("No orphaned backend processes found.")
 
 def apply_fix_modeset():
     """Add nvidia-drm.modeset=1 to GRUB."""
@@ -0,0 +1,115 @@
+import argparse
+import glob
+import os
+import threading
+import time
+
+import torch
+
+MODELS = ["Marqo/nsfw-image-detection-384", "SmilingWolf/wd-vit-tagger-v3"]
+
+
+def load_model(repo_id):
+    import timm
+    return timm.create_model(f"hf-hub:{repo_id}", pretrained=True).eval()
+
+
+def make_inputs(model, batch, patterns):
+    import timm.data
+    config = timm.data.resolve_data_config({}, model=model)
+    paths = []
+    for pattern in patterns or []:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    paths = [p for p in paths if os.path.isfile(p)][:batch]
+    if not paths:
+        return torch.rand(batch, *config["input_size"])
+    from PIL import Image
+    transform = timm.data.create_transform(**config)
+    tensors = [transform(Image.open(p).convert("RGB")) for p in paths]
+    while len(tensors) < batch:
+        tensors.extend(tensors[:batch - len(tensors)])
+    return torch.stack(tensors)
+
+
+def quantize(model):
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def worker(model, inputs, seconds, threads, barrier, out):
+    # Thread counts are per calling thread, as in the server's per-model pools
+    if threads:
+        torch.set_num_threads(threads)
+    with torch.inference_mode():
+        model(inputs[:1])  # warm-up
+        barrier.wait()
+        images, started = 0, time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            model(inputs)
+            images += len(inputs)
+        out.append(images / (time.perf_counter() - started))
+
+
+def run(models, inputs, seconds, threads):
+    """images/s per model with all of models running at once."""
+    barrier = threading.Barrier(len(models))
+    results = [[] for _ in models]
+    workers = [
+        threading.Thread(target=worker, args=(model, inputs[i], seconds, threads, barrier, results[i]))
+        for i, model in enumerate(models)
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return [r[0] if r else 0.0 for r in results]
+
+
+def agreement(fp32, int8, inputs):
+    with torch.inference_mode():
+        a, b = fp32(inputs), int8(inputs)
+    same_top1 = (a.argmax(-1) == b.argmax(-1)).float().mean().item()
+    return same_top1, (a.sigmoid() - b.sigmoid()).abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WD14 / NSFW on CPU: default fp32 vs partitioned threads vs int8")
+    parser.add_argument("--models", nargs="+", default=MODELS, help="timm hf-hub repo ids")
+    parser.add_argument("--images", nargs="*", help="image files or glob patterns (default: random tensors)")
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=20.0, help="per configuration")
+    parser.add_argument("--int8", action="store_true", help="also measure the dynamic int8 variant")
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    share = max(1, cores // len(args.models))
+    print(f"{cores} cores, torch {torch.__version__} default {torch.get_num_threads()} threads, "
+          f"partitioned {share} threads per model, batch {args.batch}")
+    torch.set_num_interop_threads(1)
+
+    models = [load_model(repo_id) for repo_id in args.models]
+    inputs = [make_inputs(model, args.batch, args.images) for model in models]
+    configs = [("fp32 default", models, None), ("fp32 partitioned", models, share)]
+    if args.int8:
+        quantized = [quantize(model) for model in models]
+        configs.append(("int8 partitioned", quantized, share))
+
+    rows = []
+    for name, variant, threads in configs:
+        alone = [run([model], [inputs[i]], args.seconds, threads)[0] for i, model in enumerate(variant)]
+        together = run(variant, inputs, args.seconds, threads)
+        rows.append((name, alone, together))
+        print(f"  {name}: done")
+
+    print(f"\n{'config':<18}{'model':<36}{'alone img/s':>13}{'together img/s':>16}")
+    for name, alone, together in rows:
+        for i, repo_id in enumerate(args.models):
+            print(f"{name:<18}{repo_id:<36}{alone[i]:>13.1f}{together[i]:>16.1f}")
+        print(f"{name:<18}{'(sum, both running)':<36}{'':>13}{sum(together):>16.1f}")
+
+    if args.int8:
+        print("\nint8 vs fp32 on the benchmark inputs:")
+        for i, repo_id in enumerate(args.models):
+            same, diff = agreement(models[i], quantized[i], inputs[i])
+            print(f"  {repo_id}: top-1 agreement {same:.1%}, max prob diff {diff:.4f}")
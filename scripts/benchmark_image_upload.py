@@ -0,0 +1,109 @@
+import argparse
+import base64
+import glob
+import os
+import statistics
+import time
+
+import requests
+
+BASE_URL = "http://localhost:2020"
+
+
+def load_images(patterns):
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return [(os.path.basename(p), open(p, "rb").read()) for p in paths if os.path.isfile(p)]
+
+
+def post_json(images, model):
+    started = time.perf_counter()
+    payload = {"model": model, "images": [base64.b64encode(data).decode("utf-8") for _, data in images]}
+    prepared = requests.Request("POST", f"{BASE_URL}/v1/vision/batch-caption", json=payload).prepare()
+    prep_ms = (time.perf_counter() - started) * 1000
+    return prepared, prep_ms
+
+
+def post_multipart(images, model):
+    started = time.perf_counter()
+    files = [("images", (name, data, "application/octet-stream")) for name, data in images]
+    prepared = requests.Request(
+        "POST", f"{BASE_URL}/v1/vision/batch-caption/upload", files=files, data={"model": model}
+    ).prepare()
+    prep_ms = (time.perf_counter() - started) * 1000
+    return prepared, prep_ms
+
+
+def post_raw(images, model):
+    # One request per image: the raw form carries exactly one image
+    started = time.perf_counter()
+    prepared = [
+        requests.Request(
+            "POST", f"{BASE_URL}/v1/vision/caption/raw", params={"model": model}, data=data,
+            headers={"Content-Type": "application/octet-stream"},
+        ).prepare()
+        for _, data in images
+    ]
+    prep_ms = (time.perf_counter() - started) * 1000
+    return prepared, prep_ms
+
+
+def run(form, builder, images, model, repeat, session):
+    latencies, preps, wire = [], [], 0
+    for _ in range(repeat):
+        prepared, prep_ms = builder(images, model)
+        batch = prepared if isinstance(prepared, list) else [prepared]
+        started = time.perf_counter()
+        for request in batch:
+            response = session.send(request, timeout=300)
+            if response.status_code != 200:
+                print(f"{form}: HTTP {response.status_code} {response.text[:200]}")
+                return None
+        latencies.append((time.perf_counter() - started) * 1000)
+        preps.append(prep_ms)
+        wire = sum(len(r.body or b"") for r in batch)
+    return {
+        "form": form,
+        "wire_kb": wire / 1024,
+        "prep_ms": statistics.median(preps),
+        "p50_ms": statistics.median(latencies),
+        "min_ms": min(latencies),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare base64 JSON, multipart and raw image uploads")
+    parser.add_argument("images", nargs="+", help="image files or glob patterns")
+    parser.add_argument("--model", default="wd14-vit-v2")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--url", default=BASE_URL)
+    args = parser.parse_args()
+    BASE_URL = args.url.rstrip("/")
+
+    images = load_images(args.images)
+    if not images:
+        raise SystemExit("No images found")
+    raw_kb = sum(len(data) for _, data in images) / 1024
+    print(f"{len(images)} images, {raw_kb:.0f} KB on disk, model {args.model}, {args.repeat} runs each")
+
+    session = requests.Session()
+    # One untimed call so the model is loaded before anything is measured
+    run("warmup", post_json, images[:1], args.model, 1, session)
+
+    results = []
+    for form, builder in (("json+base64", post_json), ("multipart", post_multipart), ("octet-stream", post_raw)):
+        result = run(form, builder, images, args.model, args.repeat, session)
+        if result:
+            results.append(result)
+
+    print(f"\n{'form':<14}{'wire KB':>10}{'vs disk':>9}{'client prep ms':>16}{'p50 ms':>10}{'min ms':>10}")
+    for r in results:
+        print(
+            f"{r['form']:<14}{r['wire_kb']:>10.0f}{r['wire_kb'] / raw_kb:>8.2f}x"
+            f"{r['prep_ms']:>16.1f}{r['p50_ms']:>10.1f}{r['min_ms']:>10.1f}"
+        )
+    try:
+        print("\nServer ingest counters:", session.get(f"{BASE_URL}/v1/metrics", timeout=10).json().get("ingest"))
+    except (requests.RequestException, ValueError):
+        pass
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+QUANTIZED = os.path.expanduser("~/.moondream-station/models/quantized/joycaption-alpha-2-nf4")
+
+
+def child(mode, artifact):
+    """One load in a fresh process; prints a JSON line with time and peaks."""
+    import torch
+    from transformers import BitsAndBytesConfig, LlavaForConditionalGeneration
+
+    with open(os.path.join(artifact, "prequantized.json")) as f:
+        manifest = json.load(f)
+    started = time.perf_counter()
+    if mode == "runtime":
+        # What the backend did before: fp16 source quantized during the load
+        model = LlavaForConditionalGeneration.from_pretrained(
+            manifest["source"],
+            quantization_config=BitsAndBytesConfig(**manifest["quantization"], bnb_4bit_compute_dtype=torch.float16),
+            torch_dtype=torch.float16,
+            device_map={"": 0},
+        )
+    else:
+        model = LlavaForConditionalGeneration.from_pretrained(artifact, torch_dtype=torch.float16, device_map={"": 0})
+    torch.cuda.synchronize()
+    load_s = time.perf_counter() - started
+    print(json.dumps({
+        "load_s": load_s,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KB on Linux
+        "vram_mb": torch.cuda.max_memory_allocated() / 1024 ** 2,
+        "params": sum(p.numel() for p in model.parameters()),
+    }))
+
+
+def measure(mode, artifact):
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", mode, "--artifact", artifact],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JoyCaption load: runtime 4-bit quantization vs pre-quantized copy")
+    parser.add_argument("--artifact", default=QUANTIZED, help="output of scripts/prequantize_joycaption.py")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child", choices=["runtime", "prequantized"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.artifact)
+        raise SystemExit(0)
+    if not os.path.exists(os.path.join(args.artifact, "prequantized.json")):
+        raise SystemExit(f"No pre-quantized copy at {args.artifact}; run scripts/prequantize_joycaption.py first")
+
+    # Alternate the modes so both see the same page-cache state; the first load of each may be cold
+    runs = {"runtime": [], "prequantized": []}
+    for i in range(args.repeat):
+        for mode in runs:
+            result = measure(mode, args.artifact)
+            runs[mode].append(result)
+            print(f"  run {i + 1} {mode:<13} {result['load_s']:6.1f}s  peak RSS {result['peak_rss_mb']:7.0f} MB")
+
+    print(f"\n{'mode':<14}{'p50 load s':>11}{'min load s':>11}{'peak RSS MB':>13}{'VRAM MB':>10}")
+    for mode, results in runs.items():
+        print(
+            f"{mode:<14}{statistics.median(r['load_s'] for r in results):>11.1f}"
+            f"{min(r['load_s'] for r in results):>11.1f}{max(r['peak_rss_mb'] for r in results):>13.0f}"
+            f"{max(r['vram_mb'] for r in results):>10.0f}"
+        )
@@ -3,19 +3,21 @@
 Download JoyCaption Alpha 2 model to HuggingFace cache.
 After running this, use migrate_models_to_local.py to move it to local storage.
 
-NOTE: The model will be quantized to 4-bit at runtime for 8GB VRAM compatibility.
+NOTE: The model runs in 4-bit for 8GB VRAM compatibility. Convert it once with
+prequantize_joycaption.py so loads read the saved 4-bit copy instead of
+quantizing the fp16 weights every time.
 """
 from transformers import LlavaForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
 import torch
 
 print("Downloading JoyCaption Alpha 2...")
 print("Model: fancyfeast/llama-joycaption-alpha-two-hf-llava")
-print("NOTE: Model will use 4-bit quantization at runtime for 8GB VRAM")
+print("NOTE: Model runs in 4-bit for 8GB VRAM (convert once with prequantize_joycaption.py)")
 print()
 
 try:
     print("Downloading model (LLaVA architecture)...")
-    print("This will download the full model (~8GB), but it will be quantized to 4-bit at runtime")
+    print("This will download the full model (~8GB); prequantize_joycaption.py saves the 4-bit copy")
     
     # Download without loading to save memory during download
     model = LlavaForConditionalGeneration.from_pretrained(
@@ -39,7 +41,8 @@ try:
     print()
     print("Next steps:")
     print("1. Run: python3 scripts/migrate_models_to_local.py --model joycaption-alpha-2")
-    print("2. Restart backend: python3 backend/main.py --port 2020")
+    print("2. Run: python3 scripts/prequantize_joycaption.py --source <Local Path from step 1>")
+    print("3. Restart backend: python3 backend/main.py --port 2020")
     print("=" * 60)
     
 except Exception as e:
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Per-process GPU memory inspection for ghost-VRAM detection.
+
+Shared by the moondream-station server (installed into moondream_station/core
+by scripts/patches/patch_ghost_process_detection.py) and by the sudo wrapper
+scripts/apply_system_fixes.py.
+
+Every process NVML reports on the GPU is put in one of four buckets:
+    self     - the server process itself
+    child    - a live descendant of the server (backend workers)
+    orphan   - a process the server once registered as its child whose
+               parent is gone (confirmed by pid AND create_time)
+    foreign  - everything else (Xorg, browsers, other users' jobs)
+
+Only orphans may ever be killed. Foreign processes are reported, never touched.
+
+Usage (read-only report):
+    python3 gpu_process_inspector.py
+"""
+
+import gc
+import json
+import os
+import signal
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+
+DEFAULT_REGISTRY_PATH = os.path.join(
+    os.path.expanduser(f"~{os.environ.get('SUDO_USER', '')}"), ".moondream-station", "gpu_children.json"
+)
+
+
+class NvmlProvider:
+    """Thin pynvml wrapper. Tests pass a fake exposing the same three methods."""
+
+    def __init__(self):
+        import pynvml
+        self._nvml = pynvml
+        pynvml.nvmlInit()
+
+    def device_count(self):
+        return self._nvml.nvmlDeviceGetCount()
+
+    def device_memory(self, index):
+        """(total_bytes, used_bytes) for one device."""
+        handle = self._nvml.nvmlDeviceGetHandleByIndex(index)
+        memory = self._nvml.nvmlDeviceGetMemoryInfo(handle)
+        return memory.total, memory.total - memory.free
+
+    def processes(self, index):
+        """[(pid, used_bytes)] for compute and graphics contexts on one device."""
+        handle = self._nvml.nvmlDeviceGetHandleByIndex(index)
+        usage = {}
+        for query in (self._nvml.nvmlDeviceGetComputeRunningProcesses,
+                      self._nvml.nvmlDeviceGetGraphicsRunningProcesses):
+            try:
+                for proc in query(handle):
+                    used = proc.usedGpuMemory or 0  # None when the driver hides it
+                    usage[proc.pid] = max(usage.get(proc.pid, 0), used)
+            except Exception:
+                continue
+        return list(usage.items())
+
+
+class PsutilProcessTable:
+    """Process lookups used for classification. Tests pass a fake."""
+
+    def info(self, pid):
+        """{pid, ppid, create_time, cmdline} or None if the process is gone."""
+        if psutil is None:
+            return None
+        try:
+            proc = psutil.Process(pid)
+            with proc.oneshot():
+                return {
+                    "pid": pid,
+                    "ppid": proc.ppid(),
+                    "create_time": proc.create_time(),
+                    "cmdline": " ".join(proc.cmdline()),
+                }
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            return None
+
+    def descendants(self, pid):
+        if psutil is None:
+            return []
+        try:
+            return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return []
+
+
+def _same_process(info, create_time):
+    return info is not None and abs(info["create_time"] - create_time) < 0.01
+
+
+class ChildRegistry:
+    """JSON record of the server and the children it spawned.
+
+    Written by the server on every inspection so that, after a crash, the
+    sudo fix script can tell our orphaned backend workers from someone
+    else's processes that merely happen to use the GPU.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("MOONDREAM_CHILD_REGISTRY", DEFAULT_REGISTRY_PATH)
+        self.data = {"server": None, "children": {}}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {"server": None, "children": {}}
+        self.data.setdefault("children", {})
+        return self
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[GPU Inspector] Could not write child registry: {e}")
+
+    def sync(self, server_pid, table):
+        """Record the live server and its descendants; forget entries whose process died."""
+        server = table.info(server_pid)
+        if server is None:
+            return
+        before = json.dumps(self.data, sort_keys=True)
+        self.data["server"] = {"pid": server_pid, "create_time": server["create_time"]}
+
+        children = self.data["children"]
+        for key, entry in list(children.items()):
+            if not _same_process(table.info(entry["pid"]), entry["create_time"]):
+                del children[key]
+
+        for pid in table.descendants(server_pid):
+            info = table.info(pid)
+            if info is None or str(pid) in children:
+                continue
+            parent = table.info(info["ppid"])
+            children[str(pid)] = {
+                "pid": pid,
+                "create_time": info["create_time"],
+                "cmdline": info["cmdline"],
+                "parent_pid": info["ppid"],
+                "parent_create_time": parent["create_time"] if parent else server["create_time"],
+            }
+        if json.dumps(self.data, sort_keys=True) != before:
+            self.save()
+
+    def confirmed_orphan(self, pid, table):
+        """True only if pid is a registered child that is still the same process
+        and whose recorded parent no longer exists."""
+        entry = self.data["children"].get(str(pid))
+        if entry is None:
+            return False
+        info = table.info(pid)
+        if not _same_process(info, entry["create_time"]) or info["cmdline"] != entry["cmdline"]:
+            return False
+        parent = table.info(entry["parent_pid"])
+        return not _same_process(parent, entry["parent_create_time"])
+
+
+class GpuProcessReport:
+    def __init__(self):
+        self.available = False
+        self.devices = []
+        self.processes = []  # {pid, device, used_mb, category, cmdline}
+
+    def total_mb(self, *categories):
+        return sum(p["used_mb"] for p in self.processes if p["category"] in categories)
+
+    @property
+    def own_mb(self):
+        return self.total_mb("self", "child")
+
+    @property
+    def orphan_mb(self):
+        return self.total_mb("orphan")
+
+    @property
+    def foreign_mb(self):
+        return self.total_mb("foreign")
+
+    def by_category(self, category):
+        return [p for p in self.processes if p["category"] == category]
+
+    def as_dict(self):
+        return {
+            "available": self.available,
+            "devices": self.devices,
+            "own_vram_mb": round(self.own_mb, 1),
+            "orphan_vram_mb": round(self.orphan_mb, 1),
+            "foreign_vram_mb": round(self.foreign_mb, 1),
+            "processes": self.processes,
+        }
+
+
+class GpuProcessInspector:
+    def __init__(self, nvml=None, table=None, registry=None, server_pid=None):
+        self.nvml = nvml
+        self.table = table or PsutilProcessTable()
+        self.registry = registry
+        self.server_pid = server_pid
+
+    def _nvml(self):
+        if self.nvml is None:
+            try:
+                self.nvml = NvmlProvider()
+            except Exception:
+                self.nvml = False
+        return self.nvml or None
+
+    def inspect(self, sync_registry=True):
+        report = GpuProcessReport()
+        nvml = self._nvml()
+        if nvml is None:
+            return report
+
+        descendants = set()
+        if self.server_pid is not None:
+            descendants = set(self.table.descendants(self.server_pid))
+            if sync_registry and self.registry is not None:
+                self.registry.sync(self.server_pid, self.table)
+
+        try:
+            for index in range(nvml.device_count()):
+                total, used = nvml.device_memory(index)
+                processes = nvml.processes(index)
+                report.devices.append({
+                    "index": index,
+                    "total_mb": round(total / MB, 1),
+                    "used_mb": round(used / MB, 1),
+                    "unattributed_mb": round(max(0, used - sum(u for _, u in processes)) / MB, 1),
+                })
+                for pid, used_bytes in processes:
+                    report.processes.append({
+                        "pid": pid,
+                        "device": index,
+                        "used_mb": round(used_bytes / MB, 1),
+                        "category": self._classify(pid, descendants),
+                        "cmdline": (self.table.info(pid) or {}).get("cmdline", ""),
+                    })
+        except Exception as e:
+            print(f"[GPU Inspector] NVML query failed: {e}")
+            return report
+        report.available = True
+        return report
+
+    def _classify(self, pid, descendants):
+        if pid == self.server_pid:
+            return "self"
+        if pid in descendants:
+            return "child"
+        if self.registry is not None and self.registry.confirmed_orphan(pid, self.table):
+            return "orphan"
+        return "foreign"
+
+
+def reclaim_in_process(drop_cache_hooks=(), inspector=None):
+    """Free VRAM inside the server without killing anything.
+
+    1. drop cached backends (hooks registered by the server)
+    2. gc.collect() so dropped modules release their tensors
+    3. torch.cuda.empty_cache() to hand cached blocks back to the driver
+    Returns own-process VRAM before/after when an inspector is given.
+    """
+    before = inspector.inspect(sync_registry=False).own_mb if inspector else None
+    steps = []
+    for hook in drop_cache_hooks:
+        name = getattr(hook, "__name__", repr(hook))
+        try:
+            hook()
+            steps.append({"step": name, "ok": True})
+        except Exception as e:
+            steps.append({"step": name, "ok": False, "error": str(e)})
+
+    collected = gc.collect()
+    steps.append({"step": "gc.collect", "ok": True, "objects": collected})
+
+    torch = sys.modules.get("torch")  # never import torch (and init CUDA) just to clear it
+    if torch is not None:
+        try:
+            if torch.cuda.is_available() and torch.cuda.is_initialized():
+                torch.cuda.synchronize()
+                torch.cuda.empty_cache()
+                steps.append({"step": "torch.cuda.empty_cache", "ok": True})
+        except Exception as e:
+            steps.append({"step": "torch.cuda.empty_cache", "ok": False, "error": str(e)})
+
+    after = inspector.inspect(sync_registry=False).own_mb if inspector else None
+    return {
+        "steps": steps,
+        "own_vram_before_mb": before,
+        "own_vram_after_mb": after,
+        "reclaimed_mb": round(before - after, 1) if before is not None and after is not None else None,
+    }
+
+
+def kill_orphans(inspector, kill=os.kill, grace_seconds=5.0, sleep=time.sleep):
+    """Terminate confirmed orphaned children only (SIGTERM, then SIGKILL).
+
+    Re-inspects right before signalling so a pid that was reused in the
+    meantime is never hit.
+    """
+    killed = []
+    report = inspector.inspect(sync_registry=False)
+    for proc in report.by_category("orphan"):
+        pid = proc["pid"]
+        if not inspector.registry.confirmed_orphan(pid, inspector.table):
+            continue
+        print(f"Terminating orphaned backend child {pid} ({proc['used_mb']}MB): {proc['cmdline']}")
+        try:
+            kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            continue
+        deadline = time.monotonic() + grace_seconds
+        while time.monotonic() < deadline and inspector.table.info(pid) is not None:
+            sleep(0.2)
+        if inspector.registry.confirmed_orphan(pid, inspector.table):
+            try:
+                kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        killed.append({"pid": pid, "used_mb": proc["used_mb"]})
+    return killed
+
+
+if __name__ == "__main__":
+    registry = ChildRegistry()
+    server = registry.data.get("server") or {}
+    inspector = GpuProcessInspector(registry=registry, server_pid=server.get("pid"))
+    print(json.dumps(inspector.inspect(sync_registry=False).as_dict(), indent=2))
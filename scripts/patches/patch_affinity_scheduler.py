@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Patch to schedule requests by model affinity so bursts share one load.
+
+The frontend queue interleaves analysis and generation jobs, and every
+request naming a different model triggers an auto-switch (or an SDXL load
+in /v1/generate). Served in arrival order, A B A B costs three switches.
+
+This patch installs moondream_station/core/affinity_scheduler.py in front
+of the switch coordinator:
+1. Requests wait in per-model queues; the model being served keeps
+   admitting its own requests while its queue or in-flight work lasts
+2. The scheduler rotates to another model when the current one is idle,
+   when a waiting request has a higher priority than anything queued for
+   the current model, or when the oldest waiter hits affinity_max_wait_ms
+   (config, default 1500)
+3. Priority comes from X-Priority or the request's "priority" field
+   (0=background, 1=preload, 2=interactive, 3=immediate - types/queue.ts)
+4. /v1/generate (SDXL) goes through the same queues as "sdxl-base"
+5. /metrics "scheduler": switch rate, the switches a FIFO order would
+   have made, switches_avoided and queue wait percentiles (overall and per
+   priority)
+
+Requires: patch_switch_coordinator.py
+
+Usage:
+    python3 patch_affinity_scheduler.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_switch_coordinator import COORDINATOR_MODULE  # noqa: E402
+
+SCHEDULER_MODULE = '''"""
+Model-affinity admission in front of SwitchCoordinator.
+
+Shares the coordinator's asyncio.Condition, so lease releases (requests
+finishing on the served model) wake queued requests for other models.
+"""
+
+import asyncio
+import collections
+import contextvars
+import itertools
+import time
+
+PRIORITY_NAMES = {"background": 0, "preload": 1, "normal": 1, "interactive": 2, "high": 2, "immediate": 3}
+PRIORITY_LABELS = ("background", "preload", "interactive", "immediate")
+DEFAULT_PRIORITY = 1
+DEFAULT_MAX_WAIT_MS = 1500.0
+SWITCH_RATE_WINDOW_S = 300.0
+
+
+def parse_priority(value, default=DEFAULT_PRIORITY):
+    if value is None or value == "":
+        return default
+    if isinstance(value, str) and value.strip().lower() in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value.strip().lower()]
+    try:
+        return max(0, min(3, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+# Priority of the request being handled; set on admission, read by inference-level queues
+current_priority = contextvars.ContextVar("request_priority", default=DEFAULT_PRIORITY)
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def wait_summary(waits_by_priority):
+    """{label: {count, p50_ms, p95_ms}} for the priorities that have waited."""
+    out = {}
+    for priority, waits in waits_by_priority.items():
+        if waits:
+            values = list(waits)
+            out[PRIORITY_LABELS[priority]] = {
+                "count": len(values),
+                "p50_ms": round(_percentile(values, 50), 1),
+                "p95_ms": round(_percentile(values, 95), 1),
+            }
+    return out
+
+
+class _Waiter:
+    def __init__(self, model_id, priority, seq, idle_only=False):
+        self.model_id = model_id
+        self.priority = priority
+        self.seq = seq
+        self.idle_only = idle_only  # only admitted once the served model is idle (warm-ups)
+        self.enqueued_at = time.monotonic()
+
+
+class AffinityScheduler:
+    def __init__(self, coordinator, config=None):
+        self.coordinator = coordinator
+        self.config = config
+        self.serving = None  # model whose requests are being admitted
+        self.queues = collections.defaultdict(list)  # model_id -> [_Waiter]
+        self.running = collections.defaultdict(int)  # admitted, not yet finished
+        self.rotations = collections.deque()  # monotonic times the served model changed
+        self.waits_ms = collections.deque(maxlen=500)
+        self.priority_waits_ms = {p: collections.deque(maxlen=500) for p in range(len(PRIORITY_LABELS))}
+        self.stats = {
+            "requests": 0,
+            "switches": 0,
+            "fifo_switches": 0,
+            "rotations_idle": 0,
+            "rotations_priority": 0,
+            "rotations_max_wait": 0,
+        }
+        self._fifo_last = None
+        self._seq = itertools.count()
+
+    def max_wait_s(self):
+        value = self.config.get("affinity_max_wait_ms") if self.config else None
+        return float(value or DEFAULT_MAX_WAIT_MS) / 1000.0
+
+    # --- policy -----------------------------------------------------------
+
+    def _next_model(self, now):
+        """Model to serve next, and why (None reason = keep serving the current one)."""
+        current = self.serving
+        waiting = {m: q for m, q in self.queues.items() if q and m != current}
+        if not waiting:
+            return current, None
+
+        def urgency(queue):
+            return max(w.priority for w in queue), -min(w.enqueued_at for w in queue)
+
+        own_queue = self.queues.get(current) or []
+        if not own_queue and self.running.get(current, 0) == 0:
+            return max(waiting, key=lambda m: urgency(waiting[m])), "idle"
+
+        # Idle-only waiters never take the model away from live requests
+        eager = {m: [w for w in q if not w.idle_only] for m, q in waiting.items()}
+        eager = {m: q for m, q in eager.items() if q}
+        if not eager:
+            return current, None
+        candidate = max(eager, key=lambda m: urgency(eager[m]))
+        top_priority, oldest = urgency(eager[candidate])
+        own_priority = max((w.priority for w in own_queue), default=-1)
+
+        if top_priority > own_priority and top_priority > DEFAULT_PRIORITY:
+            return candidate, "priority"
+        if now + oldest >= self.max_wait_s():
+            return candidate, "max_wait"
+        return current, None
+
+    def _rotate(self, now):
+        target, reason = self._next_model(now)
+        if reason is None or target == self.serving:
+            return
+        if self.serving is not None:
+            self.stats["switches"] += 1
+            self.stats[f"rotations_{reason}"] += 1
+            self.rotations.append(now)
+        self.serving = target
+
+    def _account_fifo(self, model_id):
+        """What arrival-order serving would have cost."""
+        if self._fifo_last is not None and model_id != self._fifo_last:
+            self.stats["fifo_switches"] += 1
+        self._fifo_last = model_id
+
+    def _next_deadline(self, now):
+        oldest = min((w.enqueued_at for q in self.queues.values() for w in q if not w.idle_only), default=None)
+        if oldest is None:
+            return None
+        return max(0.01, oldest + self.max_wait_s() - now)
+
+    # --- admission --------------------------------------------------------
+
+    async def acquire(self, model_id, priority=None, external=False, idle_only=False):
+        """Wait for model_id's turn, then make it active (external: SDXL or warm-up, not switched here)."""
+        priority = parse_priority(priority)
+        current_priority.set(priority)
+        cond = self.coordinator._condition()
+        waiter = _Waiter(model_id, priority, next(self._seq), idle_only)
+        async with cond:
+            self.stats["requests"] += 1
+            self._account_fifo(model_id)
+            if self.serving is None:
+                self.serving = model_id
+            self.queues[model_id].append(waiter)
+            try:
+                while True:
+                    self._rotate(time.monotonic())
+                    if self.serving == model_id:
+                        break
+                    try:
+                        await asyncio.wait_for(cond.wait(), self._next_deadline(time.monotonic()))
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                # Also on cancellation (client disconnect): a stale waiter would pin its model's turn
+                self.queues[model_id].remove(waiter)
+                cond.notify_all()
+            if self.coordinator.on_scope_close(lambda: self._finished(model_id)):
+                self.running[model_id] += 1
+        if not idle_only:
+            wait_ms = (time.monotonic() - waiter.enqueued_at) * 1000.0
+            self.waits_ms.append(wait_ms)
+            self.priority_waits_ms[priority].append(wait_ms)
+        if external:
+            return {"model": model_id, "switched": False, "coalesced": False}
+        return await self.coordinator.acquire(model_id)
+
+    def is_busy(self, model_id=None):
+        """Requests queued or admitted and still running (for model_id, or for any model)."""
+        if model_id is None:
+            return any(self.queues.values()) or any(self.running.values())
+        return bool(self.queues.get(model_id)) or self.running.get(model_id, 0) > 0
+
+    async def _finished(self, model_id):
+        cond = self.coordinator._condition()
+        async with cond:
+            self.running[model_id] = max(0, self.running[model_id] - 1)
+            cond.notify_all()
+
+    # --- reporting --------------------------------------------------------
+
+    def _switch_rate(self):
+        cutoff = time.monotonic() - SWITCH_RATE_WINDOW_S
+        while self.rotations and self.rotations[0] < cutoff:
+            self.rotations.popleft()
+        return round(len(self.rotations) * 60.0 / SWITCH_RATE_WINDOW_S, 3)
+
+    def summary(self):
+        waits = list(self.waits_ms)
+        return {
+            **self.stats,
+            "switches_avoided": max(0, self.stats["fifo_switches"] - self.stats["switches"]),
+            "switch_rate_per_min": self._switch_rate(),
+            "queued": sum(len(q) for q in self.queues.values()),
+            "wait_p50_ms": round(_percentile(waits, 50), 1) if waits else None,
+            "wait_p95_ms": round(_percentile(waits, 95), 1) if waits else None,
+            "wait_by_priority": wait_summary(self.priority_waits_ms),
+        }
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            **self.summary(),
+            "serving": self.serving,
+            "max_wait_ms": self.max_wait_s() * 1000.0,
+            "queues": {
+                m: {"waiting": len(q), "oldest_wait_ms": round((now - min(w.enqueued_at for w in q)) * 1000.0, 1),
+                    "top_priority": max(w.priority for w in q)}
+                for m, q in self.queues.items() if q
+            },
+            "running": {m: n for m, n in self.running.items() if n},
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .switch_coordinator import SwitchCoordinator, SwitchError',
+        'from .switch_coordinator import SwitchCoordinator, SwitchError\n'
+        'from .affinity_scheduler import AffinityScheduler',
+    ),
+    (
+        "scheduler setup",
+        '''        metrics_sampler.register_provider("switch", self.switch_coordinator.summary)''',
+        '''        metrics_sampler.register_provider("switch", self.switch_coordinator.summary)
+        self.affinity_scheduler = AffinityScheduler(self.switch_coordinator, self.config)
+        metrics_sampler.register_provider("scheduler", self.affinity_scheduler.summary)''',
+    ),
+    (
+        "generate admission",
+        '''            scope = self.switch_coordinator.open_scope()
+            try:
+                response = await call_next(request)''',
+        '''            scope = self.switch_coordinator.open_scope()
+            try:
+                if request.method == "POST" and request.url.path.rstrip("/") == "/v1/generate":
+                    await self.affinity_scheduler.acquire(
+                        "sdxl-base", request.headers.get("X-Priority"), external=True
+                    )
+                response = await call_next(request)''',
+    ),
+    (
+        "chat admission",
+        '''            try:
+                await self.switch_coordinator.acquire(target_model)
+            except SwitchError:''',
+        '''            try:
+                await self.affinity_scheduler.acquire(
+                    target_model, request.headers.get("X-Priority") or data.get("priority")
+                )
+            except SwitchError:''',
+    ),
+    (
+        "status endpoint",
+        '''        @self.app.get("/v1/models/switch/status")
+        async def switch_status():
+            return self.switch_coordinator.status()''',
+        '''        @self.app.get("/v1/models/switch/status")
+        async def switch_status():
+            return {**self.switch_coordinator.status(), "scheduler": self.affinity_scheduler.status()}''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("affinity_scheduler.py", SCHEDULER_MODULE), ("switch_coordinator.py", COORDINATOR_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .affinity_scheduler import" in content:
+        print("✅ Already patched - affinity scheduler found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_switch_coordinator.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_affinity_scheduler'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional: config key affinity_max_wait_ms (default 1500)")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/metrics | jq .scheduler")
+
+    return True
+
+if __name__ == "__main__":
+    print("🧲 Moondream Station - Model Affinity Scheduler")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Patch to add a safety-first analysis pipeline: cheap NSFW gate, then the
+expensive caption / tag stages only for images that pass.
+
+The NSFW detector (Marqo 384, nsfw_backend) and the captioners are called
+as independent requests, so every upload pays for a full JoyCaption or
+moondream caption even when the content settings will hide or reject it.
+
+This patch installs moondream_station/core/analysis_pipeline.py and adds
+POST /v1/vision/analyze (JSON "items" / "images" / "image_url", or the
+multipart form of patch_binary_upload.py):
+1. Gate: all images are decoded at the gate model's input size and
+   classified in one batched call ("gate_model", default nsfw-detector,
+   function "classify")
+2. An image is flagged when a flag label ("nsfw", "explicit", "porn",
+   "hentai"; config "analysis_flag_labels") scores >= "threshold" (0-1 or a
+   percentage like the Content Safety slider; default 0.5). Gate failures
+   count as flagged (fail closed)
+3. Only passing images are decoded again at full size and sent to the
+   heavy stages: "stages" ["caption"] (caption_model, default moondream-2;
+   "prompt" turns it into a query) and/or ["tags"] (tag_model, default
+   wd-vit-tagger-v3). Flagged images are never decoded at full size
+4. Each stage runs in its own lease scope, so the gate model is released
+   before the captioner is switched in
+5. One combined result per image plus per-stage timing; /metrics
+   "analysis": images, filtered share, gate errors, per-stage time
+
+Also adds "classify" to the batch contract (a classify_batch() or
+BATCH_LIST_INPUT on the NSFW backend is picked up) and to the result
+cache's default functions, and decodes wd-vit-tagger-* models at 448.
+
+Requires: patch_result_cache.py, patch_binary_upload.py
+
+Usage:
+    python3 patch_analysis_pipeline.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_batch_contract import CONTRACT_MODULE  # noqa: E402
+from patch_decode_pool import DECODE_MODULE  # noqa: E402
+from patch_result_cache import CACHE_MODULE  # noqa: E402
+
+PIPELINE_MODULE = '''"""
+Gate-then-caption analysis pipeline.
+"""
+
+import collections
+import time
+
+DEFAULT_GATE_MODEL = "nsfw-detector"
+DEFAULT_GATE_FUNCTION = "classify"
+DEFAULT_CAPTION_MODEL = "moondream-2"
+DEFAULT_TAG_MODEL = "wd-vit-tagger-v3"
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_FLAG_LABELS = ("nsfw", "explicit", "porn", "hentai")
+STAGES = ("caption", "tags")
+
+
+def gate_scores(result):
+    """{label: score} from a classifier result ({label, score, predictions} or a plain score dict)."""
+    if not isinstance(result, dict):
+        return {}
+    if isinstance(result.get("predictions"), list):
+        return {str(p.get("label")).lower(): float(p.get("score", 0)) for p in result["predictions"] if isinstance(p, dict)}
+    if "label" in result and "score" in result:
+        return {str(result["label"]).lower(): float(result["score"])}
+    return {str(k).lower(): float(v) for k, v in result.items() if isinstance(v, (int, float))}
+
+
+def parse_threshold(value):
+    if value is None or value == "":
+        return None
+    value = float(value)
+    return value / 100.0 if value > 1 else value
+
+
+class AnalysisPipeline:
+    def __init__(self, service, scheduler, coordinator, decode_pool, manifest_manager, config=None):
+        self.service = service
+        self.scheduler = scheduler
+        self.coordinator = coordinator
+        self.decode_pool = decode_pool
+        self.manifest_manager = manifest_manager
+        self.config = config
+        self.stats = collections.Counter()
+        self.stage_ms = collections.Counter()
+        self.stage_images = collections.Counter()
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def options(self, data):
+        """Validated request options; ValueError (bad input) or LookupError (unknown model) otherwise."""
+        stages = data.get("stages") or ["caption"]
+        if isinstance(stages, str):
+            stages = [s.strip() for s in stages.split(",") if s.strip()]
+        unknown = [s for s in stages if s not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}; use {list(STAGES)}")
+        options = {
+            "stages": stages,
+            "gate_model": data.get("gate_model") or self._setting("analysis_gate_model", DEFAULT_GATE_MODEL),
+            "caption_model": data.get("caption_model") or self._setting("analysis_caption_model", DEFAULT_CAPTION_MODEL),
+            "tag_model": data.get("tag_model") or self._setting("analysis_tag_model", DEFAULT_TAG_MODEL),
+            "threshold": parse_threshold(data.get("threshold")),
+            "prompt": data.get("prompt"),
+            "length": data.get("length"),
+        }
+        if options["threshold"] is None:
+            options["threshold"] = parse_threshold(self._setting("analysis_threshold", DEFAULT_THRESHOLD))
+        known = self.manifest_manager.get_models()
+        needed = [options["gate_model"]] + [options["caption_model" if s == "caption" else "tag_model"] for s in stages]
+        missing = [m for m in needed if m not in known]
+        if missing:
+            raise LookupError(f"Models not found: {missing}")
+        return options
+
+    async def _stage(self, name, model_id, priority, images_b64, call):
+        """Lease model_id for this stage only, decode at its input size, run call(images)."""
+        scope = self.coordinator.open_scope()
+        started = time.perf_counter()
+        images = []
+        try:
+            await self.scheduler.acquire(model_id, priority)
+            images = await self.decode_pool.decode_many(images_b64, model_id, return_exceptions=True)
+            return images, await call([i for i in images if not isinstance(i, BaseException)])
+        finally:
+            for image in images:
+                if not isinstance(image, BaseException):
+                    image.close()
+            await self.coordinator.close_scope(scope)
+            self.stage_ms[name] += (time.perf_counter() - started) * 1000.0
+            self.stage_images[name] += len(images_b64)
+
+    @staticmethod
+    def _scatter(decoded, results):
+        """Results for the decoded images back onto the full list (decode failures -> exception)."""
+        out, it = [], iter(results)
+        for image in decoded:
+            out.append(image if isinstance(image, BaseException) else next(it))
+        return out
+
+    async def run(self, items, options, priority=None):
+        started = time.perf_counter()
+        ids = [item_id for item_id, _ in items]
+        sources = [source for _, source in items]
+        entries = [{"id": item_id, "index": i} for i, item_id in enumerate(ids)]
+        timing = {}
+        self.stats["requests"] += 1
+        self.stats["images"] += len(items)
+
+        # Stage 1: the cheap gate, batched
+        gate_function = self._setting("analysis_gate_function", DEFAULT_GATE_FUNCTION)
+        labels = [l.lower() for l in self._setting("analysis_flag_labels", DEFAULT_FLAG_LABELS)]
+        stage_started = time.perf_counter()
+        try:
+            decoded, results = await self._stage(
+                "gate", options["gate_model"], priority, sources,
+                lambda images: self.service.execute_function(gate_function, image=images) if images else _empty(),
+            )
+            gate = self._scatter(decoded, results)
+        except Exception as e:
+            gate = [e] * len(items)
+        timing["gate_ms"] = round((time.perf_counter() - stage_started) * 1000.0, 1)
+
+        passing = []
+        for index, result in enumerate(gate):
+            entry = entries[index]
+            if isinstance(result, BaseException):
+                entry.update(flagged=True, skipped="gate_error", gate={"error": str(result)})
+                self.stats["gate_errors"] += 1
+                continue
+            scores = gate_scores(result)
+            score = max((scores.get(label, 0.0) for label in labels), default=0.0)
+            entry["flagged"] = score >= options["threshold"]
+            entry["gate"] = {"score": round(score, 4), "result": result}
+            if entry["flagged"]:
+                entry["skipped"] = "flagged"
+                self.stats["flagged"] += 1
+            else:
+                passing.append(index)
+        del gate
+
+        # Stage 2: the heavy stages, passing images only
+        for stage in options["stages"]:
+            if not passing:
+                timing[f"{stage}_ms"] = 0.0
+                continue
+            if stage == "caption":
+                model_id = options["caption_model"]
+                function_name, kwargs = ("query", {"question": options["prompt"]}) if options["prompt"] else ("caption", {})
+                if options["length"] and function_name == "caption":
+                    kwargs["length"] = options["length"]
+            else:
+                model_id, function_name, kwargs = options["tag_model"], "caption", {}
+            stage_started = time.perf_counter()
+            try:
+                decoded, results = await self._stage(
+                    stage, model_id, priority, [sources[i] for i in passing],
+                    lambda images: self.service.execute_function(function_name, image=images, **kwargs) if images else _empty(),
+                )
+                outputs = self._scatter(decoded, results)
+            except Exception as e:
+                outputs = [e] * len(passing)
+            for index, output in zip(passing, outputs):
+                if isinstance(output, BaseException):
+                    entries[index].setdefault("errors", {})[stage] = str(output)
+                else:
+                    entries[index][stage] = output
+            timing[f"{stage}_ms"] = round((time.perf_counter() - stage_started) * 1000.0, 1)
+
+        timing["total_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        return {
+            "results": entries,
+            "count": len(entries),
+            "passed": len(passing),
+            "filtered": len(entries) - len(passing),
+            "threshold": options["threshold"],
+            "models": {"gate": options["gate_model"], **{s: options["caption_model" if s == "caption" else "tag_model"] for s in options["stages"]}},
+            "timing": timing,
+        }
+
+    def summary(self):
+        images = self.stats["images"]
+        return {
+            **self.stats,
+            "filtered_ratio": round((self.stats["flagged"] + self.stats["gate_errors"]) / images, 3) if images else None,
+            "stages": {
+                name: {
+                    "images": self.stage_images[name],
+                    "total_ms": round(self.stage_ms[name], 1),
+                    "ms_per_image": round(self.stage_ms[name] / self.stage_images[name], 1) if self.stage_images[name] else None,
+                }
+                for name in ("gate",) + STAGES if self.stage_images[name]
+            },
+        }
+
+
+async def _empty():
+    return []
+'''
+
+ANALYZE_ENDPOINT = '''@self.app.post("/v1/vision/analyze")
+        async def vision_analyze(request: Request):
+            """NSFW gate first (batched), caption / tags only for images that pass"""
+            if is_multipart(request):
+                data, items = await read_batch_upload(request, max_bytes(self.config))
+            else:
+                data = await request.json()
+                single = data.get("image_url") or data.get("image")
+                try:
+                    items = [[str(data.get("id", "0")), single]] if single else batch_items(data)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                record("json", int(request.headers.get("content-length") or 0), len(items))
+            if not items:
+                raise HTTPException(status_code=400, detail="No images")
+            try:
+                options = self.analysis_pipeline.options(data)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except LookupError as e:
+                raise HTTPException(status_code=404, detail=str(e))
+            del data
+            priority = request.headers.get("X-Priority")
+            return await self.analysis_pipeline.run(items, options, priority)
+
+        '''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .binary_ingest import (',
+        'from .analysis_pipeline import AnalysisPipeline\n'
+        'from .binary_ingest import (',
+    ),
+    (
+        "pipeline",
+        '''        metrics_sampler.register_provider("ingest", ingest_summary)''',
+        '''        metrics_sampler.register_provider("ingest", ingest_summary)
+        self.analysis_pipeline = AnalysisPipeline(
+            self.inference_service, self.affinity_scheduler, self.switch_coordinator,
+            decode_pool, self.manifest_manager, self.config,
+        )
+        metrics_sampler.register_provider("analysis", self.analysis_pipeline.summary)''',
+    ),
+]
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (
+        ("analysis_pipeline.py", PIPELINE_MODULE),
+        ("batch_contract.py", CONTRACT_MODULE),
+        ("decode_pool.py", DECODE_MODULE),
+        ("result_cache.py", CACHE_MODULE),
+    ):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .analysis_pipeline import" in content:
+        print("✅ Already patched - analysis pipeline found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_binary_upload.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if ROUTER_ANCHOR not in content:
+        print("❌ Could not find router setup hook")
+        return False
+    content = content.replace(ROUTER_ANCHOR, ANALYZE_ENDPOINT + ROUTER_ANCHOR, 1)
+    print("✓ Added POST /v1/vision/analyze")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_analysis_pipeline'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: analysis_gate_model, analysis_caption_model, analysis_tag_model,")
+    print("      analysis_threshold, analysis_flag_labels, analysis_gate_function")
+    print("   2. Restart moondream-station server")
+    print("   3. curl -X POST http://localhost:2020/v1/vision/analyze -H 'Content-Type: application/json' \\\\")
+    print("        -d '{\"images\": [\"BASE64\"], \"stages\": [\"caption\", \"tags\"]}'")
+    print("   4. curl http://localhost:2020/v1/metrics | jq .analysis")
+
+    return True
+
+if __name__ == "__main__":
+    print("🛡️  Moondream Station - Safety-First Analysis Pipeline")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Patch to give every vision backend one batch contract.
+
+/v1/vision/batch-caption only worked because wd14_backend.caption()
+checks isinstance(image, list). The NSFW (Marqo 384), Florence-2 and
+moondream backends received the list as if it were one image and failed.
+
+The contract, for any backend under models/backends/*/backend.py:
+    <function>_batch(images, **kwargs) -> list   native batch entry point
+    BATCH_LIST_INPUT = ("caption", ...)          <function> itself takes a list
+    BATCH_MAX_SIZE = 16  or  {"caption": 16}     largest batch per call
+A <function> whose source checks isinstance(image, list) (WD14 today)
+counts as list input without any change to the backend.
+
+This patch installs moondream_station/core/batch_contract.py:
+1. execute_function(name, image=[...]) works on every backend: native
+   batches are split into BATCH_MAX_SIZE chunks, other backends get an
+   automatic per-image loop
+2. /v1/models entries gain "batch": {function: {native, mode,
+   max_batch_size, recommended_batch_size}} read from the backend source
+   (ast scan, nothing is imported or loaded)
+3. Refreshes micro_batcher.py, which now groups requests only for
+   backends with native batching
+
+Requires: patch_micro_batching.py, patch_footprint_store.py
+
+Usage:
+    python3 patch_batch_contract.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_micro_batching import BATCHER_MODULE  # noqa: E402
+
+CONTRACT_MODULE = '''"""
+Batch contract between InferenceService and the vision backends.
+
+Capabilities come from the backend's source file (ast), so /v1/models can
+advertise them for models that are not loaded.
+"""
+
+import ast
+import functools
+import inspect
+import os
+import threading
+
+VISION_FUNCTIONS = ("caption", "query", "detect", "point", "classify")
+DEFAULT_NATIVE_MAX = 8
+BACKENDS_DIR = os.path.join(
+    os.environ.get("MOONDREAM_MODELS_DIR", os.path.expanduser("~/.moondream-station/models")), "backends"
+)
+
+_cache = {}  # path -> (mtime_ns, capabilities)
+_lock = threading.Lock()
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+
+def _checks_list(func):
+    """True if the function body does isinstance(<x>, list) - WD14's batch detection."""
+    for node in ast.walk(func):
+        if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "isinstance" and len(node.args) == 2:
+            kinds = node.args[1]
+            names = [getattr(e, "id", None) for e in kinds.elts] if isinstance(kinds, ast.Tuple) else [getattr(kinds, "id", None)]
+            if "list" in names:
+                return True
+    return False
+
+
+def scan_source(path):
+    """{function: {native, mode, max_batch_size, recommended_batch_size}} for one backend file."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    with _lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    try:
+        with open(path, "r") as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (OSError, SyntaxError) as e:
+        print(f"[BatchContract] Could not read {path}: {e}")
+        return {}
+
+    functions = {}
+    list_input = ()
+    max_size = None
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions.setdefault(node.name, node)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                name = getattr(target, "id", None) or getattr(target, "attr", None)
+                if name == "BATCH_LIST_INPUT":
+                    list_input = tuple(_literal(node.value) or ())
+                elif name == "BATCH_MAX_SIZE":
+                    max_size = _literal(node.value)
+
+    capabilities = {}
+    for name in VISION_FUNCTIONS:
+        if name not in functions:
+            continue
+        if f"{name}_batch" in functions:
+            mode = "batch_method"
+        elif name in list_input or _checks_list(functions[name]):
+            mode = "list_input"
+        else:
+            mode = "loop"
+        native = mode != "loop"
+        limit = max_size.get(name) if isinstance(max_size, dict) else max_size
+        limit = int(limit) if limit else (DEFAULT_NATIVE_MAX if native else None)
+        capabilities[name] = {
+            "native": native,
+            "mode": mode,
+            "max_batch_size": limit,
+            "recommended_batch_size": limit if native else 1,
+        }
+    with _lock:
+        _cache[path] = (mtime, capabilities)
+    return capabilities
+
+
+def backend_source(backend):
+    """Source file of a loaded backend (module or instance)."""
+    for target in (backend, type(backend)):
+        try:
+            return inspect.getfile(target)
+        except TypeError:
+            continue
+    return None
+
+
+def model_capabilities(model_info):
+    """Capabilities of a manifest model without loading it."""
+    backend = model_info.get("backend") if isinstance(model_info, dict) else getattr(model_info, "backend", None)
+    if not backend:
+        return {}
+    return scan_source(os.path.join(BACKENDS_DIR, backend, "backend.py"))
+
+
+def _loop_support():
+    return {"native": False, "mode": "loop", "max_batch_size": None, "recommended_batch_size": 1}
+
+
+def install_batch_contract(service):
+    """Make execute_function(name, image=[...]) work on every backend."""
+    if getattr(service, "_batch_contract_installed", False):
+        return
+    service._batch_contract_installed = True
+    original = service.execute_function
+
+    def batch_support(function_name):
+        for backend in getattr(service, "worker_backends", None) or []:
+            path = backend_source(backend)
+            if path:
+                return scan_source(path).get(function_name) or _loop_support()
+        return _loop_support()
+
+    @functools.wraps(original)
+    async def execute_function(function_name, *args, **kwargs):
+        images = kwargs.get("image")
+        if args or not isinstance(images, (list, tuple)):
+            return await original(function_name, *args, **kwargs)
+        rest = {k: v for k, v in kwargs.items() if k != "image"}
+        support = batch_support(function_name)
+        if support["mode"] == "loop":
+            return [await original(function_name, image=image, **rest) for image in images]
+
+        results = []
+        size = support["max_batch_size"] or len(images)
+        for start in range(0, len(images), size):
+            chunk = list(images[start:start + size])
+            if support["mode"] == "batch_method":
+                out = await original(f"{function_name}_batch", images=chunk, **rest)
+            else:
+                out = await original(function_name, image=chunk, **rest)
+            results.extend(out)
+        return results
+
+    service.batch_support = batch_support
+    service.execute_function = execute_function
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .micro_batcher import MicroBatcher',
+        'from .micro_batcher import MicroBatcher\n'
+        'from .batch_contract import install_batch_contract, model_capabilities',
+    ),
+    (
+        "install",
+        '''        residency_manager.attach(self.inference_service)''',
+        '''        # Batch contract: image=[...] works on every backend (native, or a per-image loop)
+        install_batch_contract(self.inference_service)
+        residency_manager.attach(self.inference_service)''',
+    ),
+]
+
+MODELS_ANCHOR = '''                            "load_stats": model_memory_tracker.get_load_stats(model_id),'''
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("batch_contract.py", CONTRACT_MODULE), ("micro_batcher.py", BATCHER_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .batch_contract import" in content:
+        print("✅ Already patched - batch contract found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_micro_batching.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if MODELS_ANCHOR in content:
+        content = content.replace(
+            MODELS_ANCHOR,
+            MODELS_ANCHOR + '\n                            "batch": model_capabilities(model_info),',
+            1,
+        )
+        print("✓ /v1/models advertises batch support")
+    else:
+        print("⚠️  Could not find /v1/models load_stats - batch support not advertised")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_batch_contract'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl http://localhost:2020/v1/models | jq '.models[] | {id, batch}'")
+    print("   3. Batch-caption with a non-WD14 model now loops instead of failing")
+
+    return True
+
+if __name__ == "__main__":
+    print("🧩 Moondream Station - Vision Backend Batch Contract")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
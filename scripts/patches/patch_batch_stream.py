@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Patch to stream batch caption / classification results per image.
+
+/v1/vision/batch-caption decodes every image, runs the whole batch and
+returns one JSON blob (captions, count, duration). The client sees nothing
+until the slowest image is done, and all decoded images and results stay
+in memory until the end.
+
+This patch installs moondream_station/core/batch_stream.py and adds
+POST /v1/vision/batch-caption/stream:
+1. Body: {"model", "items": [{"id", "image"}, ...]} (or "images" + "ids"),
+   optional "function" (caption / query / detect / point, default caption),
+   "sub_batch", "length", "settings", "priority"
+2. Images are decoded one sub-batch at a time on worker threads (the next
+   sub-batch while the current one runs); each sub-batch runs as one
+   execute_function(image=[...]) call (batch contract: native batch or
+   per-image loop)
+3. One NDJSON line per image - {"id", "index", "result"} or {"id", "index",
+   "error"} - as soon as its sub-batch completes, then {"done": true, ...}.
+   With Accept: text/event-stream (or "format": "sse") the same objects are
+   sent as SSE "result" / "done" events
+4. Base64 strings, PIL images and results are dropped as soon as their
+   line is written
+5. The model is admitted through the affinity scheduler and leased for the
+   whole stream, so it cannot be switched away mid-batch
+
+Requires: patch_batch_contract.py
+
+Usage:
+    python3 patch_batch_stream.py
+"""
+
+import os
+import sys
+
+STREAM_MODULE = '''"""
+Per-image streaming of batched vision results.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import time
+
+DEFAULT_SUB_BATCH = 4
+
+
+def batch_items(data):
+    """[[id, b64], ...] from {"items": [{"id", "image"}]} or {"images": [...], "ids": [...]}."""
+    if data.get("items"):
+        return [[item.get("id", str(i)), item.get("image")] for i, item in enumerate(data["items"])]
+    images = data.get("images") or []
+    ids = data.get("ids") or [str(i) for i in range(len(images))]
+    if len(ids) != len(images):
+        raise ValueError(f"{len(ids)} ids for {len(images)} images")
+    return [[ids[i], images[i]] for i in range(len(images))]
+
+
+def decode_image(b64_str):
+    from PIL import Image
+    if isinstance(b64_str, (bytes, bytearray)):
+        return Image.open(io.BytesIO(b64_str)).convert("RGB")
+    if b64_str.startswith("data:image"):
+        _, b64_str = b64_str.split(",", 1)
+    image = Image.open(io.BytesIO(base64.b64decode(b64_str)))
+    return image.convert("RGB")
+
+
+def _frame(payload, sse, event="result"):
+    text = json.dumps(payload, default=str)
+    if sse:
+        return f"event: {event}\\ndata: {text}\\n\\n"
+    return text + "\\n"
+
+
+async def decode_in_executor(b64_list):
+    """Default decoder: one image per default-executor thread, errors returned in place."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(None, decode_image, b) for b in b64_list), return_exceptions=True)
+
+
+async def _run_single(service, function_name, image, kwargs):
+    """Result of one image, or the exception it raised."""
+    try:
+        return await service.execute_function(function_name, image=image, **kwargs)
+    except Exception as e:
+        return e
+
+
+async def stream_batch(service, function_name, items, sub_batch=None, kwargs=None, sse=False, decode=None):
+    """Yield one frame per item as each sub-batch finishes; items is consumed as it goes.
+
+    decode(b64_list) -> [image or exception]; the next sub-batch is decoded
+    while the current one runs inference.
+    """
+    decode = decode or decode_in_executor
+    size = int(sub_batch or 0)
+    if size <= 0:
+        support = service.batch_support(function_name) if hasattr(service, "batch_support") else {}
+        size = support.get("recommended_batch_size") or DEFAULT_SUB_BATCH
+    kwargs = kwargs or {}
+    started = time.perf_counter()
+    errors = 0
+    total = len(items)
+    ids = [item_id for item_id, _ in items]
+    starts = list(range(0, total, size))
+
+    def start_decode(start):
+        b64_list = []
+        for index in range(start, min(start + size, total)):
+            b64_list.append(items[index][1])
+            items[index] = None  # release the base64 string once decoded
+        return asyncio.ensure_future(decode(b64_list))
+
+    pending = start_decode(starts[0]) if starts else None
+    try:
+        for n, start in enumerate(starts):
+            decoded = await pending
+            pending = start_decode(starts[n + 1]) if n + 1 < len(starts) else None
+
+            chunk = []
+            for offset, image in enumerate(decoded):
+                index = start + offset
+                if isinstance(image, BaseException):
+                    errors += 1
+                    yield _frame({"id": ids[index], "index": index, "error": f"decode failed: {image}"}, sse)
+                else:
+                    chunk.append((index, ids[index], image))
+            del decoded
+            if not chunk:
+                continue
+
+            chunk_started = time.perf_counter()
+            try:
+                results = await service.execute_function(function_name, image=[image for _, _, image in chunk], **kwargs)
+                if not isinstance(results, (list, tuple)) or len(results) != len(chunk):
+                    raise TypeError(f"expected {len(chunk)} results, got {type(results).__name__}")
+            except Exception as e:
+                if len(chunk) == 1:
+                    results = [e]
+                else:
+                    # Replay one image at a time, so a failure is reported only for its own image
+                    print(f"[BatchStream] Sub-batch of {len(chunk)} failed, replaying singly: {e}")
+                    results = [await _run_single(service, function_name, image, kwargs) for _, _, image in chunk]
+            for _, _, image in chunk:
+                image.close()
+            ms = round((time.perf_counter() - chunk_started) * 1000.0, 1)
+
+            for position, (index, item_id, _) in enumerate(chunk):
+                result = results[position]
+                if isinstance(result, Exception):
+                    errors += 1
+                    yield _frame({"id": item_id, "index": index, "error": str(result)}, sse)
+                else:
+                    yield _frame({"id": item_id, "index": index, "result": result, "sub_batch_ms": ms}, sse)
+            del chunk, results
+    finally:
+        if pending is not None:
+            pending.cancel()  # client went away mid-stream
+
+    yield _frame({
+        "done": True,
+        "count": total,
+        "errors": errors,
+        "sub_batch": size,
+        "duration": round(time.perf_counter() - started, 3),
+    }, sse, event="done")
+'''
+
+STREAM_ENDPOINT = '''@self.app.post("/v1/vision/batch-caption/stream")
+        async def batch_caption_stream(request: Request):
+            """One NDJSON line (or SSE event) per image as soon as its sub-batch finishes"""
+            from fastapi.responses import StreamingResponse
+            from .batch_stream import _frame
+            data = await request.json()
+            try:
+                items = batch_items(data)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            function_name = data.get("function", "caption")
+            if function_name not in VISION_FUNCTIONS:
+                raise HTTPException(status_code=400, detail=f"Unsupported function {function_name}")
+            model_id = data.get("model") or self.config.get("current_model")
+            if model_id not in self.manifest_manager.get_models():
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found")
+            sse = "text/event-stream" in request.headers.get("accept", "") or data.get("format") == "sse"
+            priority = request.headers.get("X-Priority") or data.get("priority")
+            kwargs = {key: data[key] for key in ("length", "settings", "question") if key in data}
+            sub_batch = data.get("sub_batch")
+            residency_manager.set_mode(request.headers.get("X-VRAM-Mode"))
+            del data
+
+            async def body():
+                # Own scope: admission and leases last exactly as long as the stream
+                scope = self.switch_coordinator.open_scope()
+                try:
+                    await self.affinity_scheduler.acquire(model_id, priority)
+                    async for frame in stream_batch(self.inference_service, function_name, items, sub_batch, kwargs, sse):
+                        yield frame
+                except SwitchError:
+                    yield _frame({"done": True, "error": f"Failed to switch to model {model_id}"}, sse, event="done")
+                finally:
+                    await self.switch_coordinator.close_scope(scope)
+
+            return StreamingResponse(body(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+        '''
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+IMPORT_ANCHOR = 'from .batch_contract import install_batch_contract, model_capabilities'
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "batch_stream.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(STREAM_MODULE)
+
+    if "from .batch_stream import" in content:
+        print("✅ Already patched - batch streaming found")
+        return True
+
+    if IMPORT_ANCHOR not in content:
+        print("❌ Run patch_batch_contract.py first")
+        return False
+    content = content.replace(
+        IMPORT_ANCHOR,
+        IMPORT_ANCHOR.replace("model_capabilities", "model_capabilities, VISION_FUNCTIONS") + '\n'
+        'from .batch_stream import batch_items, stream_batch',
+        1,
+    )
+    print("✓ Patched import")
+
+    if ROUTER_ANCHOR not in content:
+        print("❌ Could not find router setup hook")
+        return False
+    content = content.replace(ROUTER_ANCHOR, STREAM_ENDPOINT + ROUTER_ANCHOR, 1)
+    print("✓ Added POST /v1/vision/batch-caption/stream")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_batch_stream'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl -N -X POST http://localhost:2020/v1/vision/batch-caption/stream \\\\")
+    print("        -H 'Content-Type: application/json' \\\\")
+    print("        -d '{\"model\": \"wd14-vit-v2\", \"items\": [{\"id\": \"a\", \"image\": \"BASE64\"}]}'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🌊 Moondream Station - Streaming Batch Results")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Patch to accept images as multipart/form-data or raw bytes, next to base64 JSON.
+
+Every vision route takes `data:image/png;base64,...` inside JSON: the
+payload is ~33% larger on the wire, and the server parses multi-MB JSON
+strings and base64-decodes them before the image decoder sees a byte.
+
+This patch installs moondream_station/core/binary_ingest.py and adds:
+1. POST /v1/vision/{caption|query|detect|point|classify}/raw - body is the
+   image file (Content-Type: application/octet-stream or image/*), settings
+   in the query string (model, length, question, settings as JSON,
+   priority). The whole body is buffered (up to upload_max_mb) before the
+   decode pool (patch_decode_pool.py) decodes it at the model's input size;
+   what it saves is the JSON parse and base64 decode, not the buffering.
+   classify needs patch_analysis_pipeline.py for backend support
+2. POST /v1/vision/batch-caption/upload - multipart/form-data with repeated
+   "images" file parts, optional "ids" (default: file names), "model",
+   "function"; returns the batch-caption shape (captions, count, duration)
+   plus ids
+3. POST /v1/vision/batch-caption/stream also accepts the same multipart body
+4. "upload_max_mb" (default 50) per request -> 413; /metrics "ingest":
+   requests and bytes per form (json / multipart / raw)
+
+The JSON routes, including the OpenAI-compatible /v1/chat/completions, are
+unchanged. Benchmark: scripts/benchmark_image_upload.py
+
+Requires: patch_decode_pool.py, python-multipart (requirements.txt)
+
+Usage:
+    python3 patch_binary_upload.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_batch_stream import STREAM_MODULE  # noqa: E402
+from patch_decode_pool import DECODE_MODULE  # noqa: E402
+
+INGEST_MODULE = '''"""
+Binary image ingest: raw request bodies and multipart uploads, no base64.
+"""
+
+import collections
+import json
+
+from fastapi import HTTPException
+
+DEFAULT_MAX_MB = 50
+SETTING_FIELDS = ("length", "question", "settings")
+RAW_TYPES = ("application/octet-stream", "image/")
+
+ingest_stats = {"json": collections.Counter(), "multipart": collections.Counter(), "raw": collections.Counter()}
+
+
+def max_bytes(config):
+    value = config.get("upload_max_mb") if config else None
+    return int(float(value if value is not None else DEFAULT_MAX_MB) * 1024 * 1024)
+
+
+def is_multipart(request):
+    return request.headers.get("content-type", "").startswith("multipart/form-data")
+
+
+def is_raw(request):
+    content_type = request.headers.get("content-type", "")
+    return any(content_type.startswith(t) for t in RAW_TYPES)
+
+
+def record(form, nbytes, images=1):
+    stats = ingest_stats[form]
+    stats["requests"] += 1
+    stats["images"] += images
+    stats["bytes"] += nbytes
+
+
+def _too_large(limit):
+    return HTTPException(status_code=413, detail=f"Upload larger than {limit // (1024 * 1024)} MB")
+
+
+async def read_raw(request, limit):
+    """The whole request body in one buffer; 413 as soon as it passes limit.
+
+    Decoding starts only once the body is complete - image decoders need
+    the full file, so this is not incremental.
+    """
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise _too_large(limit)
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise _too_large(limit)
+    if not body:
+        raise HTTPException(status_code=400, detail="Empty request body")
+    record("raw", len(body))
+    return body
+
+
+def settings_from(fields):
+    """Function kwargs from query / form fields (settings may be a JSON string)."""
+    kwargs = {key: fields[key] for key in SETTING_FIELDS if fields.get(key) not in (None, "")}
+    if isinstance(kwargs.get("settings"), str):
+        try:
+            kwargs["settings"] = json.loads(kwargs["settings"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="settings must be JSON")
+    return kwargs
+
+
+async def read_batch_upload(request, limit):
+    """(fields, [[id, bytes], ...]) from a multipart body with repeated "images" parts."""
+    form = await request.form()
+    try:
+        uploads = form.getlist("images") or form.getlist("image")
+        ids = form.getlist("ids")
+        if len(ids) == 1 and len(uploads) > 1:
+            ids = [i.strip() for i in ids[0].split(",")]
+        if ids and len(ids) != len(uploads):
+            raise HTTPException(status_code=400, detail=f"{len(ids)} ids for {len(uploads)} images")
+        items = []
+        total = 0
+        for index, upload in enumerate(uploads):
+            if isinstance(upload, str):
+                raise HTTPException(status_code=400, detail="images must be file parts")
+            data = await upload.read()
+            total += len(data)
+            if total > limit:
+                raise _too_large(limit)
+            items.append([ids[index] if ids else (upload.filename or str(index)), data])
+        fields = {key: value for key, value in form.multi_items() if isinstance(value, str) and key != "ids"}
+    finally:
+        await form.close()
+    fields.update(settings_from(fields))
+    record("multipart", total, len(items))
+    return fields, items
+
+
+def close_decoded(future):
+    """Done-callback for a decode that is no longer wanted: close its images."""
+    if not future.cancelled() and future.exception() is None:
+        for image in future.result():
+            image.close()
+
+
+def summary():
+    return {form: dict(stats) for form, stats in ingest_stats.items()}
+'''
+
+RAW_ENDPOINTS = '''@self.app.post("/v1/vision/{function_name}/raw")
+        async def vision_raw(function_name: str, request: Request):
+            """One image as the request body (octet-stream / image/*), settings in the query string"""
+            if function_name not in VISION_FUNCTIONS:
+                raise HTTPException(status_code=404, detail=f"Unknown function {function_name}")
+            if not is_raw(request):
+                raise HTTPException(status_code=415, detail="Send the image as application/octet-stream or image/*")
+            params = request.query_params
+            model_id = params.get("model") or self.config.get("current_model")
+            if model_id not in self.manifest_manager.get_models():
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found")
+            started = time.time()
+            kwargs = settings_from(params)
+            body = await read_raw(request, max_bytes(self.config))
+            # Decode on the pool while the scheduler admits / switches the model
+            decoding = asyncio.ensure_future(decode_pool.decode_many([body], model_id))
+            del body
+            try:
+                await self.affinity_scheduler.acquire(model_id, request.headers.get("X-Priority") or params.get("priority"))
+            except SwitchError:
+                decoding.add_done_callback(close_decoded)
+                raise HTTPException(status_code=500, detail=f"Failed to switch to model {model_id}")
+            self.warmup_predictor.observe(model_id)
+            try:
+                image = (await decoding)[0]
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+            try:
+                result = await self.inference_service.execute_function(function_name, image=image, **kwargs)
+            finally:
+                image.close()
+            return {"result": result, "model": model_id, "duration": round(time.time() - started, 3)}
+
+        @self.app.post("/v1/vision/batch-caption/upload")
+        async def batch_caption_upload(request: Request):
+            """multipart/form-data variant of /v1/vision/batch-caption"""
+            if not is_multipart(request):
+                raise HTTPException(status_code=415, detail="Send multipart/form-data with repeated images parts")
+            started = time.time()
+            fields, items = await read_batch_upload(request, max_bytes(self.config))
+            function_name = fields.get("function", "caption")
+            if function_name not in VISION_FUNCTIONS:
+                raise HTTPException(status_code=400, detail=f"Unsupported function {function_name}")
+            model_id = fields.get("model") or self.config.get("current_model")
+            if model_id not in self.manifest_manager.get_models():
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found")
+            ids = [item_id for item_id, _ in items]
+            decoding = asyncio.ensure_future(decode_pool.decode_many([data for _, data in items], model_id))
+            del items
+            try:
+                await self.affinity_scheduler.acquire(model_id, request.headers.get("X-Priority") or fields.get("priority"))
+            except SwitchError:
+                decoding.add_done_callback(close_decoded)
+                raise HTTPException(status_code=500, detail=f"Failed to switch to model {model_id}")
+            self.warmup_predictor.observe(model_id)
+            try:
+                images = await decoding
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+            try:
+                captions = await self.inference_service.execute_function(
+                    function_name, image=images, **settings_from(fields)
+                )
+            finally:
+                for image in images:
+                    image.close()
+            return {"captions": captions, "ids": ids, "count": len(captions), "duration": round(time.time() - started, 3)}
+
+        '''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .decode_pool import decode_pool',
+        'from .decode_pool import decode_pool\n'
+        'from .binary_ingest import (\n'
+        '    close_decoded, is_multipart, is_raw, max_bytes, read_batch_upload, read_raw, record, settings_from,\n'
+        '    summary as ingest_summary,\n'
+        ')',
+    ),
+    (
+        "ingest metrics",
+        '''        metrics_sampler.register_provider("decode", decode_pool.summary)''',
+        '''        metrics_sampler.register_provider("decode", decode_pool.summary)
+        metrics_sampler.register_provider("ingest", ingest_summary)''',
+    ),
+    (
+        "stream multipart",
+        '''            data = await request.json()
+            try:
+                items = batch_items(data)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))''',
+        '''            if is_multipart(request):
+                data, items = await read_batch_upload(request, max_bytes(self.config))
+            else:
+                data = await request.json()
+                try:
+                    items = batch_items(data)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                record("json", int(request.headers.get("content-length") or 0), len(items))''',
+    ),
+]
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (
+        ("binary_ingest.py", INGEST_MODULE),
+        ("decode_pool.py", DECODE_MODULE),
+        ("batch_stream.py", STREAM_MODULE),
+    ):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .binary_ingest import" in content:
+        print("✅ Already patched - binary upload found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_decode_pool.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if ROUTER_ANCHOR not in content:
+        print("❌ Could not find router setup hook")
+        return False
+    content = content.replace(ROUTER_ANCHOR, RAW_ENDPOINTS + ROUTER_ANCHOR, 1)
+    print("✓ Added POST /v1/vision/{function}/raw and /v1/vision/batch-caption/upload")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_binary_upload'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl -X POST 'http://localhost:2020/v1/vision/caption/raw?model=wd14-vit-v2' \\\\")
+    print("        -H 'Content-Type: application/octet-stream' --data-binary @photo.jpg")
+    print("   3. curl -X POST 'http://localhost:2020/v1/vision/classify/raw?model=nsfw-detector' \\\\")
+    print("        -H 'Content-Type: image/jpeg' --data-binary @photo.jpg")
+    print("   4. python3 scripts/benchmark_image_upload.py photo.jpg")
+
+    return True
+
+if __name__ == "__main__":
+    print("📤 Moondream Station - Binary Image Upload")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Patch to publish server capacity and queue depth for adaptive concurrency.
+
+The queue (hooks/queue/useAdaptiveConcurrency.ts, useQueueCalibration.ts)
+guesses a safe concurrency from VRAM % and tokens/s after the fact: it steps
+up until requests back up or OOM, then steps down. The server already knows
+what the client is guessing at - how many calls it runs at once, how many
+are waiting, how long a call takes on the loaded model and how much VRAM is
+left.
+
+This patch installs moondream_station/core/capacity.py and:
+1. Adds GET /v1/system/capacity (no model calls, no locks; VRAM is read at
+   most once a second):
+   - queue_depth: calls waiting for the dispatcher plus requests queued in
+     the affinity scheduler, in_flight, slots
+   - recommended_concurrency (1-5, "capacity_max_concurrency"): one call
+     per dispatch slot plus one queued so a slot never idles, raised to the
+     model's recommended batch size when micro-batching can merge
+     concurrent calls; 1 when free VRAM is below "capacity_min_free_vram_mb"
+     (default 1024), halved below twice that. A backlog lowers it: one
+     less per call queued beyond the slots, and 1 once the estimated wait
+     at the request's priority passes "capacity_max_wait_ms" (default 5000)
+   - estimated_wait_ms per priority: calls ahead of a new call at that
+     priority x the model's average call time (null until one call ran)
+   - service_ms per model, vram total / free
+   ?priority= picks the priority for the top-level estimated_wait_ms
+2. Adds X-Recommended-Concurrency, X-Queue-Depth and X-Estimated-Wait-Ms
+   (for the request's own X-Priority) to every POST response, so each
+   inference call also returns the current signal
+3. /metrics "capacity": the same snapshot
+
+Requires: patch_priority_dispatch.py (service time per model), patch_batch_contract.py
+
+Usage:
+    python3 patch_capacity_signal.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_priority_dispatch import DISPATCH_MODULE  # noqa: E402
+
+CAPACITY_MODULE = '''"""
+Capacity signal: how many concurrent calls the server can use right now, and how long a new one waits.
+"""
+
+import time
+
+from .affinity_scheduler import DEFAULT_PRIORITY, PRIORITY_LABELS, parse_priority
+from .micro_batcher import DEFAULT_MAX_SIZE as MICRO_BATCH_MAX_SIZE
+from .residency_manager import device_vram_mb
+
+DEFAULT_MAX_CONCURRENCY = 5
+DEFAULT_MIN_FREE_VRAM_MB = 1024
+DEFAULT_MAX_WAIT_MS = 5000.0
+VRAM_REFRESH_S = 1.0
+
+
+class CapacitySignal:
+    def __init__(self, service, scheduler, dispatcher, config=None):
+        self.service = service
+        self.scheduler = scheduler
+        self.dispatcher = dispatcher
+        self.config = config
+        self._vram = (None, None)
+        self._vram_at = 0.0
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def vram(self):
+        """(total_mb, free_mb), refreshed at most once per VRAM_REFRESH_S."""
+        now = time.monotonic()
+        if now - self._vram_at >= VRAM_REFRESH_S:
+            self._vram = device_vram_mb()
+            self._vram_at = now
+        return self._vram
+
+    def model_id(self):
+        return self.scheduler.serving or (self.config.get("current_model") if self.config else None)
+
+    def scheduler_queued(self):
+        return sum(len(q) for q in self.scheduler.queues.values())
+
+    def queue_depth(self):
+        return self.dispatcher.waiting_count() + self.scheduler_queued()
+
+    def recommended_concurrency(self, priority=DEFAULT_PRIORITY):
+        ceiling = max(1, int(self._setting("capacity_max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+        wanted = self.dispatcher.slots() + 1
+        if int(self._setting("micro_batch_max_size", MICRO_BATCH_MAX_SIZE)) > 1 and hasattr(self.service, "batch_support"):
+            try:
+                support = self.service.batch_support("caption")
+            except Exception:
+                support = {}
+            if support.get("native"):
+                wanted = max(wanted, int(support.get("recommended_batch_size") or 1))
+
+        _, free_mb = self.vram()
+        floor_mb = float(self._setting("capacity_min_free_vram_mb", DEFAULT_MIN_FREE_VRAM_MB))
+        if free_mb is not None and free_mb < floor_mb:
+            wanted = 1
+        elif free_mb is not None and free_mb < 2 * floor_mb:
+            wanted = max(1, wanted // 2)
+
+        # Other clients backed up: more concurrency would only join the queue
+        backlog = self.queue_depth() - self.dispatcher.slots()
+        if backlog > 0:
+            wanted = max(1, wanted - backlog)
+        wait_ms = self.estimated_wait_ms(priority)
+        if wait_ms is not None and wait_ms > float(self._setting("capacity_max_wait_ms", DEFAULT_MAX_WAIT_MS)):
+            wanted = 1
+        return max(1, min(wanted, ceiling))
+
+    def estimated_wait_ms(self, priority=DEFAULT_PRIORITY):
+        # Requests still in the scheduler run before a new call reaches the dispatcher
+        return self.dispatcher.estimated_wait_ms(parse_priority(priority), self.model_id(), self.scheduler_queued())
+
+    def headers(self, priority=DEFAULT_PRIORITY):
+        out = {
+            "X-Recommended-Concurrency": str(self.recommended_concurrency(priority)),
+            "X-Queue-Depth": str(self.queue_depth()),
+        }
+        wait_ms = self.estimated_wait_ms(priority)
+        if wait_ms is not None:
+            out["X-Estimated-Wait-Ms"] = f"{wait_ms:.0f}"
+        return out
+
+    def snapshot(self, priority=DEFAULT_PRIORITY):
+        total_mb, free_mb = self.vram()
+        waits = {label: self.estimated_wait_ms(p) for p, label in enumerate(PRIORITY_LABELS)}
+        wait_ms = self.estimated_wait_ms(priority)
+        return {
+            "model": self.model_id(),
+            "recommended_concurrency": self.recommended_concurrency(priority),
+            "queue_depth": self.queue_depth(),
+            "in_flight": self.dispatcher.active,
+            "slots": self.dispatcher.slots(),
+            "estimated_wait_ms": None if wait_ms is None else round(wait_ms),
+            "estimated_wait_ms_by_priority": {k: None if v is None else round(v) for k, v in waits.items()},
+            "service_ms": {m: {k: round(v, 1) for k, v in s.items()} for m, s in self.dispatcher.service_ms.items()},
+            "vram": {
+                "total_mb": None if total_mb is None else round(total_mb),
+                "free_mb": None if free_mb is None else round(free_mb),
+            },
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .priority_dispatch import PriorityDispatcher',
+        'from .priority_dispatch import PriorityDispatcher\n'
+        'from .capacity import CapacitySignal',
+    ),
+    (
+        "capacity",
+        '''        # Outermost: a micro-batch is one execute_function call for the wrappers above''',
+        '''        self.capacity = CapacitySignal(
+            self.inference_service, self.affinity_scheduler, self.priority_dispatcher, self.config
+        )
+        metrics_sampler.register_provider("capacity", self.capacity.snapshot)
+
+        @self.app.middleware("http")
+        async def capacity_headers(request: Request, call_next):
+            """X-Recommended-Concurrency / X-Queue-Depth / X-Estimated-Wait-Ms on inference calls"""
+            response = await call_next(request)
+            if request.method == "POST":
+                response.headers.update(
+                    self.capacity.headers(request.headers.get("X-Priority") or request.query_params.get("priority"))
+                )
+            return response
+
+        @self.app.get("/v1/system/capacity")
+        async def capacity(priority: str = None):
+            return self.capacity.snapshot(priority)
+
+        # Outermost: a micro-batch is one execute_function call for the wrappers above''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("capacity.py", CAPACITY_MODULE), ("priority_dispatch.py", DISPATCH_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .capacity import" in content:
+        print("✅ Already patched - capacity signal found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_priority_dispatch.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_capacity_signal'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: capacity_max_concurrency (default 5), capacity_min_free_vram_mb (default 1024),")
+    print("      capacity_max_wait_ms (default 5000)")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/system/capacity")
+    print("   4. curl -si -X POST http://localhost:2020/v1/vision/caption ... | grep -i '^x-\\(recommended\\|queue\\|estimated\\)'")
+
+    return True
+
+if __name__ == "__main__":
+    print("📶 Moondream Station - Capacity Signal")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
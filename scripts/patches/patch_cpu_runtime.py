@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Patch to run the small classifiers (WD14 tagger, NSFW detector) in a CPU
+execution mode with partitioned threads.
+
+On nodes without a usable GPU, wd14_backend and nsfw_backend run on the CPU
+with default torch settings: every call uses one intra-op thread per core.
+When both models are busy at once (the analysis pipeline, two clients), each
+one spawns a full set of threads, every core is oversubscribed, and
+throughput drops below what one model gets on its own.
+
+This patch installs moondream_station/core/cpu_runtime.py:
+1. A model is in CPU mode when its id matches "cpu_runtime_models" (default
+   wd14 / tagger / nsfw) and its weights are on the CPU after the load
+   ("cpu_runtime": "auto", the default). Use "cpu_runtime": true to move
+   those models to the CPU on GPU nodes too (frees VRAM for the captioners),
+   or false to disable
+2. The usable cores are split between the loaded CPU-mode models, and
+   re-split when one is loaded or unloaded. Each model gets its own thread
+   pool ("cpu_workers" threads, default 1) whose threads call
+   torch.set_num_threads(share // workers). Thread counts are per calling
+   thread in the OpenMP builds of torch, so two models running at once use
+   their own share of cores instead of all of them each. "cpu_threads"
+   ({model: n}) overrides a share. "cpu_pin_cores": true also pins each
+   pool to its cores (Linux)
+3. The inter-op pool is set once at startup ("cpu_interop_threads",
+   default 1), only when a model will run in CPU mode: "cpu_runtime": true,
+   or auto on a node without CUDA
+4. Optional int8: "cpu_int8" (true or a list of model ids) swaps every
+   nn.Linear for a dynamically quantized one (torch.ao quantize_dynamic).
+   The quantized module is cached under "cpu_int8_dir" (default
+   ~/.moondream-station/models/quantized), keyed by the weights and the
+   torch version, so later loads skip the quantization
+5. A CPU-mode model's worker pool is replaced by one with the same
+   submit_request() contract that runs the backend call on the model's
+   thread pool, so execute_function, its wrappers and the worker pool's
+   timeout / result shape stay as they are. /metrics "cpu_runtime": the
+   plan, calls, images, images/s and p50 per model
+
+Benchmark (fp32 default vs partitioned vs int8): scripts/benchmark_cpu_runtime.py
+
+Requires: patch_batch_contract.py
+
+Usage:
+    python3 patch_cpu_runtime.py
+"""
+
+import os
+import sys
+
+CPU_MODULE = '''"""
+CPU execution mode for small classifiers: one sized thread pool per model.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import os
+import threading
+import time
+import types
+import weakref
+
+DEFAULT_MODELS = ("wd14", "tagger", "nsfw")
+DEFAULT_INT8_DIR = os.path.expanduser("~/.moondream-station/models/quantized")
+DEVICE_ATTRS = ("device", "_device")
+_SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, str, bytes, int, float)
+
+
+def usable_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def torch_modules(backend):
+    """(owner, attribute, nn.Module) for the models a backend holds (module globals or attributes, and .model)."""
+    import torch
+    owners = [backend]
+    if hasattr(backend, "__dict__"):
+        owners += [v for v in vars(backend).values() if not isinstance(v, _SKIP) and not isinstance(v, torch.nn.Module)]
+    found, seen = [], set()
+    for owner in owners:
+        if not hasattr(owner, "__dict__"):
+            continue
+        for name, value in list(vars(owner).items()):
+            if isinstance(value, torch.nn.Module) and id(value) not in seen:
+                seen.add(id(value))
+                found.append((owner, name, value))
+    return found
+
+
+def _on_cpu(module):
+    return all(p.device.type == "cpu" for p in module.parameters())
+
+
+def _move_to_cpu(backend, modules):
+    import torch
+    owners = {id(backend): backend}
+    for owner, _, module in modules:
+        module.to("cpu")
+        owners[id(owner)] = owner
+    for owner in owners.values():
+        for attr in DEVICE_ATTRS:
+            value = getattr(owner, attr, None)
+            if isinstance(value, (str, torch.device)):
+                setattr(owner, attr, torch.device("cpu"))
+
+
+def fingerprint(model_id, module):
+    """Weights + torch version: a changed checkpoint or torch upgrade misses the int8 cache."""
+    import torch
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(f"{model_id}|{torch.__version__}|{type(module).__name__}".encode())
+    for name, tensor in module.state_dict().items():
+        digest.update(f"{name}{tuple(tensor.shape)}{float(tensor.float().sum()):.6e}".encode())
+    return digest.hexdigest()
+
+
+def quantize_int8(model_id, module, cache_dir):
+    """Dynamic int8 (nn.Linear) copy of module, loaded from / saved to cache_dir. Returns (module, cached)."""
+    import torch
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+    path = os.path.join(cache_dir, f"{model_id.replace('/', '_')}-{fingerprint(model_id, module)}-int8.pt")
+    if os.path.exists(path):
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False), True
+        except Exception as e:
+            print(f"[CpuRuntime] Ignoring unreadable int8 cache {path}: {e}")
+    quantized = torch.ao.quantization.quantize_dynamic(module.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = path + ".tmp"
+        torch.save(quantized, partial)
+        os.replace(partial, path)
+    except Exception as e:
+        print(f"[CpuRuntime] Could not cache int8 {model_id}: {e}")
+    return quantized, False
+
+
+class _Lane:
+    """Thread pool of one CPU-mode model; its share of cores changes as models enter or leave CPU mode."""
+
+    def __init__(self, model_id, workers, pin):
+        self.model_id = model_id
+        self.cores = []
+        self.threads = 0
+        self.workers = workers
+        self.intra = 1
+        self.pin = pin
+        self.int8 = False
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"cpu-{model_id}")
+        self.stats = collections.Counter()
+        self.busy_s = 0.0
+        self.latencies = collections.deque(maxlen=256)
+        self._local = threading.local()
+
+    def resize(self, cores, threads):
+        self.cores = cores
+        self.threads = threads
+        self.intra = max(1, threads // self.workers)
+
+    def call(self, function, kwargs):
+        """On a lane thread: apply the current share (once per change), then run function."""
+        share = (self.intra, tuple(self.cores))
+        if getattr(self._local, "share", None) != share:
+            import torch
+            torch.set_num_threads(self.intra)
+            if self.pin and self.cores and hasattr(os, "sched_setaffinity"):
+                try:
+                    os.sched_setaffinity(0, self.cores)  # this thread; its OpenMP team inherits the mask
+                except OSError:
+                    pass
+            self._local.share = share
+        return function(**kwargs)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            "cores": f"{self.cores[0]}-{self.cores[-1]}" if self.cores else None,
+            "threads": self.threads,
+            "workers": self.workers,
+            "intra_op_threads": self.intra,
+            "pinned": self.pin,
+            "int8": self.int8,
+            **self.stats,
+            "images_per_s": round(self.stats["images"] / self.busy_s, 2) if self.busy_s else None,
+            "p50_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+        }
+
+
+class _LanePool:
+    """Stands in for a CPU-mode model's SimpleWorkerPool: same submit_request()
+    contract, but the backend call runs on the model's lane."""
+
+    def __init__(self, runtime, lane, inner):
+        self.runtime = runtime
+        self.lane = lane
+        self.inner = inner
+
+    def submit_request(self, function, timeout=None, **kwargs):
+        self.runtime.rebalance()
+        lane = self.lane
+        started = time.perf_counter()
+        future = lane.pool.submit(lane.call, function, kwargs)
+        try:
+            result = future.result(timeout=timeout or getattr(self.inner, "default_timeout", None))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            lane.stats["timeouts"] += 1
+            return {"error": "Request timeout", "status": "timeout"}
+        except Exception as e:
+            return {"error": str(e), "status": "error"}
+        finally:
+            elapsed = time.perf_counter() - started
+            lane.stats["calls"] += 1
+            lane.stats["images"] += CpuRuntime._count(kwargs)
+            lane.busy_s += elapsed
+            lane.latencies.append(elapsed * 1000.0)
+        return result if isinstance(result, dict) else {"result": result}
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)  # get_stats, shutdown, ...
+
+
+class CpuRuntime:
+    def __init__(self, service, config=None, manifest_manager=None):
+        self.service = service
+        self.config = config
+        self.manifest_manager = manifest_manager
+        self.lanes = {}  # model_id -> _Lane
+        self.backends = weakref.WeakKeyDictionary()  # loaded CPU-mode backend -> model_id
+        self._planned = None  # the models the current split was made for
+        self._lock = threading.Lock()
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def mode(self):
+        value = self._setting("cpu_runtime", "auto")
+        if value is True or str(value).lower() in ("true", "force", "on"):
+            return "force"
+        if value is False or str(value).lower() in ("false", "off", "0"):
+            return "off"
+        return "auto"
+
+    def matches(self, model_id):
+        patterns = self._setting("cpu_runtime_models", DEFAULT_MODELS)
+        return any(p in model_id for p in patterns)
+
+    def _cpu_models(self):
+        with self._lock:
+            return sorted(set(self.backends.values()))
+
+    def plan(self, models=None):
+        """{model_id: (cores, threads)}: the usable cores split between the loaded CPU-mode models."""
+        models = self._cpu_models() if models is None else models
+        cores = usable_cores()
+        share = max(1, len(cores) // max(1, len(models)))
+        overrides = self._setting("cpu_threads", {})
+        plan = {}
+        for index, model_id in enumerate(models):
+            start = (index * share) % len(cores)
+            plan[model_id] = (cores[start:start + share], int(overrides.get(model_id, share)))
+        return plan
+
+    def rebalance(self):
+        """Re-split the cores when a CPU-mode model was loaded or unloaded since the last split."""
+        models = self._cpu_models()
+        if models == self._planned:
+            return
+        self._planned = models
+        for model_id, (cores, threads) in self.plan(models).items():
+            lane = self.lanes.get(model_id)
+            if lane is not None:
+                lane.resize(cores, threads)
+                print(f"[CpuRuntime] {model_id}: {threads} threads on cores {lane.summary()['cores']}, {lane.workers} worker(s)")
+
+    def _lane(self, model_id):
+        with self._lock:
+            lane = self.lanes.get(model_id)
+            if lane is None:
+                workers = max(1, int(self._setting("cpu_workers", 1)))
+                lane = self.lanes[model_id] = _Lane(model_id, workers, bool(self._setting("cpu_pin_cores", False)))
+            return lane
+
+    def _wants_int8(self, model_id):
+        value = self._setting("cpu_int8", False)
+        return model_id in value if isinstance(value, (list, tuple)) else bool(value)
+
+    def prepare(self, model_id):
+        """After a load: put the model's backends in CPU mode (or leave them alone)."""
+        mode = self.mode()
+        if mode == "off" or not self.matches(model_id):
+            return
+        prepared = False
+        for backend in getattr(self.service, "worker_backends", None) or []:
+            if backend in self.backends:
+                prepared = True  # resident reattach: already in CPU mode
+                continue
+            modules = torch_modules(backend)
+            if not modules:
+                continue
+            if not all(_on_cpu(m) for _, _, m in modules):
+                if mode != "force":
+                    continue
+                _move_to_cpu(backend, modules)
+            lane = self._lane(model_id)
+            if self._wants_int8(model_id):
+                cache_dir = os.path.expanduser(self._setting("cpu_int8_dir", DEFAULT_INT8_DIR))
+                for owner, name, module in modules:
+                    started = time.perf_counter()
+                    quantized, cached = quantize_int8(model_id, module, cache_dir)
+                    setattr(owner, name, quantized)
+                    source = "cache" if cached else "quantized"
+                    print(f"[CpuRuntime] {model_id}.{name} int8 ({source}, {time.perf_counter() - started:.1f}s)")
+                lane.int8 = True
+            with self._lock:
+                self.backends[backend] = model_id
+            prepared = True
+        pool = getattr(self.service, "worker_pool", None)
+        if prepared and pool is not None and not isinstance(pool, _LanePool):
+            # Calls still go through execute_function and the pool's contract, on the lane's threads
+            self.service.worker_pool = _LanePool(self, self.lanes[model_id], pool)
+        self.rebalance()
+
+    @staticmethod
+    def _count(kwargs):
+        images = kwargs.get("images", kwargs.get("image"))
+        return len(images) if isinstance(images, (list, tuple)) else 1
+
+    def _cpu_expected(self):
+        """Some manifest model will run in CPU mode: forced, or auto without CUDA."""
+        models = self.manifest_manager.get_models() if self.manifest_manager else {}
+        if self.mode() == "off" or not any(self.matches(m) for m in models):
+            return False
+        if self.mode() == "force":
+            return True
+        import torch
+        return not torch.cuda.is_available()
+
+    def attach(self):
+        if getattr(self.service, "_cpu_runtime_installed", False):
+            return
+        self.service._cpu_runtime_installed = True
+        if self._cpu_expected():
+            import torch
+            try:
+                torch.set_num_interop_threads(int(self._setting("cpu_interop_threads", 1)))
+            except RuntimeError:
+                pass  # already set, or inter-op work already started
+        original_start = self.service.start
+
+        @functools.wraps(original_start)
+        def start(model_id, *args, **kwargs):
+            ok = original_start(model_id, *args, **kwargs)
+            if ok:
+                try:
+                    self.prepare(model_id)
+                except Exception as e:
+                    print(f"[CpuRuntime] Leaving {model_id} on the default path: {e}")
+            return ok
+
+        self.service.start = start
+
+    def summary(self):
+        return {
+            "mode": self.mode(),
+            "cores": len(usable_cores()),
+            "plan": {model_id: {"cores": len(cores), "threads": threads} for model_id, (cores, threads) in self.plan().items()},
+            "models": {model_id: lane.summary() for model_id, lane in self.lanes.items()},
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .batch_contract import install_batch_contract, model_capabilities, VISION_FUNCTIONS',
+        'from .batch_contract import install_batch_contract, model_capabilities, VISION_FUNCTIONS\n'
+        'from .cpu_runtime import CpuRuntime',
+    ),
+    (
+        "install",
+        '''        # Batch contract: image=[...] works on every backend (native, or a per-image loop)''',
+        '''        # CPU mode for the small classifiers: their worker pool runs on a per-model thread pool
+        self.cpu_runtime = CpuRuntime(self.inference_service, self.config, self.manifest_manager)
+        self.cpu_runtime.attach()
+        metrics_sampler.register_provider("cpu_runtime", self.cpu_runtime.summary)
+        # Batch contract: image=[...] works on every backend (native, or a per-image loop)''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "cpu_runtime.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(CPU_MODULE)
+
+    if "from .cpu_runtime import" in content:
+        print("✅ Already patched - CPU runtime found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_batch_contract.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_cpu_runtime'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: cpu_runtime (auto / true / false), cpu_runtime_models, cpu_threads,")
+    print("      cpu_workers, cpu_interop_threads, cpu_pin_cores, cpu_int8, cpu_int8_dir")
+    print("   2. Restart moondream-station server")
+    print("   3. python3 scripts/benchmark_cpu_runtime.py --int8")
+    print("   4. curl http://localhost:2020/v1/metrics | jq .cpu_runtime")
+
+    return True
+
+if __name__ == "__main__":
+    print("🧮 Moondream Station - CPU Runtime for Small Classifiers")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Patch to decode batch images on a worker pool, at model input size.
+
+/v1/vision/batch-caption decodes base64 and runs
+Image.open(...).convert("RGB") serially on the event loop before inference,
+always at full resolution. A 4000x3000 photo becomes a 36 MB RGB buffer that
+the NSFW model (384px) or WD14 (448px) immediately shrinks again - the
+50-100 MB per batch in docs/MEMORY_LEAK_ANALYSIS.md.
+
+This patch installs moondream_station/core/decode_pool.py:
+1. Decoding runs on a thread pool ("decode_workers", default min(4, CPUs));
+   PIL releases the GIL while decoding, so images decode in parallel and the
+   event loop stays free
+2. Size-aware decode, keeping the short side >= the model's input size:
+   JPEG uses Image.draft() (libjpeg scales by 1/2, 1/4, 1/8 inside the
+   IDCT), PNG and other formats use Image.reduce() by an integer factor
+   right after load. Target sizes: config "decode_target_sizes"
+   ({model_id: px}, 0 = full size), then manifest "input_size", then 384
+   for NSFW and 448 for WD14 models. Other models (moondream detect / point)
+   keep full resolution
+3. /v1/vision/batch-caption uses the pool (routers/vision.py), and the
+   streaming endpoint (patch_batch_stream.py) decodes the next sub-batch
+   while the current one runs inference
+4. /metrics "decode": images, failures, images/s, per-image p50/p95, input
+   bytes, and RGB bytes saved versus a full-size decode
+
+Requires: patch_batch_stream.py
+
+Usage:
+    python3 patch_decode_pool.py
+"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_batch_stream import STREAM_MODULE  # noqa: E402
+
+DECODE_MODULE = '''"""
+Image decode stage for the batch endpoints: worker pool + size-aware decode.
+"""
+
+import asyncio
+import base64
+import collections
+import hashlib
+import io
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_TARGET_SIZES = {"nsfw": 384, "wd14": 448, "tagger": 448}  # substring of the model id -> input size
+REDUCE_MODES = {"L", "LA", "RGB", "RGBA", "CMYK", "YCbCr"}  # others (P, 1, I;16, ...) go to RGB first
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def b64_bytes(b64_str):
+    """Raw bytes of a base64 / data-URI string; bytes from a binary upload pass through."""
+    if isinstance(b64_str, (bytes, bytearray, memoryview)):
+        return b64_str
+    if b64_str.startswith("data:image"):
+        _, b64_str = b64_str.split(",", 1)
+    return base64.b64decode(b64_str)
+
+
+def decode_bytes(raw, target=None):
+    """(RGB image, full (w, h)) - short side kept >= target when target is set."""
+    from PIL import Image
+    image = Image.open(io.BytesIO(raw))
+    full_size = image.size
+    if target and min(full_size) > target:
+        if image.format == "JPEG":
+            scale = target / float(min(full_size))
+            image.draft("RGB", (math.ceil(full_size[0] * scale), math.ceil(full_size[1] * scale)))
+        factor = min(image.size) // target
+        if factor >= 2:
+            if image.mode not in REDUCE_MODES:
+                converted = image.convert("RGB")
+                image.close()
+                image = converted
+            reduced = image.reduce(factor)
+            image.close()
+            image = reduced
+    rgb = image.convert("RGB")
+    if rgb is not image:
+        image.close()
+    return rgb, full_size
+
+
+class DecodePool:
+    def __init__(self):
+        self.config = None
+        self.manifest_manager = None
+        self.stats = {"images": 0, "failures": 0, "bytes_in": 0, "full_pixels": 0, "decoded_pixels": 0, "calls": 0}
+        self.decode_ms = collections.deque(maxlen=1000)
+        self._wall_seconds = 0.0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def configure(self, config, manifest_manager=None):
+        self.config = config
+        self.manifest_manager = manifest_manager
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    workers = int(self._setting("decode_workers", DEFAULT_WORKERS))
+                    self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="decode")
+        return self._executor
+
+    def target_size(self, model_id):
+        """Decode size for a model; None means full resolution."""
+        if not model_id:
+            return None
+        configured = self._setting("decode_target_sizes", {})
+        if model_id in configured:
+            return int(configured[model_id]) or None
+        info = self.manifest_manager.get_models().get(model_id) if self.manifest_manager else None
+        size = info.get("input_size") if isinstance(info, dict) else getattr(info, "input_size", None)
+        if size:
+            return int(size)
+        for key, default in DEFAULT_TARGET_SIZES.items():
+            if key in model_id.lower():
+                return default
+        return None
+
+    def _decode_one(self, b64_str, target):
+        started = time.perf_counter()
+        try:
+            raw = b64_bytes(b64_str)
+            image, full_size = decode_bytes(raw, target)
+            image.info["content_hash"] = hashlib.blake2b(raw, digest_size=16).hexdigest()  # result cache key
+        except Exception:
+            with self._lock:
+                self.stats["failures"] += 1
+            raise
+        with self._lock:
+            self.stats["images"] += 1
+            self.stats["bytes_in"] += len(raw)
+            self.stats["full_pixels"] += full_size[0] * full_size[1]
+            self.stats["decoded_pixels"] += image.size[0] * image.size[1]
+            self.decode_ms.append((time.perf_counter() - started) * 1000.0)
+        return image
+
+    async def decode_many(self, b64_list, model_id=None, return_exceptions=False):
+        """Decode in parallel; list order is kept. Without return_exceptions the first failure is raised."""
+        loop = asyncio.get_running_loop()
+        target = self.target_size(model_id)
+        started = time.perf_counter()
+        futures = [loop.run_in_executor(self._pool(), self._decode_one, b64_str, target) for b64_str in b64_list]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        with self._lock:
+            self.stats["calls"] += 1
+            self._wall_seconds += time.perf_counter() - started
+        if not return_exceptions:
+            failure = next((r for r in results if isinstance(r, BaseException)), None)
+            if failure is not None:
+                for result in results:
+                    if not isinstance(result, BaseException):
+                        result.close()
+                raise failure
+        return results
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            times = list(self.decode_ms)
+            wall = self._wall_seconds
+        saved = (stats["full_pixels"] - stats["decoded_pixels"]) * 3
+        return {
+            **stats,
+            "workers": self._executor._max_workers if self._executor else int(self._setting("decode_workers", DEFAULT_WORKERS)),
+            "images_per_s": round(stats["images"] / wall, 1) if wall else None,
+            "decode_p50_ms": round(_percentile(times, 50), 2) if times else None,
+            "decode_p95_ms": round(_percentile(times, 95), 2) if times else None,
+            "rgb_bytes_saved": saved,
+            "rgb_saved_mb": round(saved / 1024 ** 2, 1),
+            "pixel_ratio": round(stats["decoded_pixels"] / stats["full_pixels"], 3) if stats["full_pixels"] else None,
+        }
+
+
+decode_pool = DecodePool()
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .batch_stream import batch_items, stream_batch',
+        'from .batch_stream import batch_items, stream_batch\n'
+        'from .decode_pool import decode_pool',
+    ),
+    (
+        "configure",
+        '''        # Batch contract: image=[...] works on every backend (native, or a per-image loop)''',
+        '''        decode_pool.configure(self.config, self.manifest_manager)
+        metrics_sampler.register_provider("decode", decode_pool.summary)
+        # Batch contract: image=[...] works on every backend (native, or a per-image loop)''',
+    ),
+    (
+        "stream decoder",
+        '''stream_batch(self.inference_service, function_name, items, sub_batch, kwargs, sse)''',
+        '''stream_batch(
+                        self.inference_service, function_name, items, sub_batch, kwargs, sse,
+                        decode=lambda b64_list: decode_pool.decode_many(b64_list, model_id, return_exceptions=True),
+                    )''',
+    ),
+]
+
+# routers/vision.py batch-caption: the serial decode loop, with or without the data-URI branch
+VISION_DECODE_RE = re.compile(
+    r'^([ \t]*)pil_images = \[\]\n[ \t]*for b64_str in images_b64:\n.*?^[ \t]*pil_images\.append\(img\)\n',
+    re.MULTILINE | re.DOTALL,
+)
+
+IMPORT_LINE_RE = re.compile(r'^(?:from \S+ import [^\n(]+|import [^\n]+)\n', re.MULTILINE)
+
+VISION_DECODE_POOL = (
+    '\\1# Parallel, size-aware decode (decode_pool.py)\n'
+    '\\1pil_images = await decode_pool.decode_many(images_b64, model_id)\n'
+)
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    vision_path = os.path.join(core_dir, "routers/vision.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("decode_pool.py", DECODE_MODULE), ("batch_stream.py", STREAM_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .decode_pool import" in content:
+        print("✅ Already patched - decode pool found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_batch_stream.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if os.path.exists(vision_path):
+        with open(vision_path, 'r') as f:
+            vision = f.read()
+        vision, count = VISION_DECODE_RE.subn(VISION_DECODE_POOL, vision, count=1)
+        if count:
+            routes_at = vision.find("\n@router")
+            header = list(IMPORT_LINE_RE.finditer(vision, 0, routes_at if routes_at != -1 else len(vision)))
+            at = header[-1].end() if header else 0
+            vision = vision[:at] + "from ..decode_pool import decode_pool\n" + vision[at:]
+            with open(vision_path + '.backup_decode_pool', 'w') as f, open(vision_path, 'r') as orig:
+                f.write(orig.read())
+            with open(vision_path, 'w') as f:
+                f.write(vision)
+            print("✓ /v1/vision/batch-caption decodes on the pool")
+        else:
+            print("⚠️  Could not find the batch-caption decode loop - only the streaming endpoint uses the pool")
+    else:
+        print(f"⚠️  {vision_path} not found - only the streaming endpoint uses the pool")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_decode_pool'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: decode_workers, decode_target_sizes")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/metrics | jq .decode")
+
+    return True
+
+if __name__ == "__main__":
+    print("🖼️  Moondream Station - Parallel Image Decode")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Patch to cache vision-encoder output so follow-up prompts on one image
+only pay for the text decoder.
+
+The UI asks several things about one image through separate
+/v1/chat/completions calls - caption, tags, a query, smart-crop. Moondream
+and JoyCaption run the vision encoder again for every one of them, and for
+short answers the encoder dominates latency. The result cache
+(patch_result_cache.py) cannot help: each prompt is a different key.
+
+This patch installs moondream_station/core/embedding_cache.py:
+1. The encoder entry point of every loaded backend model is memoised:
+   - encode_image(image, ...) - moondream2 (caption / query / detect / point
+     all call it); keyed by the image content hash from result_cache.py
+   - get_image_features(pixel_values, ...) - LLaVA models (JoyCaption);
+     keyed by a hash of the pixel tensor
+2. The cache lives on the model object, so entries are scoped to that model
+   and are freed (VRAM included) when the model is unloaded
+3. LRU eviction by size: "embedding_cache_mb" per model (default 256,
+   counted from the cached tensors; 0 disables)
+4. Every response gets X-Encoder-Time (ms spent encoding) and
+   X-Encoder-Saved (ms of encoding skipped thanks to the cache, measured
+   when the entry was created); the frontend records both in its
+   performance metrics. /metrics "embedding_cache": hits, misses, bytes,
+   evictions and total encoder time saved
+
+Attribution per response is exact for the usual one-inference-at-a-time
+case; with concurrent inference on one model it is approximate.
+
+Requires: patch_result_cache.py
+
+Usage:
+    python3 patch_embedding_cache.py
+"""
+
+import os
+import sys
+
+EMBEDDING_MODULE = '''"""
+Memoised vision encoders, one LRU per model object.
+"""
+
+import collections
+import contextvars
+import functools
+import hashlib
+import threading
+import time
+import types
+import weakref
+
+from .result_cache import image_hash
+
+DEFAULT_MB = 256
+ENCODERS = ("encode_image", "get_image_features")
+_SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, str, bytes, int, float)
+
+_request = contextvars.ContextVar("embedding_cache_request", default=None)
+
+
+def _walk_tensors(value, depth=0):
+    if depth > 4 or value is None:
+        return
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _walk_tensors(item, depth + 1)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _walk_tensors(item, depth + 1)
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        for item in vars(value).values():
+            yield from _walk_tensors(item, depth + 1)
+
+
+def nbytes(value):
+    return sum(t.element_size() * t.nelement() for t in _walk_tensors(value))
+
+
+def _synchronize(value):
+    """Wait for async CUDA work so the encode time is real."""
+    for tensor in _walk_tensors(value):
+        if getattr(tensor, "is_cuda", False):
+            import torch
+            torch.cuda.synchronize(tensor.device)
+            return
+
+
+def _tensor_hash(tensor):
+    data = tensor.detach().float().cpu().contiguous().numpy().tobytes()
+    return hashlib.blake2b(data, digest_size=16).hexdigest() + str(tuple(tensor.shape))
+
+
+def _key(encoder, args, kwargs):
+    first = args[0] if args else kwargs.get("image", kwargs.get("pixel_values"))
+    if first is None:
+        return None
+    if hasattr(first, "element_size"):
+        content = _tensor_hash(first)
+    elif hasattr(first, "tobytes") and hasattr(first, "size"):
+        content = image_hash(first)
+    else:
+        return None  # already encoded (e.g. EncodedImage passed back in)
+    rest = repr(args[1:]) + repr(sorted((k, repr(v)) for k, v in kwargs.items() if k not in ("image", "pixel_values")))
+    return f"{encoder}|{content}|{rest}"
+
+
+def open_request():
+    state = {"encode_ms": 0.0, "saved_ms": 0.0}
+    return _request.set(state), state
+
+
+def close_request(token):
+    _request.reset(token)
+
+
+class _ModelCache:
+    def __init__(self, owner, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> (value, nbytes, encode_ms)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.name = type(owner).__name__
+
+
+class EmbeddingCache:
+    def __init__(self, service, config=None):
+        self.service = service
+        self.config = config
+        self.caches = weakref.WeakKeyDictionary()  # model object -> _ModelCache
+        self.stats = collections.Counter()
+        self.encode_ms = 0.0
+        self.saved_ms = 0.0
+        self._lock = threading.Lock()
+
+    def _max_bytes(self):
+        value = self.config.get("embedding_cache_mb") if self.config else None
+        return int(float(DEFAULT_MB if value is None else value) * 1024 * 1024)
+
+    def _candidates(self):
+        for backend in getattr(self.service, "worker_backends", None) or []:
+            objects = [backend]
+            if hasattr(backend, "__dict__"):
+                objects += [v for v in vars(backend).values() if not isinstance(v, _SKIP)]
+            for obj in objects:
+                yield obj
+                inner = getattr(obj, "model", None)
+                if inner is not None and not isinstance(inner, type):
+                    yield inner
+
+    def instrument(self):
+        """Wrap the encoder of every model object of the loaded backends (once per object)."""
+        if self._max_bytes() <= 0:
+            return
+        for obj in self._candidates():
+            for encoder in ENCODERS:
+                method = getattr(obj, encoder, None)
+                if not callable(method) or getattr(method, "_embedding_cached", False):
+                    continue
+                try:
+                    cache = self.caches.get(obj)
+                    if cache is None:
+                        cache = self.caches[obj] = _ModelCache(obj, self._max_bytes())
+                    wrapped = self._wrap(method, encoder, cache)
+                    setattr(obj, encoder, wrapped)
+                    print(f"[EmbeddingCache] Caching {cache.name}.{encoder}")
+                except (TypeError, AttributeError):
+                    continue  # not weak-referenceable or read-only attribute
+
+    def _wrap(self, method, encoder, cache):
+        @functools.wraps(method)
+        def cached(*args, **kwargs):
+            try:
+                key = _key(encoder, args, kwargs)
+            except Exception:
+                key = None
+            if key is None:
+                return method(*args, **kwargs)
+            with cache.lock:
+                entry = cache.entries.get(key)
+                if entry is not None:
+                    cache.entries.move_to_end(key)
+            if entry is not None:
+                with self._lock:
+                    self.stats["hits"] += 1
+                    self.saved_ms += entry[2]
+                return entry[0]
+
+            started = time.perf_counter()
+            value = method(*args, **kwargs)
+            _synchronize(value)
+            encode_ms = (time.perf_counter() - started) * 1000.0
+            size = nbytes(value)
+            with self._lock:
+                self.stats["misses"] += 1
+                self.encode_ms += encode_ms
+            if size > cache.max_bytes:
+                return value
+            with cache.lock:
+                cache.entries[key] = (value, size, encode_ms)
+                cache.bytes += size
+                while cache.bytes > cache.max_bytes:
+                    _, (_, old_size, _) = cache.entries.popitem(last=False)
+                    cache.bytes -= old_size
+                    self.stats["evictions"] += 1
+            return value
+
+        cached._embedding_cached = True
+        return cached
+
+    def attach(self):
+        if getattr(self.service, "_embedding_cache_installed", False):
+            return
+        self.service._embedding_cache_installed = True
+        original = self.service.execute_function
+
+        @functools.wraps(original)
+        async def execute_function(function_name, *args, **kwargs):
+            self.instrument()
+            encode_before, saved_before = self.encode_ms, self.saved_ms
+            try:
+                return await original(function_name, *args, **kwargs)
+            finally:
+                state = _request.get()
+                if state is not None:
+                    state["encode_ms"] += self.encode_ms - encode_before
+                    state["saved_ms"] += self.saved_ms - saved_before
+
+        self.service.execute_function = execute_function
+
+    def summary(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        models = {}
+        for cache in list(self.caches.values()):
+            models[cache.name] = {"entries": len(cache.entries), "mb": round(cache.bytes / 1024 ** 2, 1)}
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None,
+            "encode_ms": round(self.encode_ms, 1),
+            "saved_ms": round(self.saved_ms, 1),
+            "max_mb_per_model": round(self._max_bytes() / 1024 ** 2, 1),
+            "models": models,
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .result_cache import ResultCache, close_request, open_request, outcome',
+        'from .result_cache import ResultCache, close_request, open_request, outcome\n'
+        'from .embedding_cache import EmbeddingCache, close_request as close_encoder_request, '
+        'open_request as open_encoder_request',
+    ),
+    (
+        "attach",
+        '''        # Outside the batcher: cache hits never wait for a batch window''',
+        '''        self.embedding_cache = EmbeddingCache(self.inference_service, self.config)
+        self.embedding_cache.attach()
+        metrics_sampler.register_provider("embedding_cache", self.embedding_cache.summary)
+
+        @self.app.middleware("http")
+        async def encoder_timing(request: Request, call_next):
+            """X-Encoder-Time / X-Encoder-Saved (ms) for this request"""
+            token, state = open_encoder_request()
+            try:
+                response = await call_next(request)
+            finally:
+                close_encoder_request(token)
+            if state["encode_ms"] or state["saved_ms"]:
+                response.headers["X-Encoder-Time"] = f"{state['encode_ms']:.1f}"
+                response.headers["X-Encoder-Saved"] = f"{state['saved_ms']:.1f}"
+            return response
+
+        # Outside the batcher: cache hits never wait for a batch window''',
+    ),
+]
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "embedding_cache.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(EMBEDDING_MODULE)
+
+    if "from .embedding_cache import" in content:
+        print("✅ Already patched - embedding cache found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_result_cache.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_embedding_cache'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: embedding_cache_mb (per model, 0 disables)")
+    print("   2. Restart moondream-station server")
+    print("   3. Ask two questions about one image, compare X-Encoder-Time / X-Encoder-Saved")
+    print("   4. curl http://localhost:2020/v1/metrics | jq .embedding_cache")
+
+    return True
+
+if __name__ == "__main__":
+    print("🧠 Moondream Station - Vision Embedding Cache")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
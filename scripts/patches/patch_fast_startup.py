@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Patch to start the backend faster: lazy backend imports, parallel warm-up,
+and startup phase timings.
+
+rest_server.py imports the SDXL backend at module load, which pulls in
+diffusers / transformers / accelerate before a single route exists, and the
+Docker healthcheck has to allow a 60s start period for it. Nothing told us
+where those seconds went.
+
+This patch installs moondream_station/core/startup_profile.py:
+1. lazy_attr() - the SDXL backend class becomes a proxy that imports
+   sdxl_backend.backend (and diffusers) on first use. A missing backend is
+   still detected at startup (importlib.util.find_spec, no import)
+2. Startup marks measured from process creation: rest_server_imported,
+   routes_ready, serving, warmup_done - plus every lazy import with the time
+   it took and when it happened
+3. Optional parallel warm-up once the server is serving: config
+   "warmup_models" (list or comma string, env MOONDREAM_WARMUP_MODELS
+   overrides), default none. Backend modules of all listed models are
+   imported on a thread pool ("warmup_workers", default 3) while the models
+   are loaded one after another through the switch coordinator (one model
+   is active in InferenceService at a time; the residency manager keeps the
+   earlier ones loaded). Light endpoints keep answering throughout
+4. GET /v1/system/startup
+
+torch itself is still imported by rest_server.py (the memory tracker and
+allocator probes use it from the first request).
+
+Requires: patch_model_lifecycle.py
+
+Usage:
+    python3 patch_fast_startup.py
+"""
+
+import os
+import re
+import sys
+
+STARTUP_MODULE = '''"""
+Startup timing, lazy backend imports and background warm-up.
+
+Times are seconds since the process was created (psutil), so they include
+interpreter start and everything imported before rest_server.py.
+"""
+
+import asyncio
+import importlib
+import importlib.util
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+DEFAULT_WARMUP_WORKERS = 3
+
+
+class StartupProfile:
+    def __init__(self):
+        try:
+            self.process_started_at = psutil.Process().create_time()
+        except Exception:
+            self.process_started_at = time.time()
+        self.marks = []  # {"name", "at_s", "seconds"} - seconds since the previous mark
+        self.lazy_imports = {}  # "module:attr" -> {"resolved", "import_seconds", "first_use_at_s"}
+        self.warmup = {"state": "disabled", "models": {}}
+        self._lock = threading.Lock()
+
+    def since_start(self, now=None):
+        return round((now or time.time()) - self.process_started_at, 3)
+
+    def mark(self, name):
+        with self._lock:
+            at_s = self.since_start()
+            previous = self.marks[-1]["at_s"] if self.marks else 0.0
+            self.marks.append({"name": name, "at_s": at_s, "seconds": round(at_s - previous, 3)})
+        print(f"[Startup] {name} at {at_s:.2f}s")
+
+    def reached(self, name):
+        return any(m["name"] == name for m in self.marks)
+
+    def status(self):
+        marks = {m["name"]: m["at_s"] for m in self.marks}
+        return {
+            "process_started_at": self.process_started_at,
+            "uptime_s": self.since_start(),
+            "marks": list(self.marks),
+            "serving_after_s": marks.get("serving"),
+            "ready_after_s": marks.get("warmup_done", marks.get("serving") if self.warmup["state"] == "disabled" else None),
+            "lazy_imports": {k: dict(v) for k, v in self.lazy_imports.items()},
+            "warmup": {"state": self.warmup["state"], "models": {k: dict(v) for k, v in self.warmup["models"].items()}},
+        }
+
+
+startup_profile = StartupProfile()
+
+
+class _LazyAttr:
+    """Stands in for module.attr until first call / attribute access, then imports it."""
+
+    def __init__(self, module_name, attr, profile):
+        self._module_name = module_name
+        self._attr = attr
+        self._profile = profile
+        self._target = None
+        self._lock = threading.Lock()
+        profile.lazy_imports[f"{module_name}:{attr}"] = {"resolved": False}
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    started = time.perf_counter()
+                    target = getattr(importlib.import_module(self._module_name), self._attr)
+                    self._profile.lazy_imports[f"{self._module_name}:{self._attr}"] = {
+                        "resolved": True,
+                        "import_seconds": round(time.perf_counter() - started, 3),
+                        "first_use_at_s": self._profile.since_start(),
+                    }
+                    print(f"[Startup] Lazy import of {self._module_name} took {time.perf_counter() - started:.2f}s")
+                    self._target = target
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+def lazy_attr(module_name, attr, profile=None):
+    """Deferred `from module_name import attr`. Raises ImportError now if the top-level package is missing."""
+    if importlib.util.find_spec(module_name.split(".")[0]) is None:
+        raise ImportError(f"No module named {module_name.split('.')[0]!r}")
+    return _LazyAttr(module_name, attr, profile or startup_profile)
+
+
+def _manifest_value(info, key):
+    if isinstance(info, dict):
+        return info.get(key)
+    return getattr(info, key, None)
+
+
+class ParallelWarmup:
+    def __init__(self, coordinator, manifest_manager, config, profile=None):
+        self.coordinator = coordinator
+        self.manifest_manager = manifest_manager
+        self.config = config
+        self.profile = profile or startup_profile
+        self._task = None
+
+    def models(self):
+        value = os.environ.get("MOONDREAM_WARMUP_MODELS") or (self.config.get("warmup_models") if self.config else None)
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = [m.strip() for m in value.split(",")]
+        return [m for m in value if m]
+
+    def _import_backend(self, model_id):
+        """Import the model's backend module (the expensive part of a cold start() besides weights)."""
+        info = self.manifest_manager.get_models().get(model_id)
+        backend = _manifest_value(info, "backend") if info is not None else None
+        if not backend:
+            return None
+        started = time.perf_counter()
+        for name in (f"{backend}.backend", backend):
+            try:
+                importlib.import_module(name)
+                return round(time.perf_counter() - started, 3)
+            except ImportError:
+                continue
+        return None
+
+    async def run(self):
+        known = self.manifest_manager.get_models()
+        models = [m for m in self.models() if m in known]
+        for missing in set(self.models()) - set(models):
+            print(f"[Startup] Warm-up model {missing} is not in the manifest, skipping")
+        if not models:
+            return
+        states = self.profile.warmup["models"]
+        self.profile.warmup["state"] = "running"
+        for model_id in models:
+            states[model_id] = {"state": "pending"}
+
+        loop = asyncio.get_running_loop()
+        workers = int(self.config.get("warmup_workers") or DEFAULT_WARMUP_WORKERS) if self.config else DEFAULT_WARMUP_WORKERS
+        pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(models))), thread_name_prefix="warmup")
+        try:
+            imports = {m: loop.run_in_executor(pool, self._import_backend, m) for m in models}
+            # Loads are serial (one active model); imports for later models overlap earlier loads
+            for model_id in models:
+                state = states[model_id]
+                try:
+                    state["import_seconds"] = await imports[model_id]
+                except Exception as e:
+                    state["import_error"] = str(e)
+                state["state"] = "loading"
+                started = time.perf_counter()
+                try:
+                    await self.coordinator.acquire(model_id, hold=False)
+                    state["state"] = "ready"
+                except Exception as e:
+                    state["state"] = "failed"
+                    state["error"] = str(e)
+                    print(f"[Startup] Warm-up load of {model_id} failed: {e}")
+                state["load_seconds"] = round(time.perf_counter() - started, 3)
+                state["ready_at_s"] = self.profile.since_start()
+        finally:
+            pool.shutdown(wait=False)
+        self.profile.warmup["state"] = "done"
+        self.profile.mark("warmup_done")
+
+    def start(self):
+        if self._task is None:
+            if not self.models():
+                self.profile.mark("warmup_done")
+                return
+            self.profile.warmup["state"] = "pending"
+            self._task = asyncio.get_running_loop().create_task(self.run())
+'''
+
+SDXL_IMPORT_RE = re.compile(r'^([ \t]*)from sdxl_backend\.backend import SDXLBackend[^\n]*\n', re.MULTILINE)
+
+SDXL_IMPORT_LAZY = (
+    '\\1# Lazy: diffusers is imported on the first SDXL call, not at server start\n'
+    '\\1from .startup_profile import lazy_attr\n'
+    '\\1SDXLBackend = lazy_attr("sdxl_backend.backend", "SDXLBackend")\n'
+)
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .model_lifecycle import IdleReaper, WarmupPredictor',
+        'from .model_lifecycle import IdleReaper, WarmupPredictor\n'
+        'from .startup_profile import ParallelWarmup, startup_profile',
+    ),
+    (
+        "imported mark",
+        '''metrics_sampler.register_provider("mmap_loader", mmap_loader_stats)''',
+        '''metrics_sampler.register_provider("mmap_loader", mmap_loader_stats)
+
+startup_profile.mark("rest_server_imported")''',
+    ),
+    (
+        "serving mark",
+        '''        @self.app.on_event("startup")
+        async def start_idle_reaper():
+            self.idle_reaper.start()''',
+        '''        self.startup_warmup = ParallelWarmup(self.switch_coordinator, self.manifest_manager, self.config)
+
+        @self.app.on_event("startup")
+        async def start_idle_reaper():
+            self.idle_reaper.start()
+
+        @self.app.on_event("startup")
+        async def start_warmup():
+            startup_profile.mark("serving")
+            self.startup_warmup.start()''',
+    ),
+]
+
+ROUTES_READY_RE = re.compile(r'^([ \t]*)self\._setup_routes\(\)\n', re.MULTILINE)
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+STARTUP_ENDPOINT = '''@self.app.get("/v1/system/startup")
+        async def system_startup():
+            """Startup marks since process creation, lazy imports, warm-up progress"""
+            return startup_profile.status()
+
+        '''
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "startup_profile.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(STARTUP_MODULE)
+
+    if "from .startup_profile import ParallelWarmup" in content:
+        print("✅ Already patched - startup profile found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_model_lifecycle.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    content, count = SDXL_IMPORT_RE.subn(SDXL_IMPORT_LAZY, content, count=1)
+    if count:
+        print("✓ SDXL backend is imported on first use")
+    else:
+        print("⚠️  Could not find 'from sdxl_backend.backend import SDXLBackend' - SDXL stays an eager import")
+
+    content, count = ROUTES_READY_RE.subn('\\1self._setup_routes()\n\\1startup_profile.mark("routes_ready")\n', content, count=1)
+    if count:
+        print("✓ Patched routes_ready mark")
+    else:
+        print("⚠️  Could not find self._setup_routes() call - routes_ready mark not added")
+
+    if ROUTER_ANCHOR in content:
+        content = content.replace(ROUTER_ANCHOR, STARTUP_ENDPOINT + ROUTER_ANCHOR, 1)
+        print("✓ Added GET /v1/system/startup")
+    else:
+        print("⚠️  Could not find router setup hook - startup endpoint not added")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_fast_startup'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional: config warmup_models, e.g. [\"moondream-2\", \"nsfw-detector\"]")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/system/startup")
+
+    return True
+
+if __name__ == "__main__":
+    print("🚀 Moondream Station - Fast Startup")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
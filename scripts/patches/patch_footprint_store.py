@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Patch to persist model footprints and load times across restarts.
+
+last_known_vram in ModelMemoryTracker only lived in memory, and the ghost
+detector fell back to a hand-written EXPECTED_VRAM table (2500MB default) for
+anything it had not seen since the last restart.
+
+This patch:
+1. Installs moondream_station/core/footprint_store.py - a small SQLite store
+   at ~/.moondream-station/footprints.db keeping a rolling history of load
+   time, VRAM, RAM and first-inference latency per model, with p50/p95
+2. Records every measured load (patch_vram_attribution.py) and first inference
+3. Makes tracker.expected_vram_mb() and get_last_known_vram() fall back to the
+   stored history, so /v1/models, ghost detection and schedulers use real
+   sizes straight after a restart
+4. Adds "load_stats" to each /v1/models entry
+
+Requires: patch_vram_attribution.py
+
+Usage:
+    python3 patch_footprint_store.py
+"""
+
+import os
+import sys
+
+STORE_MODULE = '''"""
+On-disk model footprint and load-time history (SQLite).
+
+Rows are trimmed to the newest HISTORY_PER_MODEL per model so percentiles
+follow the current weights/driver rather than every load ever made.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_DB_PATH = os.path.expanduser("~/.moondream-station/footprints.db")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)."""
+    data = sorted(v for v in values if v is not None)
+    if not data:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(data)))
+    return data[min(rank, len(data)) - 1]
+
+
+class FootprintStore:
+    HISTORY_PER_MODEL = 50
+    METRICS = ("load_seconds", "vram_mb", "ram_mb", "first_inference_ms")
+
+    def __init__(self, path=None, history=None):
+        self.path = path or os.environ.get("MOONDREAM_FOOTPRINT_DB", DEFAULT_DB_PATH)
+        self.history = int(history or self.HISTORY_PER_MODEL)
+        self._lock = threading.Lock()
+        self._stats_cache = {}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS model_loads ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " model_id TEXT NOT NULL,"
+            " recorded_at REAL NOT NULL,"
+            " load_seconds REAL,"
+            " vram_mb REAL,"
+            " ram_mb REAL,"
+            " first_inference_ms REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_model_loads_model ON model_loads (model_id, id)")
+        self._db.commit()
+
+    def record_load(self, model_id, load_seconds, vram_mb, ram_mb):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO model_loads (model_id, recorded_at, load_seconds, vram_mb, ram_mb) VALUES (?, ?, ?, ?, ?)",
+                (model_id, time.time(), load_seconds, vram_mb, ram_mb),
+            )
+            self._db.execute(
+                "DELETE FROM model_loads WHERE model_id = ? AND id NOT IN "
+                "(SELECT id FROM model_loads WHERE model_id = ? ORDER BY id DESC LIMIT ?)",
+                (model_id, model_id, self.history),
+            )
+            self._db.commit()
+            self._stats_cache.pop(model_id, None)
+
+    def record_first_inference(self, model_id, latency_ms):
+        """Attach first-inference latency to the newest load of model_id."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE model_loads SET first_inference_ms = ? WHERE id = "
+                "(SELECT id FROM model_loads WHERE model_id = ? ORDER BY id DESC LIMIT 1)",
+                (latency_ms, model_id),
+            )
+            self._db.commit()
+            self._stats_cache.pop(model_id, None)
+
+    def stats(self, model_id):
+        """{samples, last, <metric>: {p50, p95}} for one model, or None if never loaded."""
+        cached = self._stats_cache.get(model_id)
+        if cached is not None:
+            return cached
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT recorded_at, load_seconds, vram_mb, ram_mb, first_inference_ms "
+                "FROM model_loads WHERE model_id = ? ORDER BY id DESC",
+                (model_id,),
+            ).fetchall()
+        if not rows:
+            return None
+        result = {
+            "samples": len(rows),
+            "last": dict(zip(("recorded_at",) + self.METRICS, rows[0])),
+        }
+        for index, metric in enumerate(self.METRICS, start=1):
+            values = [row[index] for row in rows]
+            result[metric] = {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+        self._stats_cache[model_id] = result
+        return result
+
+    def all_stats(self):
+        with self._lock:
+            model_ids = [row[0] for row in self._db.execute("SELECT DISTINCT model_id FROM model_loads")]
+        return {model_id: self.stats(model_id) for model_id in model_ids}
+
+    def last_vram_mb(self, model_id):
+        stats = self.stats(model_id)
+        return stats["last"]["vram_mb"] if stats else None
+
+    def expected_vram_mb(self, model_id):
+        """p95 VRAM - conservative enough for admission and ghost detection."""
+        stats = self.stats(model_id)
+        return stats["vram_mb"]["p95"] if stats else None
+
+    def expected_load_seconds(self, model_id):
+        stats = self.stats(model_id)
+        return stats["load_seconds"]["p50"] if stats else None
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service',
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service\n'
+        'from .footprint_store import FootprintStore',
+    ),
+    (
+        "__init__",
+        '''    def __init__(self):
+        self.loaded_models = {}  # model_id -> {name, vram_mb, ram_mb, loaded_at, footprint}''',
+        '''    def __init__(self, store=None):
+        self.store = store  # FootprintStore - survives restarts
+        self.loaded_models = {}  # model_id -> {name, vram_mb, ram_mb, loaded_at, footprint}''',
+    ),
+    (
+        "record_footprint",
+        '''        self.footprints[model_id] = footprint
+        print(f"[VRAM] {model_id}: weights={footprint.weights_bytes / 1048576:.0f}MB, "
+              f"cache/reserved={footprint.cache_reserved_bytes / 1048576:.0f}MB ({footprint.source})")''',
+        '''        self.footprints[model_id] = footprint
+        print(f"[VRAM] {model_id}: weights={footprint.weights_bytes / 1048576:.0f}MB, "
+              f"cache/reserved={footprint.cache_reserved_bytes / 1048576:.0f}MB ({footprint.source})")
+        if self.store and footprint.measured:
+            try:
+                self.store.record_load(
+                    model_id,
+                    footprint.load_seconds,
+                    footprint.resident_bytes / (1024 * 1024),
+                    footprint.host_bytes / (1024 * 1024),
+                )
+            except Exception as e:
+                print(f"[FootprintStore] Failed to record load: {e}")''',
+    ),
+    (
+        "record_inference",
+        '''        fp = self.footprints.get(model_id)
+        if fp is not None:
+            measure_inference(fp, probe)''',
+        '''        fp = self.footprints.get(model_id)
+        if fp is not None:
+            first = fp.first_inference_ms is None
+            measure_inference(fp, probe)
+            if first and self.store:
+                try:
+                    self.store.record_first_inference(model_id, fp.first_inference_ms)
+                except Exception as e:
+                    print(f"[FootprintStore] Failed to record first inference: {e}")''',
+    ),
+    (
+        "expected_vram_mb",
+        '''        fp = self.footprints.get(model_id)
+        if fp is not None and fp.measured:
+            return int(fp.resident_bytes / (1024 * 1024))
+        return self.EXPECTED_VRAM.get(model_id, self.DEFAULT_EXPECTED_VRAM)''',
+        '''        fp = self.footprints.get(model_id)
+        if fp is not None and fp.measured:
+            return int(fp.resident_bytes / (1024 * 1024))
+        stored = self.store.expected_vram_mb(model_id) if self.store else None
+        if stored:
+            return int(stored)
+        return self.EXPECTED_VRAM.get(model_id, self.DEFAULT_EXPECTED_VRAM)
+
+    def get_load_stats(self, model_id: str):
+        """p50/p95 load time, VRAM, RAM and first-inference latency from the store"""
+        return self.store.stats(model_id) if self.store else None''',
+    ),
+    (
+        "get_last_known_vram",
+        '''    def get_last_known_vram(self, model_id: str) -> int:
+        return self.last_known_vram.get(model_id, 0)''',
+        '''    def get_last_known_vram(self, model_id: str) -> int:
+        if model_id in self.last_known_vram:
+            return self.last_known_vram[model_id]
+        stored = self.store.last_vram_mb(model_id) if self.store else None
+        return int(stored) if stored else 0''',
+    ),
+    (
+        "instance",
+        '''model_memory_tracker = ModelMemoryTracker()''',
+        '''try:
+    model_memory_tracker = ModelMemoryTracker(store=FootprintStore())
+except Exception as e:
+    print(f"[FootprintStore] Disabled ({e}) - footprints will not persist")
+    model_memory_tracker = ModelMemoryTracker()''',
+    ),
+    (
+        "/v1/models",
+        '''                            "last_known_vram_mb": model_memory_tracker.get_last_known_vram(model_id),''',
+        '''                            "last_known_vram_mb": model_memory_tracker.get_last_known_vram(model_id),
+                            "load_stats": model_memory_tracker.get_load_stats(model_id),''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+    module_path = os.path.join(moondream_dir, "moondream_station/core/footprint_store.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(STORE_MODULE)
+
+    if "from .footprint_store import FootprintStore" in content:
+        print("✅ Already patched - footprint store found")
+        return True
+
+    if "from .vram_attribution import" not in content:
+        print("❌ Run patch_vram_attribution.py first")
+        return False
+
+    for name, old, new in REPLACEMENTS:
+        if old in content:
+            content = content.replace(old, new, 1)
+            print(f"✓ Patched {name}")
+        elif name == "/v1/models":
+            print("⚠️  Could not find /v1/models last_known_vram_mb - skipping load_stats")
+        else:
+            print(f"❌ Could not find {name} to patch")
+            return False
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_footprints'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server and load a model")
+    print("   2. Restart again - /v1/models still reports last_known_vram_mb")
+    print("   3. sqlite3 ~/.moondream-station/footprints.db 'select * from model_loads'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🔧 Moondream Station - Persistent Footprint Store")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Patch to detect ghost VRAM per process and reclaim it without kill -9.
+
+Ghost detection used to flag a zombie whenever device VRAM exceeded a
+hard-coded expected total by 1.5GB, and the only fix ran fuser + kill -9 on
+every process holding /dev/nvidia0 (including Xorg and anything else).
+
+This patch:
+1. Installs scripts/gpu_process_inspector.py into moondream_station/core
+2. Makes ModelMemoryTracker classify NVML per-process usage into
+   self / child / orphan / foreign. Ghost VRAM is now
+     (own processes - CUDA contexts - attributed models) + orphaned children
+   and foreign processes are reported but never counted
+3. Registers the server's children in ~/.moondream-station/gpu_children.json
+   so apply_system_fixes.py can confirm an orphan after a crash
+4. Adds POST /v1/system/reclaim-vram: drop cached backends (SDXL only when
+   no /v1/generate call is running), gc, empty the allocator cache; {"kill_orphans": true} additionally terminates confirmed
+   orphaned children (never foreign processes)
+
+Requires: patch_vram_attribution.py
+
+Usage:
+    python3 patch_ghost_process_detection.py
+"""
+
+import os
+import re
+import shutil
+import sys
+
+INSPECTOR_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpu_process_inspector.py")
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service',
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service\n'
+        'from .gpu_process_inspector import ChildRegistry, GpuProcessInspector, kill_orphans, reclaim_in_process',
+    ),
+    (
+        "constants",
+        '''    DEFAULT_EXPECTED_VRAM = 2500
+    GHOST_THRESHOLD_MB = 1500''',
+        '''    DEFAULT_EXPECTED_VRAM = 2500
+    GHOST_THRESHOLD_MB = 1500
+    CUDA_CONTEXT_MB = 400  # per process with a CUDA context, never attributable to a model''',
+    ),
+    (
+        "__init__",
+        '''        self.unattributed_vram_mb = 0
+        self.zombie_detected = False''',
+        '''        self.unattributed_vram_mb = 0
+        self.in_process_ghost_mb = 0
+        self.gpu_inspector = None  # GpuProcessInspector - per-process NVML view
+        self.process_report = None
+        self.zombie_detected = False''',
+    ),
+    (
+        "ghost detection",
+        '''            # 3. Whatever the device uses beyond our models is unattributed
+            self.unattributed_vram_mb = int(max(0, effective_vram - attributed_vram))
+            if self.unattributed_vram_mb > self.GHOST_THRESHOLD_MB:
+                self.ghost_vram_mb = self.unattributed_vram_mb''',
+        '''            # 3. Per-process view: our PIDs vs orphaned children vs foreign processes
+            report = self.gpu_inspector.inspect() if self.gpu_inspector else None
+            self.process_report = report
+            if report is not None and report.available:
+                own_contexts = len(report.by_category("self")) + len(report.by_category("child"))
+                self.in_process_ghost_mb = int(max(0, report.own_mb - own_contexts * self.CUDA_CONTEXT_MB - attributed_vram))
+                self.unattributed_vram_mb = self.in_process_ghost_mb
+                ghost_mb = self.in_process_ghost_mb + int(report.orphan_mb)
+                detected = self.in_process_ghost_mb > self.GHOST_THRESHOLD_MB or report.orphan_mb > 0
+            else:
+                # No per-process data (driver hides it): device total minus attributed
+                self.unattributed_vram_mb = int(max(0, effective_vram - attributed_vram))
+                ghost_mb = self.unattributed_vram_mb
+                detected = ghost_mb > self.GHOST_THRESHOLD_MB
+
+            if detected:
+                self.ghost_vram_mb = ghost_mb''',
+    ),
+    (
+        "get_ghost_status",
+        '''            "ghost_vram_mb": self.ghost_vram_mb,
+            "unattributed_vram_mb": self.unattributed_vram_mb
+        }''',
+        '''            "ghost_vram_mb": self.ghost_vram_mb,
+            "unattributed_vram_mb": self.unattributed_vram_mb,
+            "in_process_ghost_mb": self.in_process_ghost_mb,
+            "method": "per_process" if self.process_report is not None and self.process_report.available else "device_total",
+            "processes": self.process_report.as_dict() if self.process_report is not None else None
+        }''',
+    ),
+    (
+        "instance",
+        '''# Background sampler''',
+        '''# Per-process NVML inspection (own PIDs / children / orphans / foreign)
+model_memory_tracker.gpu_inspector = GpuProcessInspector(registry=ChildRegistry(), server_pid=os.getpid())
+
+# In-process reclamation steps, run before anything is ever killed
+vram_reclaim_hooks = []
+
+
+# /v1/generate calls in flight (counted by the track_sdxl_generation middleware)
+sdxl_in_flight = {"generations": 0}
+
+
+def _drop_idle_sdxl():
+    if sdxl_backend_new and not sdxl_in_flight["generations"]:
+        sdxl_backend_new.unload_backend()
+
+
+vram_reclaim_hooks.append(_drop_idle_sdxl)
+
+# Background sampler''',
+    ),
+]
+
+RECLAIM_ENDPOINT = '''@self.app.middleware("http")
+        async def track_sdxl_generation(request: Request, call_next):
+            """Reclaim never unloads SDXL while a generation is running"""
+            generating = request.method == "POST" and request.url.path.rstrip("/") == "/v1/generate"
+            if generating:
+                sdxl_in_flight["generations"] += 1
+            try:
+                return await call_next(request)
+            finally:
+                if generating:
+                    sdxl_in_flight["generations"] -= 1
+
+        @self.app.post("/v1/system/reclaim-vram")
+        async def reclaim_vram(request: Request):
+            """Reclaim ghost VRAM in-process; optionally end confirmed orphaned children"""
+            try:
+                data = await request.json()
+            except Exception:
+                data = {}
+            hooks = list(vram_reclaim_hooks)
+            if hasattr(self.inference_service, "cleanup_memory"):
+                hooks.append(self.inference_service.cleanup_memory)
+            inspector = model_memory_tracker.gpu_inspector
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: reclaim_in_process(hooks, inspector)
+            )
+            if data.get("kill_orphans") and inspector is not None:
+                result["killed_orphans"] = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: kill_orphans(inspector)
+                )
+            model_memory_tracker.update_memory_usage()
+            result["ghost_memory"] = model_memory_tracker.get_ghost_status()
+            return result
+
+        '''
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+IMPORT_LINE_RE = re.compile(r'^(?:from \S+ import [^\n(]+|import [^\n]+)\n', re.MULTILINE)
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+    module_path = os.path.join(moondream_dir, "moondream_station/core/gpu_process_inspector.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    shutil.copyfile(INSPECTOR_SOURCE, module_path)
+
+    if "from .gpu_process_inspector import" in content:
+        print("✅ Already patched - per-process ghost detection found")
+        return True
+
+    if "from .vram_attribution import" not in content:
+        print("❌ Run patch_vram_attribution.py first")
+        return False
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} to patch")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if not re.search(r'^import os$', content, re.MULTILINE):
+        # After the last top-level import, below any docstring / __future__ import
+        body_at = content.find("\nclass ")
+        header = list(IMPORT_LINE_RE.finditer(content, 0, body_at if body_at != -1 else len(content)))
+        at = header[-1].end() if header else 0
+        content = content[:at] + "import os\n" + content[at:]
+
+    if ROUTER_ANCHOR in content:
+        content = content.replace(ROUTER_ANCHOR, RECLAIM_ENDPOINT + ROUTER_ANCHOR, 1)
+        print("✓ Added POST /v1/system/reclaim-vram")
+    else:
+        print("⚠️  Could not find router setup hook - reclaim endpoint not added")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_ghost_process'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl http://localhost:2020/metrics | jq .ghost_memory.processes")
+    print("   3. curl -X POST http://localhost:2020/v1/system/reclaim-vram")
+    print("   4. 'vram_ghosting' in Diagnostics now only ends confirmed orphans")
+
+    return True
+
+if __name__ == "__main__":
+    print("👻 Moondream Station - Per-Process Ghost VRAM Detection")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
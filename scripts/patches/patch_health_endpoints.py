@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Patch to add liveness / readiness endpoints that never touch a model.
+
+Dockerfile.backend and docker-compose.yml health-checked with
+`curl -f http://localhost:2020/v1/chat/completions`. That is the inference
+route: every 30s the check could auto-start or auto-switch a model in
+_handle_chat_completion.
+
+This patch adds:
+1. GET /health/live - the event loop is answering. No locks, GPU or
+   manifest access
+2. GET /health/ready - 200 once the server is serving and the startup
+   warm-up (patch_fast_startup.py) has finished, 503 before. Reports the
+   loaded models with their tier (gpu / parked), the active model, a switch
+   in progress, and the loadable models (manifest + SDXL if its backend is
+   installed), captured when routes are set up
+
+Both read in-memory state only, so they answer in microseconds even while
+a model load holds the GPU.
+
+Requires: patch_fast_startup.py
+
+Usage:
+    python3 patch_health_endpoints.py
+"""
+
+import os
+import sys
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+HEALTH_ENDPOINTS = '''# Liveness / readiness: cached state only, never model or GPU calls
+        from fastapi.responses import JSONResponse
+        health_loadable = sorted(self.manifest_manager.get_models()) + (["sdxl-base"] if sdxl_backend_new else [])
+
+        @self.app.get("/health/live")
+        async def health_live():
+            return {"status": "alive", "uptime_s": startup_profile.since_start()}
+
+        @self.app.get("/health/ready")
+        async def health_ready():
+            warmup = startup_profile.warmup
+            ready = startup_profile.reached("serving") and warmup["state"] in ("disabled", "done")
+            body = {
+                "status": "ready" if ready else "starting",
+                "warmup": warmup["state"],
+                "warmup_failed": [m for m, s in warmup["models"].items() if s.get("state") == "failed"],
+                "active_model": residency_manager.active,
+                "switching_to": self.switch_coordinator.status()["switching_to"],
+                "loaded": {model_id: entry.tier for model_id, entry in list(residency_manager.resident.items())},
+                "loadable": health_loadable,
+            }
+            return JSONResponse(content=body, status_code=200 if ready else 503)
+
+        '''
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    if '"/health/ready"' in content:
+        print("✅ Already patched - health endpoints found")
+        return True
+
+    if "from .startup_profile import ParallelWarmup" not in content:
+        print("❌ Run patch_fast_startup.py first")
+        return False
+
+    if ROUTER_ANCHOR not in content:
+        print("❌ Could not find router setup hook")
+        return False
+    content = content.replace(ROUTER_ANCHOR, HEALTH_ENDPOINTS + ROUTER_ANCHOR, 1)
+    print("✓ Added GET /health/live and /health/ready")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_health'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl -i http://localhost:2020/health/ready")
+
+    return True
+
+if __name__ == "__main__":
+    print("🩺 Moondream Station - Liveness / Readiness Endpoints")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
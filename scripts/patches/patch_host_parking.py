@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Patch to add a host-RAM "parked" tier between loaded and unloaded.
+
+When analysis and generation alternate, the residency manager evicts SDXL
+or a vision model and the next request pays a full disk reload. With this
+patch an evicted model's weights are copied into pinned host RAM instead of
+being freed, so bringing it back is a host-to-device copy (~1-2s for SDXL
+on PCIe 4) rather than a multi-second disk load and re-init.
+
+This patch:
+1. Installs moondream_station/core/host_parking.py (tensor-level park /
+   unpark with pinned buffers; bitsandbytes modules are moved whole)
+2. Refreshes residency_manager.py and turns parking on for it
+3. Enforces a host budget with psutil: config "host_park_budget_mb", else
+   35% of total RAM, and always leaves "host_park_reserve_mb" (default
+   4096) available. Parked models are evicted to make room with the same
+   cost score as GPU residents
+4. ModelMemoryTracker reports every known model as gpu / parked / cold
+   (model_states in /metrics)
+
+Pipelines using accelerate offload hooks are never parked (they already
+manage their own placement); they are unloaded as before.
+
+Requires: patch_residency_manager.py
+
+Usage:
+    python3 patch_host_parking.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_residency_manager import RESIDENCY_MODULE  # noqa: E402
+
+PARKING_MODULE = '''"""
+Host-RAM parking for model weights.
+
+park() copies every CUDA parameter/buffer reachable from a backend into a
+(pinned) CPU tensor and repoints the module at it, so the VRAM is released
+while the Python objects - and everything the backend cached around them -
+stay alive. unpark() copies them back to their original devices.
+"""
+
+import sys
+import time
+
+import psutil
+
+from .vram_attribution import iter_torch_modules
+
+MB = 1024 * 1024
+DEFAULT_HOST_FRACTION = 0.35
+DEFAULT_RESERVE_MB = 4096
+QUANTIZED_PARAM_TYPES = ("Params4bit", "Int8Params")
+
+
+class ParkedWeights:
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.records = []  # (owner_module, "param" | "buffer", name, host_tensor, device)
+        self.module_moves = []  # (module, device) for modules moved whole
+        self.nbytes = 0
+        self.parked_at = time.time()
+        self.park_seconds = 0.0
+
+
+def _has_offload_hooks(module):
+    return any(hasattr(m, "_hf_hook") for m in module.modules())
+
+
+def _is_quantized(module):
+    return any(type(p).__name__ in QUANTIZED_PARAM_TYPES for p in module.parameters())
+
+
+def _first_cuda_device(module):
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if tensor.is_cuda:
+            return tensor.device
+    return None
+
+
+def _assign(owner, kind, name, tensor):
+    if kind == "param":
+        owner._parameters[name].data = tensor
+    else:
+        owner._buffers[name] = tensor
+
+
+class HostParking:
+    def __init__(self, config=None):
+        self.config = config
+        self.parked = {}  # model_id -> ParkedWeights
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return float(value) if value else default
+
+    def budget_mb(self):
+        total = psutil.virtual_memory().total / MB
+        return self._setting("host_park_budget_mb", total * DEFAULT_HOST_FRACTION)
+
+    def parked_mb(self):
+        return sum(p.nbytes for p in self.parked.values()) / MB
+
+    def fits(self, size_mb):
+        available = psutil.virtual_memory().available / MB
+        reserve = self._setting("host_park_reserve_mb", DEFAULT_RESERVE_MB)
+        return self.parked_mb() + size_mb <= self.budget_mb() and available - size_mb >= reserve
+
+    def park(self, model_id, roots):
+        """Move a model's CUDA weights to host RAM. Returns None if it cannot be parked."""
+        torch = sys.modules.get("torch")
+        if torch is None or not torch.cuda.is_available():
+            return None
+        modules = [m for root in roots for m in iter_torch_modules(root)]
+        if not modules or any(_has_offload_hooks(m) for m in modules):
+            return None
+
+        pin = bool(self.config.get("host_park_pinned", True)) if self.config else True
+        parked = ParkedWeights(model_id)
+        started = time.perf_counter()
+        host_by_tensor = {}
+        try:
+            for module in modules:
+                if _is_quantized(module):
+                    # bitsandbytes keeps quant_state next to the data; move the module whole
+                    device = _first_cuda_device(module)
+                    if device is not None:
+                        parked.nbytes += sum(p.numel() * p.element_size() for p in module.parameters() if p.is_cuda)
+                        module.to("cpu")
+                        parked.module_moves.append((module, device))
+                    continue
+                for owner in module.modules():
+                    for kind, table in (("param", owner._parameters), ("buffer", owner._buffers)):
+                        for name, tensor in table.items():
+                            if tensor is None or not tensor.is_cuda:
+                                continue
+                            host = host_by_tensor.get(id(tensor))
+                            if host is None:
+                                host = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=pin)
+                                host.copy_(tensor.detach(), non_blocking=pin)
+                                host_by_tensor[id(tensor)] = host
+                                parked.nbytes += tensor.numel() * tensor.element_size()
+                            parked.records.append((owner, kind, name, host, tensor.device))
+            torch.cuda.synchronize()
+        except Exception as e:
+            # Nothing was repointed yet; undo whole-module moves and give up
+            for module, device in parked.module_moves:
+                module.to(device)
+            print(f"[HostParking] Could not park {model_id}: {e}")
+            return None
+
+        for owner, kind, name, host, _ in parked.records:
+            _assign(owner, kind, name, host)
+        parked.park_seconds = time.perf_counter() - started
+        self.parked[model_id] = parked
+        return parked
+
+    def unpark(self, parked):
+        """Copy parked weights back to their devices. Returns the seconds taken."""
+        import torch
+        started = time.perf_counter()
+        on_device = {}
+        for owner, kind, name, host, device in parked.records:
+            tensor = on_device.get(id(host))
+            if tensor is None:
+                tensor = host.to(device, non_blocking=True)
+                on_device[id(host)] = tensor
+            _assign(owner, kind, name, tensor)
+        for module, device in parked.module_moves:
+            module.to(device)
+        torch.cuda.synchronize()
+        self.release(parked)
+        return time.perf_counter() - started
+
+    def release(self, parked):
+        """Forget a parked model (its host buffers are freed with the last reference)."""
+        self.parked.pop(parked.model_id, None)
+        parked.records = []
+        parked.module_moves = []
+
+    def status(self):
+        return {
+            "budget_mb": round(self.budget_mb()),
+            "parked_mb": round(self.parked_mb()),
+            "available_mb": round(psutil.virtual_memory().available / MB),
+            "models": {
+                model_id: {"mb": round(p.nbytes / MB), "parked_at": p.parked_at, "park_seconds": round(p.park_seconds, 3)}
+                for model_id, p in self.parked.items()
+            },
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .residency_manager import ResidencyManager',
+        'from .residency_manager import ResidencyManager\n'
+        'from .host_parking import HostParking',
+    ),
+    (
+        "tracker state",
+        '''        self.footprints = {}  # model_id -> ModelFootprint (persists after unload)''',
+        '''        self.footprints = {}  # model_id -> ModelFootprint (persists after unload)
+        self.model_states = {}  # model_id -> "gpu" | "parked"; other known models are "cold"''',
+    ),
+    (
+        "tracker methods",
+        '''    def get_ghost_status(self):''',
+        '''    def set_model_state(self, model_id: str, state: str):
+        if state == "cold":
+            self.model_states.pop(model_id, None)
+        else:
+            self.model_states[model_id] = state
+
+    def get_model_states(self):
+        """gpu / parked / cold for every model we have a size for or have seen"""
+        known = set(self.EXPECTED_VRAM) | set(self.footprints) | set(self.model_states)
+        return {model_id: self.model_states.get(model_id, "cold") for model_id in sorted(known)}
+
+    def get_ghost_status(self):''',
+    ),
+    (
+        "enable parking",
+        '''        residency_manager.attach(self.inference_service)''',
+        '''        residency_manager.parking = HostParking(self.config)
+        metrics_sampler.register_provider("model_states", model_memory_tracker.get_model_states)
+        residency_manager.attach(self.inference_service)''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("host_parking.py", PARKING_MODULE), ("residency_manager.py", RESIDENCY_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .host_parking import" in content:
+        print("✅ Already patched - host parking found")
+        return True
+
+    if "from .residency_manager import" not in content:
+        print("❌ Run patch_residency_manager.py first")
+        return False
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} to patch")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_host_parking'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config keys: host_park_budget_mb, host_park_reserve_mb, host_park_pinned")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/models/residency | jq '.host_parking, .resident'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🅿️  Moondream Station - Host RAM Parking Tier")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Patch to load JoyCaption from a pre-quantized 4-bit checkpoint.
+
+joycaption_backend loads the 8GB fp16 LLaVA checkpoint and quantizes it
+with bitsandbytes on every load: all 8GB are read into host RAM and
+converted again each time the model is switched in.
+
+scripts/prequantize_joycaption.py does that conversion once and saves the
+4-bit model under ~/.moondream-station/models/quantized/. This patch:
+1. Installs moondream_station/core/prequantized.py:
+   - finds a pre-quantized copy of a checkpoint by its prequantized.json:
+     source path or repo id, or the same weight files at another path (a
+     local copy made after the conversion), confirmed by content hash
+   - staleness check: the source weight files (name, size, mtime) must match
+     what was converted; if they differ, the source is re-hashed and
+     compared with the recorded content hash. A changed source or different
+     4-bit settings (quant type, double quant) fall back to runtime
+     quantization with a message
+   - loads the saved 4-bit weights directly (no quantization_config, no fp16
+     copy in host RAM)
+2. Routes LlavaForConditionalGeneration.from_pretrained(...) in
+   joycaption_backend/backend.py through it. The processor still loads from
+   the source
+
+Set MOONDREAM_PREQUANTIZED=0 to always quantize at load time. Load time and
+peak RSS before / after: scripts/benchmark_joycaption_load.py (also visible
+in /v1/models load_profile with patch_load_profiler.py).
+
+Requires: scripts/prequantize_joycaption.py run once
+
+Usage:
+    python3 patch_joycaption_prequantized.py
+"""
+
+import os
+import re
+import sys
+
+PREQUANTIZED_MODULE = '''"""
+Pre-quantized checkpoints: load a saved 4-bit model instead of quantizing the source on every load.
+
+Artifacts are written by scripts/prequantize_joycaption.py, which uses the helpers below.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+DEFAULT_DIR = os.path.expanduser("~/.moondream-station/models/quantized")
+MANIFEST = "prequantized.json"
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".json")
+QUANT_FIELDS = ("load_in_4bit", "load_in_8bit", "bnb_4bit_quant_type", "bnb_4bit_use_double_quant")
+LOAD_ONLY = ("quantization_config", "load_in_4bit", "load_in_8bit")
+
+
+def weight_files(path):
+    return sorted(n for n in os.listdir(path) if n.endswith(WEIGHT_SUFFIXES) and os.path.isfile(os.path.join(path, n)))
+
+
+def signature(path):
+    """{file: [size, mtime_ns]} - cheap check that the source is unchanged."""
+    out = {}
+    for name in weight_files(path):
+        st = os.stat(os.path.join(path, name))
+        out[name] = [st.st_size, st.st_mtime_ns]
+    return out
+
+
+def content_hash(path):
+    digest = hashlib.blake2b(digest_size=20)
+    for name in weight_files(path):
+        digest.update(name.encode())
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_source(source):
+    """Local directory of source (a path, or a repo id already in the HF cache)."""
+    source = str(source)
+    if os.path.isdir(source):
+        return os.path.realpath(source)
+    try:
+        from huggingface_hub import snapshot_download
+        return os.path.realpath(snapshot_download(source, local_files_only=True))
+    except Exception:
+        return None
+
+
+def quant_settings(config):
+    if config is None:
+        return {}
+    if not isinstance(config, dict):
+        config = {f: getattr(config, f) for f in QUANT_FIELDS if hasattr(config, f)}
+    return {f: config[f] for f in QUANT_FIELDS if f in config}
+
+
+def _root():
+    return os.path.expanduser(os.environ.get("MOONDREAM_PREQUANTIZED_DIR", DEFAULT_DIR))
+
+
+def _sizes(files):
+    return {name: size for name, (size, _) in (files or {}).items()}
+
+
+def find_artifact(source, quantization_config=None):
+    """(artifact_dir, None) for a fresh pre-quantized copy of source, else (None, reason).
+
+    A copy matches by the source path or repo id it was converted from, or -
+    for the same weights moved or copied elsewhere (migrate_models_to_local.py)
+    - by file names and sizes, confirmed by the content hash.
+    """
+    root = _root()
+    src = resolve_source(source)
+    sizes = _sizes(signature(src)) if src is not None else None
+    candidates = []
+    for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        path = os.path.join(root, name, MANIFEST)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        named = str(source) in (manifest.get("source"), manifest.get("repo_id")) or src == manifest.get("source")
+        if named or (sizes and sizes == _sizes(manifest.get("source_files"))):
+            candidates.append((os.path.dirname(path), manifest))
+    if not candidates:
+        return None, "no pre-quantized copy (run scripts/prequantize_joycaption.py)"
+
+    reason = None
+    for artifact, manifest in candidates:
+        wanted = quant_settings(quantization_config)
+        saved = manifest.get("quantization", {})
+        differs = {k: (v, saved[k]) for k, v in wanted.items() if k in saved and saved[k] != v}
+        if differs:
+            reason = f"{artifact} was quantized with different settings {differs}"
+            continue
+        if src is None:
+            reason = "source weights not found locally, cannot check staleness"
+            continue
+        current = signature(src)
+        copies = manifest.get("copies") or {}
+        if current == (manifest.get("source_files") if src == manifest.get("source") else copies.get(src)):
+            return artifact, None
+        print(f"[Prequantized] {src} changed or not seen before, hashing to check {artifact}")
+        if content_hash(src) == manifest.get("source_hash"):
+            if src == manifest.get("source"):
+                manifest["source_files"] = current
+            else:
+                manifest["copies"] = {**copies, src: current}
+            try:
+                with open(os.path.join(artifact, MANIFEST), "w") as f:
+                    json.dump(manifest, f, indent=2)
+            except OSError:
+                pass
+            return artifact, None
+        reason = f"{artifact} is stale: source weights changed since conversion"
+    return None, reason
+
+
+def from_pretrained(cls, source, *args, **kwargs):
+    """cls.from_pretrained(source, ...) from the pre-quantized copy when one is fresh."""
+    if os.environ.get("MOONDREAM_PREQUANTIZED", "1") == "0":
+        return cls.from_pretrained(source, *args, **kwargs)
+    artifact, reason = find_artifact(source, kwargs.get("quantization_config"))
+    if artifact is None:
+        print(f"[Prequantized] {source}: {reason}; quantizing at load time")
+        return cls.from_pretrained(source, *args, **kwargs)
+    load_kwargs = {k: v for k, v in kwargs.items() if k not in LOAD_ONLY}
+    load_kwargs.setdefault("device_map", {"": 0})  # bitsandbytes weights live on the GPU
+    started = time.perf_counter()
+    model = cls.from_pretrained(artifact, *args, **load_kwargs)
+    print(f"[Prequantized] Loaded {artifact} in {time.perf_counter() - started:.1f}s")
+    return model
+'''
+
+BACKEND_IMPORT = '''try:
+    from moondream_station.core.prequantized import from_pretrained as prequantized_from_pretrained
+except ImportError:  # backend used outside moondream-station
+    def prequantized_from_pretrained(cls, source, *args, **kwargs):
+        return cls.from_pretrained(source, *args, **kwargs)
+'''
+
+LOAD_CALL = 'LlavaForConditionalGeneration.from_pretrained('
+PREQUANTIZED_CALL = 'prequantized_from_pretrained(LlavaForConditionalGeneration, '
+
+IMPORT_LINE_RE = re.compile(r'^(?:from \S+ import [^\n(]+|import [^\n]+)\n', re.MULTILINE)
+
+BACKEND_PATHS = (
+    "~/.moondream-station/models/backends/joycaption_backend/backend.py",
+    "~/.moondream-station/moondream-station/backends/joycaption_backend/backend.py",
+)
+
+
+def apply_patch():
+    """Install core/prequantized.py and route joycaption_backend's model load through it"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    module_path = os.path.join(core_dir, "prequantized.py")
+
+    if not os.path.isdir(core_dir):
+        print(f"❌ moondream_station/core not found at {core_dir}")
+        return False
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(PREQUANTIZED_MODULE)
+
+    backend_path = next((os.path.expanduser(p) for p in BACKEND_PATHS if os.path.exists(os.path.expanduser(p))), None)
+    if backend_path is None:
+        print(f"❌ joycaption_backend/backend.py not found (looked in {', '.join(BACKEND_PATHS)})")
+        return False
+
+    print(f"📝 Reading {backend_path}")
+    with open(backend_path, 'r') as f:
+        content = f.read()
+
+    if "prequantized_from_pretrained" in content:
+        print("✅ Already patched - pre-quantized loading found")
+        return True
+
+    calls = content.count(LOAD_CALL)
+    if not calls:
+        print(f"❌ Could not find {LOAD_CALL}...) in the backend")
+        return False
+    content = content.replace(LOAD_CALL + "\n", PREQUANTIZED_CALL.rstrip() + "\n").replace(LOAD_CALL, PREQUANTIZED_CALL)
+    print(f"✓ Routed {calls} model load(s) through prequantized_from_pretrained")
+
+    first_def = re.search(r'^(?:def |class |@)', content, re.MULTILINE)
+    header = list(IMPORT_LINE_RE.finditer(content, 0, first_def.start() if first_def else len(content)))
+    at = header[-1].end() if header else 0
+    content = content[:at] + BACKEND_IMPORT + content[at:]
+    print("✓ Added prequantized import")
+
+    # Write patched content
+    backup_path = backend_path + '.backup_prequantized'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(backend_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(backend_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. python3 scripts/prequantize_joycaption.py (once; again after the weights change)")
+    print("   2. Restart moondream-station server")
+    print("   3. python3 scripts/benchmark_joycaption_load.py")
+
+    return True
+
+if __name__ == "__main__":
+    print("🗜️  Moondream Station - Pre-quantized JoyCaption")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
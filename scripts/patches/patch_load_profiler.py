@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""
+Patch to break every model load into phases.
+
+All switch paths call self.inference_service.start(model_id) as a black box,
+so a 20s switch could be disk, deserialisation, quantisation or the
+host-to-device copy and we could not tell which.
+
+This patch installs moondream_station/core/load_profiler.py and wraps
+inference_service.start so each load reports exclusive time per phase:
+
+    disk_read      block-I/O wait (/proc delay accounting) + bytes read from storage
+    deserialize    safetensors load_file / safe_open get_tensor, torch.load
+    cast_quantize  Module.to(dtype) / half() / float(), bitsandbytes quantize
+    to_device      Module.to(device) / cuda(), accelerate set_module_tensor_to_device
+    warmup         first inference after the load
+    other          everything else inside start() (imports, config, processors)
+
+Phases nest (quantize inside .to(cuda)); each call's time is counted once,
+in the innermost phase. The breakdown is returned as "load_profile" by
+/v1/models/switch and recorded as a "model_load" event in
+/v1/metrics/history.
+
+Requires: patch_vram_attribution.py, patch_metrics_sampler.py
+
+Usage:
+    python3 patch_load_profiler.py
+"""
+
+import os
+import sys
+
+PROFILER_MODULE = '''"""
+Phase-level model load profiler.
+
+Hooks are installed once and are no-ops unless a profile is active on the
+calling thread, so inference pays one attribute lookup per hooked call.
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+
+PHASES = ("disk_read", "deserialize", "cast_quantize", "to_device", "warmup", "other")
+RSS_SAMPLE_INTERVAL_S = 0.02
+COLD_READ_FRACTION = 0.5  # storage reads >= half the weight bytes => page cache was cold
+MB = 1024 * 1024
+
+_active = None  # LoadProfile being recorded (loads are serialised)
+_hooks_installed = False
+
+
+def _blkio_ticks():
+    """delayacct_blkio_ticks from /proc/self/stat (0 when delay accounting is off)."""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return int(fields[39])
+    except Exception:
+        return 0
+
+
+def _read_bytes():
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("read_bytes:"):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+
+class _RssPeakSampler:
+    """Polls RSS during a load; weights staged in host RAM show up as the peak."""
+
+    def __init__(self):
+        self.start_bytes = _rss_bytes()
+        self.peak_bytes = self.start_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="load-rss-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL_S):
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+
+
+class LoadProfile:
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.thread = threading.get_ident()
+        self.phases = {name: {"seconds": 0.0, "calls": 0} for name in PHASES}
+        self.files = []
+        self.extra = {}
+        self.started_at = time.time()
+        self.total_seconds = 0.0
+        self.success = None
+        self._stack = []  # [phase, start, child_seconds]
+        self._t0 = time.perf_counter()
+        self._blkio0 = _blkio_ticks()
+        self._read0 = _read_bytes()
+        self._rss = _RssPeakSampler()
+        self.cache = None  # "cold" | "warm" page cache for the weight files
+
+    def enter(self, phase):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self):
+        phase, start, children = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.phases[phase]["seconds"] += max(0.0, elapsed - children)
+        self.phases[phase]["calls"] += 1
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def add_file(self, path):
+        try:
+            self.files.append({"path": str(path), "bytes": os.path.getsize(path)})
+        except (OSError, TypeError):
+            pass
+
+    def annotate(self, key, value):
+        self.extra[key] = value
+
+    def finish(self, success):
+        self.total_seconds = time.perf_counter() - self._t0
+        self.success = success
+        ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        remaining = (_blkio_ticks() - self._blkio0) / float(ticks)
+        # Block-I/O wait happens inside whichever phase touches the pages first:
+        # deserialize for copying loaders, to_device when tensors are mmap views
+        for phase in ("deserialize", "to_device", "cast_quantize"):
+            taken = min(remaining, self.phases[phase]["seconds"])
+            self.phases[phase]["seconds"] -= taken
+            self.phases["disk_read"]["seconds"] += taken
+            remaining -= taken
+        self.phases["disk_read"]["bytes"] = max(0, _read_bytes() - self._read0)
+        self.phases["disk_read"]["calls"] = len(self.files)
+        self._rss.stop()
+        weight_bytes = sum(f["bytes"] for f in self.files)
+        if weight_bytes:
+            read = self.phases["disk_read"]["bytes"]
+            self.cache = "cold" if read >= COLD_READ_FRACTION * weight_bytes else "warm"
+        self._recompute_other()
+
+    def record_warmup(self, seconds):
+        self.phases["warmup"]["seconds"] = seconds
+        self.phases["warmup"]["calls"] = 1
+
+    def _recompute_other(self):
+        measured = sum(v["seconds"] for k, v in self.phases.items() if k not in ("other", "warmup"))
+        self.phases["other"]["seconds"] = max(0.0, self.total_seconds - measured)
+
+    def as_dict(self):
+        phases = {}
+        for name, value in self.phases.items():
+            phases[name] = {**value, "seconds": round(value["seconds"], 4)}
+        slowest = max((n for n in PHASES if n != "other"), key=lambda n: self.phases[n]["seconds"])
+        return {
+            "model": self.model_id,
+            "success": self.success,
+            "started_at": self.started_at,
+            "total_seconds": round(self.total_seconds, 4),
+            "phases": phases,
+            "slowest_phase": slowest,
+            "cache": self.cache,
+            "rss_start_mb": round(self._rss.start_bytes / MB),
+            "peak_rss_mb": round(self._rss.peak_bytes / MB),
+            "peak_rss_delta_mb": round((self._rss.peak_bytes - self._rss.start_bytes) / MB),
+            "weight_files": self.files,
+            **self.extra,
+        }
+
+
+def _timed(phase, fn, classify=None, record_file=None):
+    """Wrap fn so calls on the profiling thread are charged to a phase."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profile = _active
+        if profile is None or profile.thread != threading.get_ident():
+            return fn(*args, **kwargs)
+        name = classify(args, kwargs) if classify else phase
+        if name is None:
+            return fn(*args, **kwargs)
+        if record_file is not None:
+            profile.add_file(record_file(args, kwargs))
+        profile.enter(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.exit()
+
+    wrapper._load_profiler_wrapped = True
+    return wrapper
+
+
+def _classify_to(args, kwargs):
+    """Module.to(...): device moves are to_device, dtype-only calls are casts."""
+    import torch
+    values = list(args[1:]) + list(kwargs.values())
+    for v in values:
+        if isinstance(v, torch.device) or (isinstance(v, str) and v.split(":")[0] in ("cuda", "cpu", "mps", "xpu")):
+            return "to_device"
+        if isinstance(v, int) and not isinstance(v, bool):
+            return "to_device"
+    for v in values:
+        if isinstance(v, torch.dtype):
+            return "cast_quantize"
+    return None
+
+
+class _SafeOpenProxy:
+    """safe_open handle whose tensor reads are charged to deserialize."""
+
+    def __init__(self, handle):
+        self._handle = handle
+
+    def __enter__(self):
+        self._handle = self._handle.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._handle.__exit__(*exc)
+
+    def get_tensor(self, name):
+        return _timed("deserialize", self._handle.get_tensor)(name)
+
+    def get_slice(self, name):
+        return _timed("deserialize", self._handle.get_slice)(name)
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+
+def _patch_attr(owner, name, wrap):
+    original = getattr(owner, name, None)
+    if original is None or getattr(original, "_load_profiler_wrapped", False):
+        return False
+    setattr(owner, name, wrap(original))
+    return True
+
+
+def install_hooks():
+    """Wrap the load-path functions of torch / safetensors / accelerate / bitsandbytes."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+
+    first_arg = lambda args, kwargs: args[0] if args else kwargs.get("filename") or kwargs.get("f")
+
+    try:
+        import safetensors
+        import safetensors.torch as st
+        load_file = lambda fn: _timed("deserialize", fn, record_file=first_arg)
+        _patch_attr(st, "load_file", load_file)
+
+        original_safe_open = safetensors.safe_open
+
+        def safe_open(*args, **kwargs):
+            profile = _active
+            handle = original_safe_open(*args, **kwargs)
+            if profile is None or profile.thread != threading.get_ident():
+                return handle
+            profile.add_file(first_arg(args, kwargs))
+            return _SafeOpenProxy(handle)
+
+        safe_open._load_profiler_wrapped = True
+        safetensors.safe_open = safe_open
+        # Modules that imported the names before we got here
+        for module_name in ("transformers.modeling_utils", "diffusers.models.model_loading_utils"):
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            if hasattr(module, "safe_open"):
+                module.safe_open = safe_open
+            if hasattr(module, "safe_load_file"):
+                _patch_attr(module, "safe_load_file", load_file)
+    except ImportError:
+        pass
+
+    try:
+        import torch
+        _patch_attr(torch, "load", lambda fn: _timed("deserialize", fn, record_file=first_arg))
+        module_cls = torch.nn.Module
+        _patch_attr(module_cls, "to", lambda fn: _timed(None, fn, classify=_classify_to))
+        _patch_attr(module_cls, "cuda", lambda fn: _timed("to_device", fn))
+        _patch_attr(module_cls, "half", lambda fn: _timed("cast_quantize", fn))
+        _patch_attr(module_cls, "float", lambda fn: _timed("cast_quantize", fn))
+        _patch_attr(module_cls, "bfloat16", lambda fn: _timed("cast_quantize", fn))
+    except ImportError:
+        pass
+
+    try:
+        import accelerate.utils.modeling as accel
+        _patch_attr(accel, "set_module_tensor_to_device", lambda fn: _timed("to_device", fn))
+    except ImportError:
+        pass
+
+    try:
+        import bitsandbytes.nn as bnb_nn
+        for cls_name in ("Params4bit", "Int8Params"):
+            cls = getattr(bnb_nn, cls_name, None)
+            if cls is not None:
+                _patch_attr(cls, "_quantize", lambda fn: _timed("cast_quantize", fn))
+    except ImportError:
+        pass
+
+
+class LoadProfiler:
+    """Keeps the latest profile per model and publishes it to the metrics sampler."""
+
+    def __init__(self, sampler=None):
+        self.sampler = sampler
+        self.profiles = {}
+        self.by_cache = {}  # model_id -> {"cold": seconds, "warm": seconds} of the latest of each
+        self._awaiting_warmup = set()
+
+    def begin(self, model_id):
+        global _active
+        install_hooks()
+        _active = LoadProfile(model_id)
+        return _active
+
+    def end(self, profile, success):
+        global _active
+        _active = None
+        profile.finish(success)
+        self.profiles[profile.model_id] = profile
+        if success and profile.cache:
+            self.by_cache.setdefault(profile.model_id, {})[profile.cache] = round(profile.total_seconds, 3)
+        if success:
+            self._awaiting_warmup.add(profile.model_id)
+        self._publish(profile)
+        return profile
+
+    def discard(self, profile):
+        """Drop a profile whose start() did not load anything (resident swap)."""
+        global _active
+        if _active is profile:
+            _active = None
+        profile._rss.stop()
+
+    def record_warmup(self, model_id, seconds):
+        profile = self.profiles.get(model_id)
+        if profile is None or model_id not in self._awaiting_warmup:
+            return
+        self._awaiting_warmup.discard(model_id)
+        profile.record_warmup(seconds)
+        self._publish(profile, kind="model_warmup")
+
+    def last_profile(self, model_id):
+        profile = self.profiles.get(model_id)
+        return profile.as_dict() if profile else None
+
+    def summary(self):
+        return {
+            model_id: {
+                "total_seconds": round(p.total_seconds, 3),
+                "slowest_phase": p.as_dict()["slowest_phase"],
+                "cache": p.cache,
+                "peak_rss_mb": round(p._rss.peak_bytes / MB),
+                "cold_seconds": self.by_cache.get(model_id, {}).get("cold"),
+                "warm_seconds": self.by_cache.get(model_id, {}).get("warm"),
+            }
+            for model_id, p in self.profiles.items()
+        }
+
+    def _publish(self, profile, kind="model_load"):
+        data = profile.as_dict()
+        phases = ", ".join(f"{k}={v['seconds']:.2f}s" for k, v in data["phases"].items() if v["seconds"] >= 0.01)
+        print(f"[LoadProfiler] {profile.model_id} {kind} {data['total_seconds']:.2f}s: {phases}")
+        if self.sampler is not None:
+            self.sampler.record_event(kind, data)
+
+
+def instrument_load_profiler(service, profiler):
+    """Wrap service.start (profiles the load) and execute_function (first call = warm-up)."""
+    if getattr(service, "_load_profiler_installed", False):
+        return
+    service._load_profiler_installed = True
+
+    original_start = service.start
+    original_execute = service.execute_function
+    state = {"active_model": None}
+
+    @functools.wraps(original_start)
+    def start(model_id, *args, **kwargs):
+        profile = profiler.begin(model_id)
+        ok = False
+        try:
+            ok = original_start(model_id, *args, **kwargs)
+            return ok
+        finally:
+            if ok and getattr(service, "start_reused_resident", False):
+                profiler.discard(profile)
+            else:
+                profiler.end(profile, bool(ok))
+            if ok:
+                state["active_model"] = model_id
+
+    @functools.wraps(original_execute)
+    async def execute_function(*args, **kwargs):
+        model_id = state["active_model"]
+        started = time.perf_counter()
+        try:
+            return await original_execute(*args, **kwargs)
+        finally:
+            if model_id is not None:
+                profiler.record_warmup(model_id, time.perf_counter() - started)
+
+    service.start = start
+    service.execute_function = execute_function
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .metrics_sampler import MetricsSampler, collect_system_snapshot',
+        'from .metrics_sampler import MetricsSampler, collect_system_snapshot\n'
+        'from .load_profiler import LoadProfiler, instrument_load_profiler',
+    ),
+    (
+        "instance",
+        '''metrics_sampler = MetricsSampler(lambda: collect_system_snapshot(hw_monitor, model_memory_tracker))''',
+        '''metrics_sampler = MetricsSampler(lambda: collect_system_snapshot(hw_monitor, model_memory_tracker))
+
+# Per-phase load timings (disk / deserialize / cast / to(device) / warm-up)
+load_profiler = LoadProfiler(sampler=metrics_sampler)
+metrics_sampler.register_provider("load_profiles", load_profiler.summary)''',
+    ),
+    (
+        "instrumentation",
+        '''instrument_inference_service(self.inference_service, model_memory_tracker)''',
+        '''instrument_inference_service(self.inference_service, model_memory_tracker)
+        instrument_load_profiler(self.inference_service, load_profiler)''',
+    ),
+]
+
+SWITCH_RESPONSE_OLD = '''                    "vram_mb": vram_mb,
+                    "ram_mb": ram_mb
+                }'''
+
+SWITCH_RESPONSE_NEW = '''                    "vram_mb": vram_mb,
+                    "ram_mb": ram_mb,
+                    "load_profile": load_profiler.last_profile(model_id)
+                }'''
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+    module_path = os.path.join(moondream_dir, "moondream_station/core/load_profiler.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(PROFILER_MODULE)
+
+    if "from .load_profiler import" in content:
+        print("✅ Already patched - load profiler found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_vram_attribution.py and patch_metrics_sampler.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    if SWITCH_RESPONSE_OLD in content:
+        content = content.replace(SWITCH_RESPONSE_OLD, SWITCH_RESPONSE_NEW, 1)
+        print("✓ /v1/models/switch returns load_profile")
+    else:
+        print("⚠️  Could not find /v1/models/switch response - profile only in metrics history")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_load_profiler'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl -X POST localhost:2020/v1/models/switch -d '{\"model\": \"moondream-2\"}'")
+    print("      and read load_profile.phases / load_profile.slowest_phase")
+    print("   3. disk_read needs delay accounting: sudo sysctl kernel.task_delayacct=1")
+
+    return True
+
+if __name__ == "__main__":
+    print("⏱️  Moondream Station - Model Load Profiler")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Patch to move /metrics collection onto a background sampler.
+
+Every /metrics call used to run psutil.cpu_percent, hw_monitor.get_gpus(),
+NVML queries and model_memory_tracker.get_loaded_models() inline on the same
+event loop that serves inference. With several StatusPage tabs polling this
+added latency to every caption request.
+
+This patch:
+1. Installs moondream_station/core/metrics_sampler.py - a daemon thread that
+   samples at a configurable rate into fixed-size ring buffers
+2. Makes /metrics (and the new /v1/metrics alias) return the latest snapshot
+3. Adds /v1/metrics/history?minutes=N&points=M with downsampled series
+4. Lets other subsystems add sections to the snapshot (register_provider)
+   and push one-off events such as model loads (record_event)
+
+Configuration (env or config.json):
+    MOONDREAM_METRICS_INTERVAL / metrics_interval_s          default 2.0
+    MOONDREAM_METRICS_RETENTION / metrics_retention_minutes  default 60
+
+Usage:
+    python3 patch_metrics_sampler.py
+"""
+
+import os
+import re
+import sys
+
+SAMPLER_MODULE = '''"""
+Background metrics sampler with ring-buffer history.
+
+The sampler thread is the only caller of the expensive collectors; HTTP
+handlers read self._latest, which is swapped atomically after each tick.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class RingBuffer:
+    """Fixed-size (timestamp, value) series."""
+
+    def __init__(self, capacity):
+        self.points = deque(maxlen=capacity)
+
+    def append(self, ts, value):
+        self.points.append((ts, value))
+
+    def since(self, cutoff):
+        return [p for p in self.points if p[0] >= cutoff]
+
+
+def downsample(points, start, end, buckets):
+    """Average/max per bucket so a 60 minute window renders as `buckets` points."""
+    if not points or buckets <= 0:
+        return []
+    width = max((end - start) / buckets, 1e-6)
+    out = []
+    current = None
+    total = count = 0
+    peak = None
+    for ts, value in points:
+        index = min(int((ts - start) / width), buckets - 1)
+        if current is not None and index != current:
+            out.append([round(start + (current + 0.5) * width, 3), round(total / count, 3), peak])
+            total = count = 0
+            peak = None
+        current = index
+        total += value
+        count += 1
+        peak = value if peak is None else max(peak, value)
+    if count:
+        out.append([round(start + (current + 0.5) * width, 3), round(total / count, 3), peak])
+    return out
+
+
+def collect_system_snapshot(hw_monitor, tracker):
+    """What /metrics used to compute inline on every request."""
+    import psutil
+
+    gpus = hw_monitor.get_gpus()
+    return {
+        "cpu": psutil.cpu_percent(interval=None),
+        "memory": psutil.virtual_memory().percent,
+        "device": gpus[0]["name"] if gpus else "CPU",
+        "gpus": gpus,
+        "environment": hw_monitor.get_environment_status(),
+        "loaded_models": tracker.get_loaded_models(),
+        "ghost_memory": tracker.get_ghost_status(),
+    }
+
+
+class MetricsSampler:
+    """Samples collect_fn every interval_s and keeps retention_minutes of history."""
+
+    EVENT_CAPACITY = 500
+
+    def __init__(self, collect_fn, interval_s=None, retention_minutes=None):
+        self.collect_fn = collect_fn
+        self.interval_s = float(interval_s or os.environ.get("MOONDREAM_METRICS_INTERVAL", 2.0))
+        self.retention_minutes = float(retention_minutes or os.environ.get("MOONDREAM_METRICS_RETENTION", 60))
+        self.capacity = max(10, int(self.retention_minutes * 60 / self.interval_s))
+        self.providers = {}
+        self.series = {}
+        self.events = {}
+        self._latest = {"cpu": 0, "memory": 0, "device": "Unknown", "gpus": [], "loaded_models": [], "sampled_at": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, interval_s=None, retention_minutes=None):
+        """Apply config.json values; only takes effect before start()."""
+        if interval_s:
+            self.interval_s = float(interval_s)
+        if retention_minutes:
+            self.retention_minutes = float(retention_minutes)
+        # Capacity follows the interval too, so retention stays in minutes
+        self.capacity = max(10, int(self.retention_minutes * 60 / self.interval_s))
+
+    def register_provider(self, name, fn):
+        """Add fn() as snapshot[name]; numeric top-level values are also kept as series."""
+        self.providers[name] = fn
+
+    def record_event(self, kind, payload):
+        """Store a one-off event (e.g. a model load breakdown) for the history endpoint."""
+        with self._lock:
+            buf = self.events.setdefault(kind, deque(maxlen=self.EVENT_CAPACITY))
+            buf.append({"ts": time.time(), **payload})
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+        self._thread.start()
+        print(f"[Metrics] Sampler started ({self.interval_s}s interval, {self.capacity} points)")
+
+    def stop(self):
+        self._stop.set()
+
+    def latest(self):
+        snapshot = self._latest
+        return {**snapshot, "sample_age_s": round(time.time() - snapshot.get("sampled_at", 0), 3)}
+
+    def sample_once(self):
+        started = time.perf_counter()
+        try:
+            snapshot = dict(self.collect_fn())
+        except Exception as e:
+            print(f"[Metrics] Error collecting metrics: {e}")
+            snapshot = {**self._latest}
+        for name, fn in list(self.providers.items()):
+            try:
+                snapshot[name] = fn()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        now = time.time()
+        snapshot["sampled_at"] = now
+        snapshot["sample_cost_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self._latest = snapshot
+        self._record_series(now, snapshot)
+        return snapshot
+
+    def history(self, minutes=15, points=120, series=None):
+        now = time.time()
+        start = now - float(minutes) * 60
+        wanted = set(series.split(",")) if isinstance(series, str) and series else None
+        with self._lock:
+            raw = {name: buf.since(start) for name, buf in self.series.items() if not wanted or name in wanted}
+            events = {kind: [e for e in buf if e["ts"] >= start] for kind, buf in self.events.items()}
+        return {
+            "interval_s": self.interval_s,
+            "window": {"start": start, "end": now, "minutes": minutes},
+            "series": {name: downsample(pts, start, now, int(points)) for name, pts in raw.items()},
+            "events": events,
+        }
+
+    def _push(self, now, name, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        buf = self.series.get(name)
+        if buf is None:
+            buf = self.series[name] = RingBuffer(self.capacity)
+        buf.append(now, value)
+
+    def _record_series(self, now, snapshot):
+        with self._lock:
+            self._push(now, "cpu", snapshot.get("cpu"))
+            self._push(now, "memory", snapshot.get("memory"))
+            for gpu in snapshot.get("gpus") or []:
+                gid = gpu.get("id", 0)
+                for key in ("load", "memory_used", "temperature"):
+                    self._push(now, f"gpu{gid}.{key}", gpu.get(key))
+            for model in snapshot.get("loaded_models") or []:
+                self._push(now, f"model.{model.get('id')}.vram_mb", model.get("vram_mb"))
+            ghost = snapshot.get("ghost_memory") or {}
+            self._push(now, "ghost_vram_mb", ghost.get("ghost_vram_mb"))
+            for name in self.providers:
+                section = snapshot.get(name)
+                if isinstance(section, dict):
+                    for key, value in section.items():
+                        self._push(now, f"{name}.{key}", value)
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.sample_once()
+            self._stop.wait(max(0.05, self.interval_s - (time.monotonic() - started)))
+'''
+
+SAMPLER_INSTANCE = '''# Global tracker instance
+model_memory_tracker = ModelMemoryTracker()
+model_memory_tracker.record_baseline()
+
+# Background sampler - /metrics reads its latest snapshot instead of polling hardware inline
+metrics_sampler = MetricsSampler(lambda: collect_system_snapshot(hw_monitor, model_memory_tracker))'''
+
+METRICS_ENDPOINTS = '''@self.app.get("/metrics")
+        @self.app.get("/v1/metrics")
+        async def metrics():
+            """Return the latest background sample (no hardware queries on the request path)"""
+            return metrics_sampler.latest()
+
+        @self.app.get("/v1/metrics/history")
+        async def metrics_history(minutes: float = 15, points: int = 120, series: str = None):
+            """Return downsampled [t, avg, max] series and events for the last N minutes"""
+            return metrics_sampler.history(minutes=minutes, points=points, series=series)'''
+
+ROUTER_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+    module_path = os.path.join(moondream_dir, "moondream_station/core/metrics_sampler.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(SAMPLER_MODULE)
+
+    if "metrics_sampler = MetricsSampler(" in content:
+        print("✅ Already patched - metrics sampler found")
+        return True
+
+    # 1. Import + global sampler next to the tracker instance
+    instance_hook = '''# Global tracker instance
+model_memory_tracker = ModelMemoryTracker()
+model_memory_tracker.record_baseline()'''
+    if instance_hook not in content:
+        print("❌ Could not find model_memory_tracker instance")
+        return False
+    content = content.replace(instance_hook, SAMPLER_INSTANCE)
+    content = content.replace(
+        '\n\n\nclass ModelMemoryTracker:',
+        '\nfrom .metrics_sampler import MetricsSampler, collect_system_snapshot\n\n\nclass ModelMemoryTracker:',
+        1,
+    )
+    print("✓ Added metrics_sampler instance")
+
+    # 2. Replace the inline /metrics handler (decorator through its fallback return)
+    pattern = re.compile(
+        r'@self\.app\.get\("/metrics"\)\s*\n\s*async def metrics\(\):.*?'
+        r'return \{"cpu": 0, "memory": 0, "device": "Unknown", "gpus": \[\], "loaded_models": \[\]\}',
+        re.DOTALL,
+    )
+    match = pattern.search(content)
+    if not match:
+        print("❌ Could not find /metrics handler")
+        return False
+    content = content.replace(match.group(0), METRICS_ENDPOINTS)
+    print("✓ /metrics, /v1/metrics and /v1/metrics/history now read the sampler")
+
+    # 3. Start the sampler with the server (config values override env defaults)
+    if ROUTER_ANCHOR in content:
+        line_start = content.rfind("\n", 0, content.find(ROUTER_ANCHOR)) + 1
+        indent = content[line_start:content.find(ROUTER_ANCHOR)]
+        injection = (
+            f"# Background metrics sampling\n"
+            f"{indent}metrics_sampler.configure(\n"
+            f"{indent}    interval_s=self.config.get(\"metrics_interval_s\"),\n"
+            f"{indent}    retention_minutes=self.config.get(\"metrics_retention_minutes\"),\n"
+            f"{indent})\n"
+            f"{indent}metrics_sampler.start()\n"
+            f"{indent}"
+        )
+        content = content.replace(ROUTER_ANCHOR, injection + ROUTER_ANCHOR, 1)
+        print("✓ Sampler starts during route setup")
+    else:
+        print("⚠️  Could not find router setup hook - add metrics_sampler.start() manually")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_sampler'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. curl http://localhost:2020/metrics   (check sample_age_s)")
+    print("   3. curl 'http://localhost:2020/v1/metrics/history?minutes=10&points=60'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🔧 Moondream Station - Background Metrics Sampler")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
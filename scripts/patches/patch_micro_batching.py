@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Patch to micro-batch concurrent caption calls into one forward pass.
+
+Only WD14 got batches, through /v1/vision/batch-caption. Captions from
+/v1/chat/completions ran one image per execute_function call even with
+five analysis tasks in flight from the frontend queue.
+
+This patch installs moondream_station/core/micro_batcher.py as the
+outermost wrapper of inference_service.execute_function:
+1. Single-image, non-streaming calls of a batchable function (config
+   "micro_batch_functions", default ["caption"]) are grouped by active
+   model + function + identical settings for up to
+   "micro_batch_window_ms" (default 5) or "micro_batch_max_size" (default 8)
+2. A group runs as one execute_function(image=[...]) call - the same list
+   form WD14 already accepts - and the results are fanned back out
+3. Backends that do not take lists are detected on the first batch: one
+   that raises or returns something other than one result per image marks
+   the model as not batchable, its calls are replayed one by one and it is
+   never batched again. A manifest "supports_batch" value skips the probe
+4. Once a model has batched, a batch that raises is replayed per request,
+   so one bad image fails only its own request; the model stays batchable
+5. /metrics "micro_batching": batch-size and wait-time histograms
+
+With patch_batch_contract.py installed, only backends with native batching
+are grouped - in practice WD14 tagging, not the moondream / JoyCaption /
+Florence captions, which would only loop over the list.
+
+Set micro_batch_max_size to 1 to disable.
+
+Requires: patch_load_profiler.py
+
+Usage:
+    python3 patch_micro_batching.py
+"""
+
+import os
+import sys
+
+BATCHER_MODULE = '''"""
+Dynamic micro-batching in front of InferenceService.execute_function.
+
+One batch = one call to the wrapped execute_function, so the VRAM
+attribution and load profiler wrappers see (and measure) the batch once.
+"""
+
+import asyncio
+import collections
+import functools
+import time
+
+DEFAULT_WINDOW_MS = 5.0
+DEFAULT_MAX_SIZE = 8
+DEFAULT_FUNCTIONS = ("caption",)
+WAIT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+def _freeze(value):
+    """Hashable form of a settings value (dicts / lists from request JSON)."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class _Pending:
+    def __init__(self, kwargs):
+        self.kwargs = kwargs  # the first caller's settings objects (the key holds frozen copies)
+        self.items = []  # (image, future, enqueued_at)
+        self.timer = None
+
+
+class MicroBatcher:
+    def __init__(self, service, config=None, manifest_manager=None):
+        self.service = service
+        self.config = config
+        self.manifest_manager = manifest_manager
+        self.batchable = {}  # model_id -> True / False once known
+        self.stats = {"requests": 0, "batched_requests": 0, "batches": 0, "fallbacks": 0, "passthrough": 0}
+        self.size_hist = collections.Counter()
+        self.wait_hist = collections.Counter()
+        self.waits_ms = collections.deque(maxlen=1000)
+        self._pending = {}
+        self._original = None
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def max_size(self):
+        return int(self._setting("micro_batch_max_size", DEFAULT_MAX_SIZE))
+
+    def _model_batchable(self, model_id, function_name):
+        contract = getattr(self.service, "batch_support", None)
+        if contract is not None:
+            # batch_contract.py: only native batching gains from grouping; loops would not
+            return contract(function_name)["native"]
+        if model_id in self.batchable:
+            return self.batchable[model_id]
+        info = self.manifest_manager.get_models().get(model_id) if self.manifest_manager else None
+        declared = info.get("supports_batch") if isinstance(info, dict) else getattr(info, "supports_batch", None)
+        if declared is not None:
+            self.batchable[model_id] = bool(declared)
+            return bool(declared)
+        return None  # unknown: probe with the first real batch
+
+    def _batch_key(self, function_name, args, kwargs):
+        if args or self.max_size() <= 1 or kwargs.get("stream"):
+            return None
+        if function_name not in self._setting("micro_batch_functions", DEFAULT_FUNCTIONS):
+            return None
+        image = kwargs.get("image")
+        if image is None or isinstance(image, (list, tuple)):
+            return None
+        model_id = self.config.get("current_model") if self.config else None
+        if model_id is None or self._model_batchable(model_id, function_name) is False:
+            return None
+        settings = tuple(sorted((k, _freeze(v)) for k, v in kwargs.items() if k != "image"))
+        return (model_id, function_name, settings)
+
+    def attach(self):
+        if getattr(self.service, "_micro_batcher_installed", False):
+            return
+        self.service._micro_batcher_installed = True
+        original = self._original = self.service.execute_function
+
+        @functools.wraps(original)
+        async def execute_function(function_name, *args, **kwargs):
+            key = self._batch_key(function_name, args, kwargs)
+            if key is None:
+                self.stats["passthrough"] += 1
+                return await original(function_name, *args, **kwargs)
+            return await self._submit(key, kwargs)
+
+        self.service.execute_function = execute_function
+
+    async def _submit(self, key, kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _Pending({k: v for k, v in kwargs.items() if k != "image"})
+            window = float(self._setting("micro_batch_window_ms", DEFAULT_WINDOW_MS)) / 1000.0
+            pending.timer = loop.call_later(window, self._flush, key)
+        pending.items.append((kwargs["image"], future, time.perf_counter()))
+        self.stats["requests"] += 1
+        if len(pending.items) >= self.max_size():
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        pending.timer.cancel()
+        asyncio.get_running_loop().create_task(self._run(key, pending))
+
+    async def _run(self, key, pending):
+        model_id, function_name, _ = key
+        items, kwargs = pending.items, pending.kwargs
+        started = time.perf_counter()
+        for _, _, enqueued in items:
+            self._record_wait((started - enqueued) * 1000.0)
+        self.size_hist[len(items)] += 1
+        self.stats["batches"] += 1
+
+        if len(items) == 1:
+            image, future, _ = items[0]
+            await self._run_one(function_name, image, kwargs, future)
+            return
+
+        self.stats["batched_requests"] += len(items)
+        try:
+            results = await self._original(function_name, image=[image for image, _, _ in items], **kwargs)
+        except Exception as e:
+            if self.batchable.get(model_id) is None:
+                # The probe raised: most likely the backend does not take a list
+                self.batchable[model_id] = False
+            # Otherwise possibly one bad image: replay singly, but keep batching for the next group
+            print(f"[MicroBatch] Batch of {len(items)} failed on {model_id}, replaying singly: {e}")
+            await self._replay(function_name, items, kwargs)
+            return
+        if not isinstance(results, (list, tuple)) or len(results) != len(items):
+            # Only a wrong-shaped answer shows the model does not batch
+            if self.batchable.get(model_id) is None:
+                self.batchable[model_id] = False
+            print(f"[MicroBatch] {model_id} does not take batched {function_name} "
+                  f"({type(results).__name__}, not a list of {len(items)}); running singly")
+            await self._replay(function_name, items, kwargs)
+            return
+
+        self.batchable[model_id] = True
+        for (_, future, _), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _replay(self, function_name, items, kwargs):
+        self.stats["fallbacks"] += 1
+        for image, future, _ in items:
+            await self._run_one(function_name, image, kwargs, future)
+
+    async def _run_one(self, function_name, image, kwargs, future):
+        try:
+            result = await self._original(function_name, image=image, **kwargs)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def _record_wait(self, wait_ms):
+        self.waits_ms.append(wait_ms)
+        bucket = next((b for b in WAIT_BUCKETS_MS if wait_ms <= b), None)
+        self.wait_hist[f"le_{bucket}ms" if bucket is not None else f"gt_{WAIT_BUCKETS_MS[-1]}ms"] += 1
+
+    def summary(self):
+        waits = list(self.waits_ms)
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "mean_batch_size": round(self.stats["requests"] / batches, 2) if batches else None,
+            "wait_p50_ms": round(_percentile(waits, 50), 2) if waits else None,
+            "wait_p95_ms": round(_percentile(waits, 95), 2) if waits else None,
+            "batch_size_hist": {str(size): n for size, n in sorted(self.size_hist.items())},
+            "wait_ms_hist": dict(self.wait_hist),
+            "batchable": dict(self.batchable),
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .load_profiler import LoadProfiler, instrument_load_profiler',
+        'from .load_profiler import LoadProfiler, instrument_load_profiler\n'
+        'from .micro_batcher import MicroBatcher',
+    ),
+    (
+        "attach",
+        '''        instrument_load_profiler(self.inference_service, load_profiler)''',
+        '''        instrument_load_profiler(self.inference_service, load_profiler)
+        # Outermost: a micro-batch is one execute_function call for the wrappers above
+        self.micro_batcher = MicroBatcher(self.inference_service, self.config, self.manifest_manager)
+        self.micro_batcher.attach()
+        metrics_sampler.register_provider("micro_batching", self.micro_batcher.summary)''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "micro_batcher.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(BATCHER_MODULE)
+
+    if "from .micro_batcher import" in content:
+        print("✅ Already patched - micro-batcher found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_load_profiler.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_micro_batching'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: micro_batch_window_ms, micro_batch_max_size, micro_batch_functions")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/metrics | jq .micro_batching")
+
+    return True
+
+if __name__ == "__main__":
+    print("📦 Moondream Station - Caption Micro-Batching")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Patch to load safetensors weights zero-copy from memory-mapped files.
+
+export_checkpoints.sh produces multi-GB single-file SDXL checkpoints and
+export_vision_models.py lays out moondream / NSFW / WD14 / Florence-2
+weights under models/backends/*/weights. safetensors.torch.load_file()
+reads each tensor into a freshly allocated CPU tensor, so a 6.5GB
+checkpoint costs 6.5GB of anonymous RSS before anything reaches the GPU.
+
+This patch installs moondream_station/core/mmap_loader.py:
+1. Parses the safetensors header itself and builds every tensor with
+   torch.frombuffer() over a private (copy-on-write) mmap of the file, so
+   tensors are views of page-cache pages - nothing is copied until .to(cuda)
+2. One mapping per file in the process (weak registry): backends opening
+   the same file share it; other processes share the pages via the page cache
+3. Replaces safetensors.torch.load_file / safe_open for CPU loads
+   (transformers, diffusers and backends that import them directly).
+   GPU-targeted or non-"pt" calls go to the original implementation
+4. Refreshes load_profiler.py, which now reports per load:
+   cache (cold/warm page cache), peak_rss_mb / peak_rss_delta_mb, and keeps
+   the latest cold and warm load time per model
+
+Set MOONDREAM_MMAP_LOADING=0 to disable.
+
+Requires: patch_load_profiler.py
+
+Usage:
+    python3 patch_mmap_loader.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_load_profiler import PROFILER_MODULE  # noqa: E402
+
+MMAP_MODULE = '''"""
+Zero-copy safetensors loading.
+
+File layout: 8-byte little-endian header length N, N bytes of JSON
+{name: {dtype, shape, data_offsets: [begin, end]}, "__metadata__": {...}},
+then the raw tensor bytes. Offsets are relative to the end of the header.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import weakref
+
+_DTYPES = {
+    "F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+    "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8", "U8": "uint8",
+    "BOOL": "bool", "F8_E4M3": "float8_e4m3fn", "F8_E5M2": "float8_e5m2",
+}
+
+_mappings = weakref.WeakValueDictionary()  # (realpath, size, mtime_ns) -> mmap
+_lock = threading.Lock()
+_stats = {"files_mapped": 0, "mapping_reuses": 0, "tensors": 0, "bytes_mapped": 0, "fallbacks": 0}
+_originals = {}
+
+
+def _torch_dtype(name):
+    import torch
+    dtype = getattr(torch, _DTYPES.get(name, ""), None)
+    if dtype is None:
+        raise ValueError(f"unsupported safetensors dtype {name}")
+    return dtype
+
+
+def _map_file(path):
+    """Shared copy-on-write mapping of path; in-place writes never reach the file."""
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    key = (real, st.st_size, st.st_mtime_ns)
+    with _lock:
+        mapped = _mappings.get(key)
+        if mapped is not None:
+            _stats["mapping_reuses"] += 1
+            return mapped, True
+        with open(real, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            mapped.madvise(mmap.MADV_WILLNEED)
+        except (AttributeError, OSError):
+            pass
+        _mappings[key] = mapped
+        _stats["files_mapped"] += 1
+        _stats["bytes_mapped"] += st.st_size
+        return mapped, False
+
+
+class MappedSafetensors:
+    """Header + mapping of one safetensors file; tensors are views of the pages."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mapped, self.shared = _map_file(path)
+        (header_len,) = struct.unpack("<Q", self.mapped[:8])
+        header = json.loads(self.mapped[8:8 + header_len])
+        self.metadata_dict = header.pop("__metadata__", None)  # None when absent, like safe_open
+        self.entries = header
+        self.data_start = 8 + header_len
+        _note_profile(path, self.shared)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def metadata(self):
+        return None if self.metadata_dict is None else dict(self.metadata_dict)
+
+    def get_tensor(self, name):
+        import torch
+        info = self.entries[name]
+        dtype = _torch_dtype(info["dtype"])
+        shape = info["shape"]
+        begin, end = info["data_offsets"]
+        _stats["tensors"] += 1
+        if end == begin:
+            return torch.empty(shape, dtype=dtype)
+        offset = self.data_start + begin
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        if offset % itemsize:
+            # Misaligned entry: frombuffer needs element alignment, copy just this one
+            return torch.frombuffer(bytearray(self.mapped[offset:self.data_start + end]), dtype=dtype).reshape(shape)
+        count = (end - begin) // itemsize
+        return torch.frombuffer(self.mapped, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def get_slice(self, name):
+        return _MappedSlice(self, name)
+
+    def load_all(self):
+        return {name: self.get_tensor(name) for name in self.entries}
+
+
+class _MappedSlice:
+    """Subset of safetensors' PySafeSlice used by transformers."""
+
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+    def get_shape(self):
+        return list(self.source.entries[self.name]["shape"])
+
+    def get_dtype(self):
+        return self.source.entries[self.name]["dtype"]
+
+    def __getitem__(self, index):
+        return self.source.get_tensor(self.name)[index]
+
+
+class _MappedSafeOpen:
+    """Context manager with the safe_open(framework="pt", device="cpu") surface."""
+
+    def __init__(self, path):
+        self._file = MappedSafetensors(path)
+
+    def __enter__(self):
+        return self._file
+
+    def __exit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _note_profile(path, shared):
+    """Tell the active load profile which weight files were mapped (and shared)."""
+    profiler = sys.modules.get(__package__ + ".load_profiler") if __package__ else None
+    profile = getattr(profiler, "_active", None)
+    if profile is not None:
+        profile.extra.setdefault("mmap_files", []).append({"path": str(path), "shared_mapping": shared})
+
+
+def _is_cpu(device):
+    return device is None or str(device) == "cpu"
+
+
+def load_file(filename, device="cpu"):
+    if not _is_cpu(device):
+        return _originals["load_file"](filename, device=device)
+    try:
+        return MappedSafetensors(filename).load_all()
+    except Exception as e:
+        _stats["fallbacks"] += 1
+        print(f"[MmapLoader] Falling back to safetensors for {filename}: {e}")
+        return _originals["load_file"](filename, device=device)
+
+
+def safe_open(filename, framework="pt", device="cpu"):
+    if framework not in ("pt", "torch") or not _is_cpu(device):
+        return _originals["safe_open"](filename, framework=framework, device=device)
+    try:
+        return _MappedSafeOpen(filename)
+    except Exception as e:
+        _stats["fallbacks"] += 1
+        print(f"[MmapLoader] Falling back to safetensors for {filename}: {e}")
+        return _originals["safe_open"](filename, framework=framework, device=device)
+
+
+def install_mmap_loading():
+    """Route CPU safetensors loads through the mmap loader. Returns True if installed."""
+    if os.environ.get("MOONDREAM_MMAP_LOADING", "1") == "0" or _originals:
+        return bool(_originals)
+    try:
+        import safetensors
+        import safetensors.torch as st
+    except ImportError:
+        return False
+    _originals["load_file"] = st.load_file
+    _originals["safe_open"] = safetensors.safe_open
+    st.load_file = load_file
+    safetensors.safe_open = safe_open
+    # Modules that bound the names at import time
+    for module_name in ("transformers.modeling_utils", "diffusers.models.model_loading_utils"):
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        if getattr(module, "safe_load_file", None) is _originals["load_file"]:
+            module.safe_load_file = load_file
+        if getattr(module, "safe_open", None) is _originals["safe_open"]:
+            module.safe_open = safe_open
+    print("[MmapLoader] safetensors CPU loads are memory-mapped (zero-copy)")
+    return True
+
+
+def stats():
+    return {**_stats, "open_mappings": len(_mappings), "enabled": bool(_originals)}
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .load_profiler import LoadProfiler, instrument_load_profiler',
+        'from .load_profiler import LoadProfiler, instrument_load_profiler\n'
+        'from .mmap_loader import install_mmap_loading, stats as mmap_loader_stats',
+    ),
+    (
+        "install",
+        '''metrics_sampler.register_provider("load_profiles", load_profiler.summary)''',
+        '''metrics_sampler.register_provider("load_profiles", load_profiler.summary)
+
+# Zero-copy safetensors: CPU loads become views of mmapped, page-cache-shared files
+install_mmap_loading()
+metrics_sampler.register_provider("mmap_loader", mmap_loader_stats)''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("mmap_loader.py", MMAP_MODULE), ("load_profiler.py", PROFILER_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .mmap_loader import" in content:
+        print("✅ Already patched - mmap loader found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_load_profiler.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_mmap_loader'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. Switch to a model twice; compare load_profile.cache / total_seconds / peak_rss_mb")
+    print("   3. Cold run: sync; echo 3 | sudo tee /proc/sys/vm/drop_caches")
+    print("   4. curl http://localhost:2020/v1/metrics | jq '.mmap_loader, .load_profiles'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🗺️  Moondream Station - Memory-Mapped Safetensors Loader")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
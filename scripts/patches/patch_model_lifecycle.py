@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Patch to unload idle models after a TTL and warm up the likely next model.
+
+Models stayed loaded until /v1/system/unload or a switch evicted them, so
+VRAM sat on models nobody had used for an hour, while the model the next
+request needed was cold-loaded in front of it.
+
+This patch installs moondream_station/core/model_lifecycle.py:
+1. IdleReaper - background task that demotes models idle longer than their
+   TTL: GPU -> host RAM (when parking is on) -> unloaded. TTL per model from
+   the manifest entry ("idle_ttl_s"), config "model_idle_ttl_s" (a number
+   for every model or {model_id: seconds}), default 900s; 0 disables.
+   Parked models get parked_ttl_factor x TTL (config, default 4).
+   Models with requests in flight or queued are never reaped
+2. WarmupPredictor - learns model-to-model transitions from the request
+   stream (e.g. nsfw-detector bursts followed by wd14-tagger when a bulk
+   upload is analysed). Once a burst of X starts and X -> Y has been seen
+   often enough, Y is loaded in the next gap between requests - but only if
+   it fits the residency budget without evicting anything. The warm-up is
+   admitted through the affinity scheduler at background priority and only
+   while the served model is idle, so it never delays a live request; the
+   previous model stays resident and switching back is a reattach
+3. ModelMemoryTracker keeps per-model lifecycle counters (idle unloads,
+   warm-ups, TTL); /metrics gets "idle_reaper" and "warmup" sections and
+   model_idle_unload / model_warmup events in /v1/metrics/history
+
+Config: model_idle_ttl_s, parked_ttl_factor, idle_reap_interval_s (30),
+        warmup_enabled (true), warmup_min_probability (0.6),
+        warmup_min_observations (3)
+
+Requires: patch_affinity_scheduler.py
+
+Usage:
+    python3 patch_model_lifecycle.py
+"""
+
+import os
+import sys
+
+LIFECYCLE_MODULE = '''"""
+Idle-TTL reaping and transition-based warm-up on top of ResidencyManager.
+
+Both run on the event loop. The reaper checks the coordinator and scheduler
+under the coordinator's condition and marks the model as reaping, so a
+request for it waits for the eviction instead of racing it; the condition
+itself is not held while the copy / unload runs. Warm-ups go through the
+scheduler like any request.
+"""
+
+import asyncio
+import collections
+import time
+
+from .affinity_scheduler import PRIORITY_NAMES
+
+DEFAULT_IDLE_TTL_S = 900.0
+DEFAULT_PARKED_TTL_FACTOR = 4.0
+DEFAULT_REAP_INTERVAL_S = 30.0
+DEFAULT_MIN_PROBABILITY = 0.6
+DEFAULT_MIN_OBSERVATIONS = 3
+BURST_WINDOW_S = 60.0
+BURST_MIN_REQUESTS = 2
+WARMUP_GAP_TIMEOUT_S = 60.0
+TRANSITION_DECAY_AT = 200  # halve a row's counts once it reaches this total
+
+
+def _manifest_value(info, key):
+    if info is None:
+        return None
+    if isinstance(info, dict):
+        return info.get(key)
+    return getattr(info, key, None)
+
+
+def _setting(config, key, default):
+    value = config.get(key) if config else None
+    return default if value is None else value
+
+
+class _Lifecycle:
+    """Shared access to the coordinator / scheduler / residency state."""
+
+    def __init__(self, residency, coordinator, scheduler, manifest_manager, config, sampler=None):
+        self.residency = residency
+        self.coordinator = coordinator
+        self.scheduler = scheduler
+        self.manifest_manager = manifest_manager
+        self.config = config
+        self.sampler = sampler
+
+    def _busy(self, model_id=None):
+        """Anything in flight (model_id=None), or requests queued / running on model_id."""
+        return self.coordinator.is_busy(model_id) or self.scheduler.is_busy(model_id)
+
+    def _track(self, model_id, event, **detail):
+        tracker = self.residency.tracker
+        if hasattr(tracker, "record_lifecycle"):
+            tracker.record_lifecycle(model_id, event, **detail)
+        if self.sampler is not None:
+            self.sampler.record_event(f"model_{event}", {"model": model_id, **detail})
+
+
+class IdleReaper(_Lifecycle):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {"passes": 0, "parked": 0, "unloaded": 0, "skipped_busy": 0}
+        self._task = None
+
+    def ttl_s(self, model_id):
+        """Manifest idle_ttl_s, else config model_idle_ttl_s (number or per-model map)."""
+        info = self.manifest_manager.get_models().get(model_id)
+        ttl = _manifest_value(info, "idle_ttl_s")
+        if ttl is None:
+            configured = _setting(self.config, "model_idle_ttl_s", DEFAULT_IDLE_TTL_S)
+            ttl = configured.get(model_id, DEFAULT_IDLE_TTL_S) if isinstance(configured, dict) else configured
+        return float(ttl)
+
+    def _expired(self, entry, now):
+        ttl = self.ttl_s(entry.model_id)
+        if ttl <= 0:
+            return False
+        if entry.tier == "parked":
+            ttl *= float(_setting(self.config, "parked_ttl_factor", DEFAULT_PARKED_TTL_FACTOR))
+        return now - entry.last_used >= ttl
+
+    async def reap_once(self):
+        cond = self.coordinator._condition()
+        loop = asyncio.get_running_loop()
+        self.stats["passes"] += 1
+        now = time.time()
+        for entry in list(self.residency.resident.values()):
+            if not self._expired(entry, now):
+                continue
+            model_id = entry.model_id
+            async with cond:
+                if self._busy(model_id):
+                    self.stats["skipped_busy"] += 1
+                    continue
+                # Requests for model_id now wait in acquire() until end_reap()
+                self.coordinator.begin_reap(model_id)
+            tier = entry.tier
+            idle_s = round(now - entry.last_used)
+            try:
+                await loop.run_in_executor(None, self._evict, model_id)
+            finally:
+                await self.coordinator.end_reap(model_id)
+            demoted_to = self.residency.tier(model_id)
+            self.stats["parked" if demoted_to == "parked" else "unloaded"] += 1
+            self._track(model_id, "idle_unload", from_tier=tier, to_tier=demoted_to,
+                        idle_s=idle_s, ttl_s=self.ttl_s(model_id))
+
+    def _evict(self, model_id):
+        """Worker thread. The active model goes through the coordinator, which clears
+        current_model in the same step."""
+        if model_id == self.residency.active:
+            self.coordinator.evict_active(model_id, "idle-ttl")
+        else:
+            self.residency.evict(model_id, "idle-ttl")
+
+    async def run(self):
+        interval = float(_setting(self.config, "idle_reap_interval_s", DEFAULT_REAP_INTERVAL_S))
+        print(f"[Lifecycle] Idle reaper every {interval:.0f}s")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap_once()
+            except Exception as e:
+                print(f"[Lifecycle] Idle reap failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def summary(self):
+        now = time.time()
+        return {
+            **self.stats,
+            "models": {
+                e.model_id: {
+                    "tier": e.tier,
+                    "idle_s": round(now - e.last_used),
+                    "ttl_s": self.ttl_s(e.model_id),
+                }
+                for e in list(self.residency.resident.values())
+            },
+        }
+
+
+class WarmupPredictor(_Lifecycle):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transitions = collections.defaultdict(collections.Counter)  # from -> Counter(to)
+        self.recent = collections.deque(maxlen=200)  # (time, model_id)
+        self.last_model = None
+        self.stats = {
+            "observed": 0, "predictions": 0, "prediction_hits": 0, "warmups": 0,
+            "skipped_warm": 0, "skipped_no_room": 0, "skipped_busy": 0,
+        }
+        self._run_warmed = False  # one warm-up per run of the same model
+        self._pending = {}  # predicted model -> predicted_at, for hit accounting
+        self._next = None  # (target, after) - the latest prediction wins
+        self._task = None
+
+    def enabled(self):
+        return bool(_setting(self.config, "warmup_enabled", True))
+
+    def observe(self, model_id):
+        """Record a request for model_id; may schedule a warm-up of the predicted next model."""
+        now = time.time()
+        self.stats["observed"] += 1
+        self.recent.append((now, model_id))
+        if self._pending.pop(model_id, None) is not None:
+            self.stats["prediction_hits"] += 1
+        if model_id != self.last_model:
+            if self.last_model is not None:
+                row = self.transitions[self.last_model]
+                row[model_id] += 1
+                if sum(row.values()) >= TRANSITION_DECAY_AT:
+                    for key in list(row):
+                        row[key] //= 2
+            self.last_model = model_id
+            self._run_warmed = False
+
+        if self._run_warmed or not self.enabled():
+            return None
+        burst = sum(1 for ts, m in self.recent if m == model_id and now - ts <= BURST_WINDOW_S)
+        if burst < BURST_MIN_REQUESTS:
+            return None
+        target = self.predict(model_id)
+        if target is None:
+            return None
+        self._run_warmed = True
+        self.stats["predictions"] += 1
+        self._pending[target] = now
+        self._next = (target, model_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._warm())
+        return target
+
+    def predict(self, model_id):
+        row = self.transitions.get(model_id)
+        if not row:
+            return None
+        target, count = row.most_common(1)[0]
+        total = sum(row.values())
+        min_p = float(_setting(self.config, "warmup_min_probability", DEFAULT_MIN_PROBABILITY))
+        min_n = int(_setting(self.config, "warmup_min_observations", DEFAULT_MIN_OBSERVATIONS))
+        if count < min_n or count / total < min_p:
+            return None
+        return target
+
+    def _fits(self, model_id):
+        budget = self.residency.budget_mb()
+        return budget is not None and self.residency.used_mb() + self.residency.admission_mb(model_id) <= budget
+
+    def _skip_reason(self, target):
+        if self.residency.tier(target) == "gpu":
+            return "skipped_warm"
+        if not self._fits(target):
+            return "skipped_no_room"
+        return None
+
+    async def _warm(self):
+        """Load the predicted model once the served model goes idle, as a background request."""
+        target, after = self._next
+        self._next = None
+        if target not in self.manifest_manager.get_models():
+            return  # external residents (SDXL) load themselves
+        skip = self._skip_reason(target)
+        if skip:
+            self.stats[skip] += 1
+            return
+        scope = self.coordinator.open_scope()
+        try:
+            try:
+                # Admission only: a timeout here must not cancel a switch already running
+                await asyncio.wait_for(
+                    self.scheduler.acquire(target, PRIORITY_NAMES["background"], external=True, idle_only=True),
+                    WARMUP_GAP_TIMEOUT_S,
+                )
+            except asyncio.TimeoutError:
+                self.stats["skipped_busy"] += 1
+                return
+            skip = self._skip_reason(target)  # the picture may have changed while waiting
+            if skip:
+                self.stats[skip] += 1
+                return
+            started = time.perf_counter()
+            await self.coordinator.acquire(target)
+        except Exception as e:
+            print(f"[Lifecycle] Warm-up of {target} failed: {e}")
+            return
+        finally:
+            await self.coordinator.close_scope(scope)
+        self.stats["warmups"] += 1
+        seconds = round(time.perf_counter() - started, 3)
+        print(f"[Lifecycle] Warmed up {target} after {after} burst ({seconds}s)")
+        self._track(target, "warmup", after=after, seconds=seconds)
+
+    def summary(self):
+        return {
+            **self.stats,
+            "last_model": self.last_model,
+            "predicted_next": self.predict(self.last_model) if self.last_model else None,
+            "transitions": {src: dict(row) for src, row in self.transitions.items()},
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .affinity_scheduler import AffinityScheduler',
+        'from .affinity_scheduler import AffinityScheduler\n'
+        'from .model_lifecycle import IdleReaper, WarmupPredictor',
+    ),
+    (
+        "tracker state",
+        '''        self.model_states = {}  # model_id -> "gpu" | "parked"; other known models are "cold"''',
+        '''        self.model_states = {}  # model_id -> "gpu" | "parked"; other known models are "cold"
+        self.lifecycle = {}  # model_id -> idle unload / warm-up counters''',
+    ),
+    (
+        "tracker methods",
+        '''    def get_model_states(self):''',
+        '''    def record_lifecycle(self, model_id: str, event: str, **detail):
+        """Idle-TTL unloads and predictive warm-ups (model_lifecycle.py)"""
+        stats = self.lifecycle.setdefault(model_id, {"idle_unloads": 0, "warmups": 0})
+        key = {"idle_unload": "idle_unloads", "warmup": "warmups"}.get(event, event)
+        stats[key] = stats.get(key, 0) + 1
+        stats[f"last_{event}"] = {"at": time.time(), **detail}
+
+    def get_lifecycle(self):
+        return {model_id: dict(stats) for model_id, stats in self.lifecycle.items()}
+
+    def get_model_states(self):''',
+    ),
+    (
+        "lifecycle setup",
+        '''        metrics_sampler.register_provider("scheduler", self.affinity_scheduler.summary)''',
+        '''        metrics_sampler.register_provider("scheduler", self.affinity_scheduler.summary)
+        lifecycle_args = (
+            residency_manager, self.switch_coordinator, self.affinity_scheduler,
+            self.manifest_manager, self.config, metrics_sampler,
+        )
+        self.idle_reaper = IdleReaper(*lifecycle_args)
+        self.warmup_predictor = WarmupPredictor(*lifecycle_args)
+        metrics_sampler.register_provider("idle_reaper", self.idle_reaper.summary)
+        metrics_sampler.register_provider(
+            "warmup", lambda: {**self.warmup_predictor.summary(), "models": model_memory_tracker.get_lifecycle()}
+        )
+
+        @self.app.on_event("startup")
+        async def start_idle_reaper():
+            self.idle_reaper.start()''',
+    ),
+    (
+        "generate observe",
+        '''                        "sdxl-base", request.headers.get("X-Priority"), external=True
+                    )''',
+        '''                        "sdxl-base", request.headers.get("X-Priority"), external=True
+                    )
+                    self.warmup_predictor.observe("sdxl-base")''',
+    ),
+    (
+        "chat observe",
+        '''                raise HTTPException(status_code=500, detail=f"Failed to switch to model {target_model}")
+            current_model = target_model''',
+        '''                raise HTTPException(status_code=500, detail=f"Failed to switch to model {target_model}")
+            current_model = target_model
+            self.warmup_predictor.observe(target_model)''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "model_lifecycle.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(LIFECYCLE_MODULE)
+
+    if "from .model_lifecycle import" in content:
+        print("✅ Already patched - model lifecycle found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_host_parking.py and patch_affinity_scheduler.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_model_lifecycle'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional: \"idle_ttl_s\" per model in local_manifest.json, or config model_idle_ttl_s")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/metrics | jq '.idle_reaper, .warmup'")
+
+    return True
+
+if __name__ == "__main__":
+    print("⏳ Moondream Station - Idle TTL Unloading & Predictive Warm-up")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
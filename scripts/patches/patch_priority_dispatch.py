@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Patch to run inference calls in X-Priority order, with preemption between
+batches.
+
+The affinity scheduler (patch_affinity_scheduler.py) orders *models* by
+priority, but once requests for the served model are admitted they reach
+the backend first-come first-served. A user clicking "regenerate caption"
+waits behind every bulk-upload batch already queued on that model.
+
+This patch installs moondream_station/core/priority_dispatch.py in front of
+inference_service.execute_function:
+1. Every request carries a priority: X-Priority header (or ?priority=),
+   0=background, 1=preload, 2=interactive, 3=immediate (types/queue.ts),
+   or a name like "interactive". Admission through the scheduler also sets it
+   from the request's "priority" field. Default 1
+2. At most "dispatch_slots" calls run at once (default: the service's
+   worker count, so every worker stays busy); the rest wait in one queue,
+   highest priority first, arrival order within a priority
+3. Image lists longer than "preempt_batch_size" (default 8, 0 = never
+   split) are run in chunks. At each chunk boundary the batch keeps its slot
+   unless a higher-priority call is waiting; then that call runs first and
+   the batch resumes with its original place in line. Calls of the same or
+   lower priority never interleave with it. Results are joined, so callers
+   see one list
+4. Sits inside the micro-batcher and the result cache (a micro-batch is one
+   call, cache hits never queue) and outside the timing wrappers (queue wait
+   is not reported as inference time). A micro-batch runs at the priority of
+   the request that flushed it
+5. /metrics "dispatch": queue wait p50 / p95 per priority, preemptions
+   (batches paused at a boundary), overtakes (calls served before older
+   lower-priority work), chunks; the scheduler also reports admission wait
+   per priority
+
+Requests for another model still wait for the served model's in-flight
+requests (see patch_switch_coordinator.py).
+
+Requires: patch_affinity_scheduler.py, patch_micro_batching.py
+
+Usage:
+    python3 patch_priority_dispatch.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_affinity_scheduler import SCHEDULER_MODULE  # noqa: E402
+
+DISPATCH_MODULE = '''"""
+Priority-ordered dispatch of execute_function calls.
+"""
+
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import time
+
+from .affinity_scheduler import PRIORITY_LABELS, current_priority, parse_priority, wait_summary
+
+DEFAULT_PREEMPT_BATCH = 8
+SERVICE_EWMA = 0.2
+
+
+class PriorityDispatcher:
+    def __init__(self, service, config=None):
+        self.service = service
+        self.config = config
+        self.waiting = []  # heap of [-priority, seq, future]
+        self.active = 0
+        self.waits_ms = {p: collections.deque(maxlen=500) for p in range(len(PRIORITY_LABELS))}
+        self.stats = collections.Counter()
+        self.service_ms = {}  # model_id -> {"call": ms, "image": ms} (EWMA)
+        self._seq = itertools.count()
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def worker_count(self):
+        """Calls the service runs at once: its worker pool size, else its backend count."""
+        workers = getattr(getattr(self.service, "worker_pool", None), "n_workers", None)
+        return workers or len(getattr(self.service, "worker_backends", None) or []) or 1
+
+    def slots(self):
+        return max(1, int(self._setting("dispatch_slots", self.worker_count())))
+
+    def chunk_size(self):
+        return int(self._setting("preempt_batch_size", DEFAULT_PREEMPT_BATCH))
+
+    async def _acquire(self, priority, seq):
+        started = time.monotonic()
+        if self.active < self.slots() and not self.waiting:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, [-priority, seq, future])
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # granted just before the cancel: pass the slot on
+                raise
+        self.waits_ms[priority].append((time.monotonic() - started) * 1000.0)
+
+    async def _checkpoint(self, priority, seq):
+        """Batch boundary: keep the slot unless a more urgent call is waiting."""
+        while self.waiting and self.waiting[0][2].done():
+            heapq.heappop(self.waiting)
+        if not self.waiting or self.waiting[0][:2] > [-priority, seq]:
+            return
+        self.stats["preemptions"] += 1
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, [-priority, seq, future])
+        self._release()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        self.waits_ms[priority].append((time.monotonic() - started) * 1000.0)
+
+    def _observe(self, started, images):
+        """Service time of one backend call on the current model."""
+        model_id = self.config.get("current_model") if self.config else None
+        if model_id is None:
+            return
+        call_ms = (time.perf_counter() - started) * 1000.0
+        sample = {"call": call_ms, "image": call_ms / max(1, images)}
+        previous = self.service_ms.get(model_id)
+        if previous is not None:
+            sample = {k: previous[k] + SERVICE_EWMA * (v - previous[k]) for k, v in sample.items()}
+        self.service_ms[model_id] = sample
+
+    def waiting_count(self, min_priority=0):
+        return sum(1 for entry in self.waiting if not entry[2].done() and -entry[0] >= min_priority)
+
+    def estimated_wait_ms(self, priority, model_id, extra_ahead=0):
+        """Queue time a new call at priority would see on model_id (None until a call was timed)."""
+        per_call = (self.service_ms.get(model_id) or {}).get("call")
+        if per_call is None:
+            return None
+        ahead = self.active + self.waiting_count(priority) + extra_ahead
+        return ahead / self.slots() * per_call
+
+    def _release(self):
+        """Hand the slot to the most urgent waiter, or free it."""
+        while self.waiting:
+            neg_priority, seq, future = heapq.heappop(self.waiting)
+            if future.done():
+                continue  # cancelled while waiting
+            if any(entry[1] < seq and entry[0] > neg_priority for entry in self.waiting):
+                self.stats["overtakes"] += 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def attach(self):
+        if getattr(self.service, "_priority_dispatch_installed", False):
+            return
+        self.service._priority_dispatch_installed = True
+        original = self.service.execute_function
+
+        @functools.wraps(original)
+        async def execute_function(function_name, *args, **kwargs):
+            priority = parse_priority(current_priority.get())
+            seq = next(self._seq)
+            self.stats["calls"] += 1
+            key = "images" if "images" in kwargs else "image"
+            images = kwargs.get(key)
+            size = self.chunk_size()
+            if args or not isinstance(images, (list, tuple)) or size <= 0 or len(images) <= size:
+                await self._acquire(priority, seq)
+                started = time.perf_counter()
+                try:
+                    return await original(function_name, *args, **kwargs)
+                finally:
+                    self._observe(started, len(images) if isinstance(images, (list, tuple)) else 1)
+                    self._release()
+
+            # One slot for the whole batch, offered up at every chunk boundary
+            results = []
+            await self._acquire(priority, seq)
+            holding = True
+            try:
+                for start in range(0, len(images), size):
+                    if start:
+                        holding = False
+                        await self._checkpoint(priority, seq)
+                        holding = True
+                    self.stats["chunks"] += 1
+                    chunk = list(images[start:start + size])
+                    started = time.perf_counter()
+                    results.extend(await original(function_name, **{**kwargs, key: chunk}))
+                    self._observe(started, len(chunk))
+            finally:
+                if holding:
+                    self._release()
+            return results
+
+        self.service.execute_function = execute_function
+
+    def summary(self):
+        queued = collections.Counter(PRIORITY_LABELS[-entry[0]] for entry in self.waiting if not entry[2].done())
+        return {
+            **self.stats,
+            "slots": self.slots(),
+            "active": self.active,
+            "queued": dict(queued),
+            "preempt_batch_size": self.chunk_size(),
+            "wait_by_priority": wait_summary(self.waits_ms),
+            "service_ms": {m: {k: round(v, 1) for k, v in s.items()} for m, s in self.service_ms.items()},
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .micro_batcher import MicroBatcher',
+        'from .micro_batcher import MicroBatcher\n'
+        'from .priority_dispatch import PriorityDispatcher\n'
+        'from .affinity_scheduler import current_priority, parse_priority',
+    ),
+    (
+        "dispatcher",
+        '''        # Outermost: a micro-batch is one execute_function call for the wrappers above''',
+        '''        # Priority order in front of the timing wrappers: queue wait is not inference time
+        self.priority_dispatcher = PriorityDispatcher(self.inference_service, self.config)
+        self.priority_dispatcher.attach()
+        metrics_sampler.register_provider("dispatch", self.priority_dispatcher.summary)
+
+        @self.app.middleware("http")
+        async def request_priority(request: Request, call_next):
+            """X-Priority (or ?priority=) for every inference call this request makes"""
+            token = current_priority.set(
+                parse_priority(request.headers.get("X-Priority") or request.query_params.get("priority"))
+            )
+            try:
+                return await call_next(request)
+            finally:
+                current_priority.reset(token)
+
+        # Outermost: a micro-batch is one execute_function call for the wrappers above''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("priority_dispatch.py", DISPATCH_MODULE), ("affinity_scheduler.py", SCHEDULER_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .priority_dispatch import" in content:
+        print("✅ Already patched - priority dispatch found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_micro_batching.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_priority_dispatch'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: dispatch_slots (default: worker count), preempt_batch_size (default 8, 0 = never split)")
+    print("   2. Restart moondream-station server")
+    print("   3. Send X-Priority: 3 on an interactive call while a batch runs")
+    print("   4. curl http://localhost:2020/v1/metrics | jq '.dispatch, .scheduler.wait_by_priority'")
+
+    return True
+
+if __name__ == "__main__":
+    print("🚦 Moondream Station - Priority Dispatch")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
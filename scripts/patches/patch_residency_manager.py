@@ -0,0 +1,667 @@
+#!/usr/bin/env python3
+"""
+Patch to keep several models resident under a VRAM budget.
+
+patch_zombie_fix.py unloads SDXL before every manual switch, auto-start and
+auto-switch, and inference_service.start() drops the previous model, so
+alternating moondream-2 / WD14 / NSFW requests reload from disk every time
+even on a 24GB card that could hold all of them.
+
+This patch installs moondream_station/core/residency_manager.py:
+1. inference_service.start(model) first detaches the current model's
+   worker_backends / worker_pool and keeps them; switching back to a
+   resident model is a reference swap, not a reload
+2. Before a load, models are evicted until
+       resident VRAM + expected VRAM of the new model <= budget
+   The victim is the model with the lowest
+       reload_seconds * recency / size_mb
+   i.e. cheap to reload, idle for a while, and large goes first
+3. Budget: config "vram_budget_mb", else a share of device VRAM picked by
+   X-VRAM-Mode (low 50%, balanced 75%, high 90%)
+4. SDXL is registered as an external resident, so it is only unloaded when
+   the budget needs the room (replaces the [ZombiePrevention] blocks)
+5. GET /v1/models/residency reports budget, usage and the eviction log
+
+Requires: patch_vram_attribution.py, patch_metrics_sampler.py,
+          patch_ghost_process_detection.py
+
+Usage:
+    python3 patch_residency_manager.py
+"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# bypass_measurement() needs vram_attribution.py's attribute_inference_to()
+from patch_vram_attribution import ATTRIBUTION_MODULE  # noqa: E402
+
+RESIDENCY_MODULE = '''"""
+VRAM-budgeted multi-model residency for InferenceService.
+
+The service only knows one active model. The manager keeps the state
+attributes of previously started models alive (detached from the service)
+and swaps them back in on start(), evicting by cost when the budget is hit.
+"""
+
+import functools
+import gc
+import sys
+import threading
+import time
+
+MODE_BUDGET_FRACTION = {"low": 0.50, "balanced": 0.75, "high": 0.90}
+DEFAULT_RELOAD_SECONDS = 10.0
+RECENCY_HALF_LIFE_S = 300.0
+
+# Attributes that make up "the loaded model" on InferenceService
+STATE_ATTRS = ("worker_backends", "worker_pool")
+
+
+def device_vram_mb():
+    """(total_mb, free_mb) of device 0, or (None, None) if unknown."""
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        try:
+            if torch.cuda.is_available():
+                free, total = torch.cuda.mem_get_info(0)
+                return total / (1024 * 1024), free / (1024 * 1024)
+        except Exception:
+            pass
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        memory = pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(0))
+        return memory.total / (1024 * 1024), memory.free / (1024 * 1024)
+    except Exception:
+        return None, None
+
+
+class ResidentModel:
+    def __init__(self, model_id, state=None, unload=None, external=False, wrapper=None):
+        self.model_id = model_id
+        self.state = state or {}  # detached STATE_ATTRS values
+        self.unload = unload  # external residents (SDXL) unload themselves
+        self.external = external
+        self.wrapper = wrapper  # external residents: object holding the weights
+        self.tier = "gpu"  # "gpu" | "parked" (weights in host RAM)
+        self.parked = None
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+
+    def touch(self):
+        self.last_used = time.time()
+        self.uses += 1
+
+    def backends(self):
+        return list(self.state.get("worker_backends") or [])
+
+    def weight_roots(self):
+        return [self.wrapper] if self.external else self.backends()
+
+
+class ResidencyManager:
+    def __init__(self, tracker, config=None, sampler=None):
+        self.tracker = tracker
+        self.config = config
+        self.sampler = sampler
+        self.mode = "balanced"
+        self.service = None
+        self.active = None  # model_id currently attached to the service
+        self.resident = {}  # model_id -> ResidentModel (active one included)
+        self.parking = None  # HostParking - evicted models go to host RAM when set
+        self._in_transit = set()  # models being unparked, never chosen as victims
+        self.evictions = []
+        self.reuses = 0
+        self.unparks = 0
+        self.loads = 0
+        self._lock = threading.RLock()
+
+    # --- budget -----------------------------------------------------------
+
+    def set_mode(self, mode):
+        if mode in MODE_BUDGET_FRACTION:
+            self.mode = mode
+
+    def budget_mb(self):
+        configured = self.config.get("vram_budget_mb") if self.config else None
+        if configured:
+            return float(configured)
+        total, _ = device_vram_mb()
+        if total is None:
+            return None
+        return total * MODE_BUDGET_FRACTION[self.mode]
+
+    def size_mb(self, model_id):
+        fp = self.tracker.get_footprint(model_id)
+        if fp and fp.get("resident_mb"):
+            return float(fp["resident_mb"])
+        return float(self.tracker.expected_vram_mb(model_id))
+
+    def admission_mb(self, model_id):
+        fp = self.tracker.get_footprint(model_id)
+        if fp and fp.get("admission_mb"):
+            return float(fp["admission_mb"])
+        return float(self.tracker.expected_vram_mb(model_id))
+
+    def used_mb(self):
+        return sum(self.size_mb(m) for m, e in self.resident.items() if e.tier == "gpu")
+
+    def tier(self, model_id):
+        entry = self.resident.get(model_id)
+        return entry.tier if entry is not None else "cold"
+
+    def reload_seconds(self, model_id):
+        store = getattr(self.tracker, "store", None)
+        seconds = store.expected_load_seconds(model_id) if store is not None else None
+        if seconds is None:
+            stats = self.tracker.get_footprint(model_id) or {}
+            seconds = stats.get("load_seconds") or DEFAULT_RELOAD_SECONDS
+        return float(seconds)
+
+    def keep_value(self, entry, now=None):
+        """Reload cost per MB, discounted by how long the model has been idle."""
+        idle = max(0.0, (now or time.time()) - entry.last_used)
+        recency = 1.0 / (1.0 + idle / RECENCY_HALF_LIFE_S)
+        return self.reload_seconds(entry.model_id) * recency / max(self.size_mb(entry.model_id), 1.0)
+
+    def choose_victim(self, protect=(), tier="gpu"):
+        candidates = [
+            e for m, e in self.resident.items()
+            if m not in protect and m not in self._in_transit and e.tier == tier
+        ]
+        if not candidates:
+            return None
+        now = time.time()
+        return min(candidates, key=lambda e: self.keep_value(e, now))
+
+    def make_room(self, model_id, reason="load"):
+        """Evict until model_id fits the budget (and the device has the memory free)."""
+        with self._lock:
+            need = self.admission_mb(model_id)
+            budget = self.budget_mb()
+            while True:
+                over_budget = budget is not None and self.used_mb() + need > budget
+                _, free = device_vram_mb()
+                over_device = free is not None and self.tier(model_id) != "gpu" and free < need
+                if not (over_budget or over_device):
+                    return True
+                victim = self.choose_victim(protect=(model_id,))
+                if victim is None:
+                    return False
+                self.evict(victim.model_id, reason=f"{reason}:{model_id}")
+
+    # --- eviction ---------------------------------------------------------
+
+    def evict(self, model_id, reason="manual"):
+        """Free a model's VRAM: park it in host RAM if possible, else unload it."""
+        with self._lock:
+            entry = self.resident.get(model_id)
+            if entry is None:
+                return False
+            if entry.tier == "gpu" and self._park(entry, reason):
+                return True
+            del self.resident[model_id]
+            freed = self.size_mb(model_id) if entry.tier == "gpu" else 0
+            if entry.parked is not None:
+                self.parking.release(entry.parked)
+                entry.parked = None
+            if entry.external:
+                try:
+                    entry.unload()
+                except Exception as e:
+                    print(f"[Residency] Failed to unload {model_id}: {e}")
+            else:
+                if model_id == self.active:
+                    entry.state = self._detach()
+                    self.active = None
+                self._release(entry)
+            self.tracker.track_model_unload(model_id)
+            self._set_state(model_id, "cold")
+            self._collect()
+            record = {"model": model_id, "reason": reason, "freed_mb": round(freed), "at": time.time()}
+            self.evictions.append(record)
+            del self.evictions[:-50]
+            print(f"[Residency] Evicted {model_id} ({freed:.0f}MB) for {reason}")
+            if self.sampler is not None:
+                self.sampler.record_event("model_evict", record)
+            return True
+
+    def evict_inactive(self):
+        """Reclaim hook: move every model except the active one off the GPU."""
+        for model_id in [m for m, e in self.resident.items() if m != self.active and e.tier == "gpu"]:
+            self.evict(model_id, reason="reclaim")
+
+    # --- host-RAM parking -------------------------------------------------
+
+    def _park(self, entry, reason):
+        if self.parking is None:
+            return False
+        model_id = entry.model_id
+        if model_id == self.active:
+            entry.state = self._detach()
+            self.active = None
+        size = self.size_mb(model_id)
+        # Parked models compete for the host budget with the same cost score
+        while not self.parking.fits(size):
+            victim = self.choose_victim(protect=(model_id,), tier="parked")
+            if victim is None:
+                return False
+            self.evict(victim.model_id, reason=f"host:{model_id}")
+        parked = self.parking.park(model_id, entry.weight_roots())
+        if parked is None:
+            return False
+        entry.parked = parked
+        entry.tier = "parked"
+        self.tracker.track_model_unload(model_id)
+        self._set_state(model_id, "parked")
+        self._collect()
+        record = {"model": model_id, "reason": reason, "parked_mb": round(parked.nbytes / (1024 * 1024)),
+                  "seconds": round(parked.park_seconds, 3), "at": time.time()}
+        print(f"[Residency] Parked {model_id} in host RAM ({record['parked_mb']}MB, {record['seconds']}s) for {reason}")
+        if self.sampler is not None:
+            self.sampler.record_event("model_park", record)
+        return True
+
+    def _unpark(self, entry):
+        """Copy a parked model back to the GPU; falls back to a full unload on failure."""
+        model_id = entry.model_id
+        self._in_transit.add(model_id)
+        try:
+            self.make_room(model_id)
+            seconds = self.parking.unpark(entry.parked)
+        except Exception as e:
+            print(f"[Residency] Unpark of {model_id} failed, unloading: {e}")
+            self.evict(model_id, reason="unpark-failed")
+            return False
+        finally:
+            self._in_transit.discard(model_id)
+        entry.parked = None
+        entry.tier = "gpu"
+        self.unparks += 1
+        self._set_state(model_id, "gpu")
+        print(f"[Residency] Unparked {model_id} from host RAM in {seconds:.2f}s")
+        if self.sampler is not None:
+            self.sampler.record_event("model_unpark", {"model": model_id, "seconds": round(seconds, 3), "at": time.time()})
+        return True
+
+    def _set_state(self, model_id, state):
+        if hasattr(self.tracker, "set_model_state"):
+            self.tracker.set_model_state(model_id, state)
+
+    def _release(self, entry):
+        pool = entry.state.get("worker_pool")
+        for name in ("shutdown", "stop"):
+            if pool is not None and callable(getattr(pool, name, None)):
+                try:
+                    getattr(pool, name)()
+                except Exception:
+                    pass
+                break
+        for backend in entry.backends():
+            if callable(getattr(backend, "unload_model", None)):
+                try:
+                    backend.unload_model()
+                except Exception as e:
+                    print(f"[Residency] unload_model failed for {entry.model_id}: {e}")
+        entry.state.clear()
+
+    @staticmethod
+    def _collect():
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            try:
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except Exception:
+                pass
+
+    # --- service integration ---------------------------------------------
+
+    def _detach(self):
+        """Take the active model's state off the service without unloading it."""
+        state = {}
+        for attr in STATE_ATTRS:
+            if hasattr(self.service, attr):
+                state[attr] = getattr(self.service, attr)
+                setattr(self.service, attr, None)
+        return state
+
+    def _attach(self, state):
+        for attr, value in state.items():
+            setattr(self.service, attr, value)
+
+    def register_external(self, model_id, unload, wrapper=None, load_methods=("load_backend", "load_model", "generate")):
+        """Track a backend that lives outside InferenceService (SDXL).
+
+        Calls to its load/generate methods make room first and mark it resident.
+        """
+        def claim():
+            with self._lock:
+                entry = self.resident.get(model_id)
+                if entry is not None and entry.tier == "parked" and not self._unpark(entry):
+                    entry = None
+                if entry is None:
+                    self.make_room(model_id, reason="external")
+                    entry = ResidentModel(model_id, unload=unload, external=True, wrapper=wrapper)
+                    self.resident[model_id] = entry
+                    self._set_state(model_id, "gpu")
+                entry.touch()
+
+        for name in load_methods:
+            original = getattr(wrapper, name, None) if wrapper is not None else None
+            if not callable(original) or getattr(original, "_residency_wrapped", False):
+                continue
+
+            def make(fn):
+                @functools.wraps(fn)
+                def wrapped(*args, **kwargs):
+                    claim()
+                    return fn(*args, **kwargs)
+                wrapped._residency_wrapped = True
+                return wrapped
+
+            setattr(wrapper, name, make(original))
+
+        original_unload = unload
+
+        def forget(*args, **kwargs):
+            entry = self.resident.pop(model_id, None)
+            if entry is not None and entry.parked is not None:
+                self.parking.release(entry.parked)
+            self._set_state(model_id, "cold")
+            return original_unload(*args, **kwargs)
+
+        if wrapper is not None and getattr(wrapper, "unload_backend", None) is unload:
+            wrapper.unload_backend = forget
+        return claim
+
+    def attach(self, service):
+        """Wrap service.start / execute_function. Install before the measuring wrappers."""
+        if getattr(service, "_residency_installed", False):
+            return
+        service._residency_installed = True
+        self.service = service
+        service.start_reused_resident = False
+        original_start = service.start
+        original_execute = service.execute_function
+
+        @functools.wraps(original_start)
+        def start(model_id, *args, **kwargs):
+            with self._lock:
+                service.start_reused_resident = False
+                entry = self.resident.get(model_id)
+                if model_id == self.active and entry is not None:
+                    entry.touch()
+                    service.start_reused_resident = True
+                    self.reuses += 1
+                    return True
+
+                # Detach the outgoing model's state so start() cannot unload it
+                previous = self.active
+                if previous is not None and previous in self.resident:
+                    self.resident[previous].state = self._detach()
+                self.active = None
+
+                if entry is not None and entry.tier == "parked" and not self._unpark(entry):
+                    entry = None
+                if entry is not None and entry.state:
+                    self._attach(entry.state)
+                    self.active = model_id
+                    entry.touch()
+                    service.start_reused_resident = True
+                    self.reuses += 1
+                    print(f"[Residency] Reused resident {model_id} (no reload)")
+                    return True
+
+                self.make_room(model_id)
+                ok = original_start(model_id, *args, **kwargs)
+                if not ok:
+                    # Failed load: put the previous model back rather than leave nothing attached
+                    restore = self.resident.get(previous)
+                    if restore is not None and restore.state:
+                        self._attach(restore.state)
+                        self.active = previous
+                    return ok
+                self.loads += 1
+                new_backends = getattr(service, "worker_backends", None) or []
+                for other in list(self.resident.values()):
+                    # Backends shared with another model id: that entry is no longer valid
+                    if any(b is o for b in new_backends for o in other.backends()):
+                        self.resident.pop(other.model_id, None)
+                entry = ResidentModel(model_id)
+                entry.touch()
+                self.resident[model_id] = entry
+                self.active = model_id
+                self._set_state(model_id, "gpu")
+                return ok
+
+        @functools.wraps(original_execute)
+        async def execute_function(*args, **kwargs):
+            entry = self.resident.get(self.active)
+            if entry is not None:
+                entry.touch()
+            return await original_execute(*args, **kwargs)
+
+        service.start = start
+        service.execute_function = execute_function
+        self._resident_start = start
+
+    def will_reuse(self, model_id):
+        """start(model_id) would swap in a resident model instead of loading it."""
+        with self._lock:
+            entry = self.resident.get(model_id)
+            return entry is not None and (model_id == self.active or bool(entry.state))
+
+    def bypass_measurement(self, service):
+        """Install right outside the VRAM attribution wrapper: a swap to a resident model
+        goes straight to the residency start, so it is never measured as a load."""
+        measured_start = service.start
+
+        @functools.wraps(measured_start)
+        def start(model_id, *args, **kwargs):
+            if not self.will_reuse(model_id):
+                return measured_start(model_id, *args, **kwargs)
+            ok = self._resident_start(model_id, *args, **kwargs)
+            if ok and hasattr(service, "attribute_inference_to"):
+                service.attribute_inference_to(model_id)
+            return ok
+
+        service.start = start
+
+    def is_resident(self, model_id):
+        return model_id in self.resident
+
+    def status(self):
+        budget = self.budget_mb()
+        now = time.time()
+        return {
+            "mode": self.mode,
+            "budget_mb": round(budget) if budget is not None else None,
+            "used_mb": round(self.used_mb()),
+            "active": self.active,
+            "loads": self.loads,
+            "reuses": self.reuses,
+            "unparks": self.unparks,
+            "host_parking": self.parking.status() if self.parking is not None else None,
+            "resident": [
+                {
+                    "id": e.model_id,
+                    "tier": e.tier,
+                    "external": e.external,
+                    "size_mb": round(self.size_mb(e.model_id)),
+                    "reload_seconds": round(self.reload_seconds(e.model_id), 2),
+                    "idle_seconds": round(now - e.last_used, 1),
+                    "uses": e.uses,
+                    "keep_value": round(self.keep_value(e, now), 6),
+                }
+                for e in self.resident.values()
+            ],
+            "evictions": self.evictions[-10:],
+        }
+
+    def summary(self):
+        """Numeric view for the metrics sampler history."""
+        budget = self.budget_mb()
+        return {
+            "budget_mb": round(budget) if budget is not None else None,
+            "used_mb": round(self.used_mb()),
+            "resident_count": len(self.resident),
+            "parked_count": sum(1 for e in self.resident.values() if e.tier == "parked"),
+            "reuses": self.reuses,
+            "unparks": self.unparks,
+            "loads": self.loads,
+            "evictions": len(self.evictions),
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service',
+        'from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service\n'
+        'from .residency_manager import ResidencyManager',
+    ),
+    (
+        "instance",
+        '''vram_reclaim_hooks.append(_drop_idle_sdxl)''',
+        '''vram_reclaim_hooks.append(_drop_idle_sdxl)
+
+# Keeps several models resident under a VRAM budget (config set in _setup_routes)
+residency_manager = ResidencyManager(model_memory_tracker)
+if sdxl_backend_new:
+    residency_manager.register_external("sdxl-base", sdxl_backend_new.unload_backend, wrapper=sdxl_backend_new)
+vram_reclaim_hooks.insert(0, residency_manager.evict_inactive)''',
+    ),
+    (
+        "attach",
+        '''# Measure per-model VRAM around loads and inference
+        instrument_inference_service(self.inference_service, model_memory_tracker)''',
+        '''# Multi-model residency (innermost wrapper: a resident swap is not measured as a load)
+        residency_manager.config = self.config
+        residency_manager.sampler = metrics_sampler
+        metrics_sampler.register_provider("residency", residency_manager.summary)
+        residency_manager.attach(self.inference_service)
+        # Measure per-model VRAM around loads and inference
+        instrument_inference_service(self.inference_service, model_memory_tracker)
+        residency_manager.bypass_measurement(self.inference_service)''',
+    ),
+    (
+        "manual switch tracker",
+        '''if previous_model and previous_model != model_id:
+                        model_memory_tracker.track_model_unload(previous_model)''',
+        '''if previous_model and previous_model != model_id and not residency_manager.is_resident(previous_model):
+                        model_memory_tracker.track_model_unload(previous_model)''',
+    ),
+    (
+        "auto-start tracker",
+        '''if previous_model and previous_model != target_model:
+                             model_memory_tracker.track_model_unload(previous_model)''',
+        '''if previous_model and previous_model != target_model and not residency_manager.is_resident(previous_model):
+                             model_memory_tracker.track_model_unload(previous_model)''',
+    ),
+    (
+        "auto-switch tracker",
+        '''if previous_before_switch:
+                                model_memory_tracker.track_model_unload(previous_before_switch)''',
+        '''if previous_before_switch and not residency_manager.is_resident(previous_before_switch):
+                                model_memory_tracker.track_model_unload(previous_before_switch)''',
+    ),
+]
+
+ZOMBIE_BLOCK = re.compile(
+    r'([ \t]*)# Unload SDXL if present \(Zombie Prevention\)\n'
+    r'[ \t]*if sdxl_backend_new:\n'
+    r'(?:.*\n)*?'
+    r'[ \t]*except: pass\n'
+)
+
+ZOMBIE_REPLACEMENT = (
+    '\\1# Budgeted residency: SDXL and other models are evicted only if the new model needs the room\n'
+    '\\1residency_manager.set_mode(request.headers.get("X-VRAM-Mode"))\n'
+)
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (("residency_manager.py", RESIDENCY_MODULE), ("vram_attribution.py", ATTRIBUTION_MODULE)):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .residency_manager import" in content:
+        print("✅ Already patched - residency manager found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            if name.endswith("tracker"):
+                print(f"⚠️  Could not find {name} - previous model may be dropped from the tracker")
+                continue
+            print(f"❌ Could not find {name} hook (run the required patches first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    content, count = ZOMBIE_BLOCK.subn(ZOMBIE_REPLACEMENT, content)
+    print(f"✓ Replaced {count} [ZombiePrevention] unload blocks")
+
+    endpoint = '''@self.app.get("/v1/models/residency")
+        async def model_residency():
+            """Budget, resident models with their eviction score, recent evictions"""
+            return residency_manager.status()
+
+        '''
+    anchor = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+    if anchor in content:
+        content = content.replace(anchor, endpoint + anchor, 1)
+        print("✓ Added GET /v1/models/residency")
+    else:
+        print("⚠️  Could not find router setup hook - residency endpoint not added")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_residency'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional: set a fixed budget with config key vram_budget_mb")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/models/residency")
+
+    return True
+
+if __name__ == "__main__":
+    print("🧠 Moondream Station - VRAM Residency Manager")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
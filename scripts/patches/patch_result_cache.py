@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Patch to cache caption / tag / classify results by image content.
+
+The gallery re-submits the same image all the time - slideshow preload,
+re-tagging, duplicate uploads - and every time the backend runs the model
+again.
+
+This patch installs moondream_station/core/result_cache.py as the outermost
+wrapper of inference_service.execute_function, so it covers
+/v1/chat/completions, /v1/vision/batch-caption (and its stream / upload
+variants) and classification alike:
+1. Key = model id + function + settings/prompt kwargs + image content hash.
+   Images decoded by the decode pool carry the hash of their encoded bytes;
+   any other PIL image is hashed by its pixels
+2. In-memory LRU ("result_cache_entries", default 2048) and an optional
+   on-disk tier ("result_cache_dir", "result_cache_disk_mb" default 512)
+   evicting least recently used files by total size
+3. Batched calls (image=[...]) are split: hits are answered from the cache,
+   only the misses reach the model
+4. Functions: "result_cache_functions" (default caption, query, detect,
+   point, classify); streaming calls are never cached
+5. `Cache-Control: no-cache` (or `X-Cache: bypass`) skips the lookup and
+   stores the fresh result - for "regenerate caption". Responses carry
+   X-Cache: HIT / MISS / PARTIAL / BYPASS
+6. /metrics "result_cache": hit rates per tier and per function;
+   DELETE /v1/system/result-cache empties both tiers
+
+Set result_cache_entries to 0 to disable.
+
+Requires: patch_micro_batching.py, patch_decode_pool.py
+
+Usage:
+    python3 patch_result_cache.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from patch_batch_stream import STREAM_MODULE  # noqa: E402
+from patch_binary_upload import INGEST_MODULE  # noqa: E402
+from patch_decode_pool import DECODE_MODULE  # noqa: E402
+
+CACHE_MODULE = '''"""
+Content-addressed cache in front of InferenceService.execute_function.
+"""
+
+import asyncio
+import collections
+import contextvars
+import copy
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_ENTRIES = 2048
+DEFAULT_DISK_MB = 512
+DEFAULT_FUNCTIONS = ("caption", "query", "detect", "point", "classify")
+HASH_KEY = "content_hash"  # PIL image.info key set by decode_pool
+
+_request = contextvars.ContextVar("result_cache_request", default=None)
+
+
+def image_hash(image):
+    """Hash of the encoded bytes when the decoder recorded it, else of the pixels."""
+    info = getattr(image, "info", None)
+    if isinstance(info, dict) and info.get(HASH_KEY):
+        return info[HASH_KEY]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def open_request(headers):
+    """Per-request state for the middleware: bypass flag and hit / miss outcome."""
+    control = headers.get("cache-control", "").lower()
+    bypass = "no-cache" in control or "no-store" in control or headers.get("x-cache", "").lower() == "bypass"
+    state = {"bypass": bypass, "hits": 0, "misses": 0}
+    return _request.set(state), state
+
+
+def close_request(token):
+    _request.reset(token)
+
+
+def outcome(state):
+    if state["bypass"] and state["misses"]:
+        return "BYPASS"
+    if state["hits"] and state["misses"]:
+        return "PARTIAL"
+    if state["hits"]:
+        return "HIT"
+    return "MISS" if state["misses"] else None
+
+
+class _DiskTier:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index = collections.OrderedDict()  # key -> size, least recently used first
+        self.bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        entries = []
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(dirpath, name))
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def get(self, key):
+        with self._lock:
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+        try:
+            path = self._path(key)
+            with open(path, "r") as f:
+                value = json.load(f)
+            os.utime(path)  # LRU order survives restarts
+            return value
+        except (OSError, ValueError):
+            with self._lock:
+                self.bytes -= self.index.pop(key, 0)
+            return None
+
+    def put(self, key, value):
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            return 0  # not JSON-serialisable: memory tier only
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        evicted = 0
+        with self._lock:
+            self.bytes += len(data) - self.index.pop(key, 0)
+            self.index[key] = len(data)
+            while self.bytes > self.max_bytes and len(self.index) > 1:
+                old, size = self.index.popitem(last=False)
+                self.bytes -= size
+                evicted += 1
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            keys = list(self.index)
+            self.index.clear()
+            self.bytes = 0
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+class ResultCache:
+    def __init__(self, service, config=None):
+        self.service = service
+        self.config = config
+        self.memory = collections.OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0,
+                      "memory_evictions": 0, "disk_evictions": 0, "hash_ms": 0.0}
+        self.by_function = collections.defaultdict(collections.Counter)
+        self.disk = None
+        directory = self._setting("result_cache_dir", None)
+        if directory:
+            max_mb = float(self._setting("result_cache_disk_mb", DEFAULT_DISK_MB))
+            try:
+                self.disk = _DiskTier(os.path.expanduser(directory), int(max_mb * 1024 * 1024))
+            except OSError as e:
+                print(f"[ResultCache] Disk tier disabled ({directory}): {e}")
+
+    def _setting(self, key, default):
+        value = self.config.get(key) if self.config else None
+        return default if value is None else value
+
+    def enabled(self, function_name, args, kwargs):
+        if args or kwargs.get("stream") or kwargs.get("image") is None:
+            return False
+        if int(self._setting("result_cache_entries", DEFAULT_ENTRIES)) <= 0:
+            return False
+        return function_name in self._setting("result_cache_functions", DEFAULT_FUNCTIONS)
+
+    def _keys(self, function_name, images, kwargs):
+        started = time.perf_counter()
+        model_id = self.config.get("current_model") if self.config else None
+        settings = json.dumps({k: v for k, v in kwargs.items() if k != "image"}, sort_keys=True, default=repr)
+        prefix = f"{model_id}|{function_name}|{settings}|"
+        keys = [hashlib.blake2b((prefix + image_hash(image)).encode(), digest_size=20).hexdigest() for image in images]
+        self.stats["hash_ms"] += (time.perf_counter() - started) * 1000.0
+        return keys
+
+    async def _get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return True, copy.deepcopy(self.memory[key])
+        if self.disk is not None:
+            value = await asyncio.get_running_loop().run_in_executor(None, self.disk.get, key)
+            if value is not None:
+                self.stats["disk_hits"] += 1
+                self._remember(key, value)
+                return True, copy.deepcopy(value)
+        return False, None
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        limit = int(self._setting("result_cache_entries", DEFAULT_ENTRIES))
+        while len(self.memory) > limit:
+            self.memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    async def _put(self, key, value):
+        self.stats["stores"] += 1
+        self._remember(key, copy.deepcopy(value))
+        if self.disk is not None:
+            evicted = await asyncio.get_running_loop().run_in_executor(None, self.disk.put, key, value)
+            self.stats["disk_evictions"] += evicted
+
+    def attach(self):
+        if getattr(self.service, "_result_cache_installed", False):
+            return
+        self.service._result_cache_installed = True
+        original = self.service.execute_function
+
+        @functools.wraps(original)
+        async def execute_function(function_name, *args, **kwargs):
+            if not self.enabled(function_name, args, kwargs):
+                return await original(function_name, *args, **kwargs)
+            request = _request.get() or {"bypass": False, "hits": 0, "misses": 0}
+            batched = isinstance(kwargs["image"], (list, tuple))
+            images = list(kwargs["image"]) if batched else [kwargs["image"]]
+            if all(HASH_KEY in getattr(image, "info", {}) for image in images):
+                keys = self._keys(function_name, images, kwargs)
+            else:  # pixel hashing of full-size images: keep it off the event loop
+                keys = await asyncio.get_running_loop().run_in_executor(None, self._keys, function_name, images, kwargs)
+            counts = self.by_function[function_name]
+
+            results = [None] * len(images)
+            missing = []
+            for position, key in enumerate(keys):
+                hit, value = (False, None) if request["bypass"] else await self._get(key)
+                if hit:
+                    results[position] = value
+                    request["hits"] += 1
+                    counts["hits"] += 1
+                else:
+                    missing.append(position)
+            if not missing:
+                return results if batched else results[0]
+
+            request["misses"] += len(missing)
+            counts["misses"] += len(missing)
+            self.stats["bypassed" if request["bypass"] else "misses"] += len(missing)
+            rest = {k: v for k, v in kwargs.items() if k != "image"}
+            if batched:
+                fresh = await original(function_name, image=[images[p] for p in missing], **rest)
+            else:
+                fresh = [await original(function_name, image=images[0], **rest)]
+            for position, value in zip(missing, fresh):
+                results[position] = value
+                await self._put(keys[position], value)
+            return results if batched else results[0]
+
+        self.service.execute_function = execute_function
+
+    def clear(self):
+        cleared = len(self.memory)
+        self.memory.clear()
+        if self.disk is not None:
+            cleared = max(cleared, len(self.disk.index))
+            self.disk.clear()
+        return cleared
+
+    def summary(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **{k: (round(v, 1) if isinstance(v, float) else v) for k, v in self.stats.items()},
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "memory_hit_rate": round(self.stats["memory_hits"] / lookups, 3) if lookups else None,
+            "entries": len(self.memory),
+            "disk_entries": len(self.disk.index) if self.disk else None,
+            "disk_mb": round(self.disk.bytes / 1024 ** 2, 1) if self.disk else None,
+            "by_function": {
+                name: {**counts, "hit_rate": round(counts["hits"] / (counts["hits"] + counts["misses"]), 3)}
+                for name, counts in self.by_function.items() if counts["hits"] + counts["misses"]
+            },
+        }
+'''
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .micro_batcher import MicroBatcher',
+        'from .micro_batcher import MicroBatcher\n'
+        'from .result_cache import ResultCache, close_request, open_request, outcome',
+    ),
+    (
+        "attach",
+        '''        metrics_sampler.register_provider("micro_batching", self.micro_batcher.summary)''',
+        '''        metrics_sampler.register_provider("micro_batching", self.micro_batcher.summary)
+        # Outside the batcher: cache hits never wait for a batch window
+        self.result_cache = ResultCache(self.inference_service, self.config)
+        self.result_cache.attach()
+        metrics_sampler.register_provider("result_cache", self.result_cache.summary)
+
+        @self.app.middleware("http")
+        async def result_cache_scope(request: Request, call_next):
+            """Cache-Control: no-cache bypass in, X-Cache outcome out"""
+            token, state = open_request(request.headers)
+            try:
+                response = await call_next(request)
+            finally:
+                close_request(token)
+            if outcome(state):
+                response.headers["X-Cache"] = outcome(state)
+            return response
+
+        @self.app.delete("/v1/system/result-cache")
+        async def clear_result_cache():
+            return {"cleared": self.result_cache.clear()}''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    for filename, source in (
+        ("result_cache.py", CACHE_MODULE),
+        ("decode_pool.py", DECODE_MODULE),
+        ("batch_stream.py", STREAM_MODULE),
+        ("binary_ingest.py", INGEST_MODULE),
+    ):
+        module_path = os.path.join(core_dir, filename)
+        print(f"📦 Installing {module_path}")
+        with open(module_path, 'w') as f:
+            f.write(source)
+
+    if "from .result_cache import" in content:
+        print("✅ Already patched - result cache found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_micro_batching.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_result_cache'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Optional config: result_cache_entries, result_cache_dir, result_cache_disk_mb")
+    print("   2. Restart moondream-station server")
+    print("   3. curl http://localhost:2020/v1/metrics | jq .result_cache")
+
+    return True
+
+if __name__ == "__main__":
+    print("🗃️  Moondream Station - Inference Result Cache")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Patch to route every model switch through one coordinator.
+
+The start / config / tracker sequence was copy-pasted into
+/v1/models/switch and the auto-start and auto-switch blocks of
+_handle_chat_completion (patch_fix_unload_order.py exists because one copy
+captured previous_model in the wrong order). start() also ran on the event
+loop, and two concurrent chat requests for different models could both call
+it and thrash.
+
+This patch installs moondream_station/core/switch_coordinator.py and
+replaces all three copies with SwitchCoordinator.acquire(model):
+1. One switch at a time; requests for the target being loaded wait for that
+   load instead of starting another (coalescing)
+2. start() runs in a worker thread, so the server keeps answering /metrics
+   and health checks during a 20s load
+3. previous model / config.set / tracker update happen together under one
+   lock, after start() succeeded
+4. Chat requests hold a lease on the model until the response body is sent
+   (the last chunk of a streamed completion), so a switch waits for in-flight requests on the old model to finish
+   (bounded by switch_drain_timeout_s, default 30s)
+
+Requires: patch_vram_attribution.py, patch_load_profiler.py,
+          patch_residency_manager.py
+
+Usage:
+    python3 patch_switch_coordinator.py
+"""
+
+import os
+import re
+import sys
+
+COORDINATOR_MODULE = '''"""
+Single, serialised path for changing the active model of InferenceService.
+
+acquire(model) returns once model is active. Callers inside a lease scope
+(every HTTP request, via the middleware) also hold a lease: a switch to a
+different model waits until leases drain, so a model is never swapped out
+from under a running request.
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+
+DEFAULT_DRAIN_TIMEOUT_S = 30.0
+
+_scope = contextvars.ContextVar("model_lease_scope", default=None)
+
+
+class SwitchError(Exception):
+    """inference_service.start() returned False."""
+
+
+class SwitchCoordinator:
+    def __init__(self, service, config, manifest_manager, tracker, residency=None):
+        self.service = service
+        self.config = config
+        self.manifest_manager = manifest_manager
+        self.tracker = tracker
+        self.residency = residency
+        self.last_switch = None
+        self.stats = {"switches": 0, "coalesced": 0, "already_active": 0, "failures": 0, "drain_timeouts": 0}
+        self._cond = None  # created inside the running loop
+        self._leases = 0
+        self._switch_target = None
+        self._reaping = set()  # models being evicted outside a switch (model_lifecycle.py)
+        self._state_lock = threading.Lock()
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _is_active(self, model_id):
+        return self.config.get("current_model") == model_id and self.service.is_running()
+
+    def _hold(self):
+        self._leases += 1
+        scope = _scope.get()
+        if scope is not None:
+            scope["leases"] += 1
+
+    async def acquire(self, model_id, hold=True):
+        """Make model_id the active model; with hold=True keep a lease until the scope closes."""
+        cond = self._condition()
+        coalesced = False
+        async with cond:
+            while True:
+                if model_id in self._reaping:
+                    pass  # wait for the eviction to finish, then switch back in
+                elif self._switch_target is None and self._is_active(model_id):
+                    if hold:
+                        self._hold()
+                    self.stats["coalesced" if coalesced else "already_active"] += 1
+                    return {"model": model_id, "switched": False, "coalesced": coalesced}
+                elif self._switch_target is None:
+                    self._switch_target = model_id
+                    break
+                coalesced = coalesced or self._switch_target == model_id
+                await cond.wait()
+
+            own = (_scope.get() or {}).get("leases", 0)
+            timeout = float(self.config.get("switch_drain_timeout_s") or DEFAULT_DRAIN_TIMEOUT_S)
+            try:
+                await asyncio.wait_for(cond.wait_for(lambda: self._leases <= own), timeout)
+            except asyncio.TimeoutError:
+                self.stats["drain_timeouts"] += 1
+                print(f"[Switch] {self._leases - own} request(s) still running after {timeout:.0f}s, switching anyway")
+
+        result = None
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, self._switch_sync, model_id)
+        finally:
+            async with cond:
+                self._switch_target = None
+                if result is not None and hold:
+                    self._hold()
+                cond.notify_all()
+        if result is None:
+            self.stats["failures"] += 1
+            raise SwitchError(f"Failed to start model {model_id}")
+        return result
+
+    async def release(self, count=1):
+        cond = self._condition()
+        async with cond:
+            self._leases = max(0, self._leases - count)
+            cond.notify_all()
+
+    def open_scope(self):
+        scope = {"leases": 0, "callbacks": []}
+        return _scope.set(scope), scope
+
+    def on_scope_close(self, callback):
+        """Run callback (a coroutine function) when the current request finishes."""
+        scope = _scope.get()
+        if scope is None:
+            return False
+        scope["callbacks"].append(callback)
+        return True
+
+    async def close_scope(self, handle):
+        token, scope = handle
+        _scope.reset(token)
+        await self._finish_scope(scope)
+
+    async def close_scope_after(self, handle, response):
+        """Close the scope once response's body is sent; a streamed body keeps the leases until it ends."""
+        token, scope = handle
+        _scope.reset(token)
+        body = getattr(response, "body_iterator", None)
+        if body is None:
+            await self._finish_scope(scope)
+            return response
+
+        async def leased_body():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                await self._finish_scope(scope)
+
+        response.body_iterator = leased_body()
+        return response
+
+    async def _finish_scope(self, scope):
+        for callback in scope["callbacks"]:
+            try:
+                await callback()
+            except Exception as e:
+                print(f"[Switch] Scope close callback failed: {e}")
+        if scope["leases"]:
+            await self.release(scope["leases"])
+
+    def is_busy(self, model_id=None):
+        """A switch is running, or requests hold leases (on model_id, if it is the active model)."""
+        if self._switch_target is not None:
+            return True
+        if model_id is not None and self.config.get("current_model") != model_id:
+            return False
+        return self._leases > 0
+
+    def begin_reap(self, model_id):
+        """Call with the condition held: acquire(model_id) waits until end_reap()."""
+        self._reaping.add(model_id)
+
+    async def end_reap(self, model_id):
+        cond = self._condition()
+        async with cond:
+            self._reaping.discard(model_id)
+            cond.notify_all()
+
+    def evict_active(self, model_id, reason="manual"):
+        """Worker thread: evict model_id and, if it was the active model, clear current_model
+        in the same step, so the coordinator never names a model whose backends are detached."""
+        with self._state_lock:
+            evicted = self.residency.evict(model_id, reason)
+            if evicted and self.config.get("current_model") == model_id:
+                self.config.set("current_model", None)
+            return evicted
+
+    def _switch_sync(self, model_id):
+        """Runs in a worker thread: start, then config + tracker as one step."""
+        started = time.perf_counter()
+        # Capture previous BEFORE anything changes it
+        previous = self.config.get("current_model")
+        print(f"[Switch] {previous} -> {model_id}")
+        if not self.service.start(model_id):
+            return None
+
+        vram_mb = 0
+        ram_mb = 0
+        with self._state_lock:
+            self.config.set("current_model", model_id)
+            try:
+                still_resident = self.residency is not None and self.residency.is_resident(previous)
+                if previous and previous != model_id and not still_resident:
+                    self.tracker.track_model_unload(previous)
+                model_info = self.manifest_manager.get_models().get(model_id)
+                if model_info:
+                    self.tracker.track_model_load(model_id, model_info.name)
+                    stats = self.tracker.loaded_models.get(model_id, {})
+                    vram_mb = stats.get("vram_mb", 0)
+                    ram_mb = stats.get("ram_mb", 0)
+            except Exception as e:
+                print(f"Warning: Failed to track switch to {model_id}: {e}")
+
+        self.stats["switches"] += 1
+        self.last_switch = {
+            "model": model_id,
+            "previous": previous,
+            "switched": True,
+            "coalesced": False,
+            "seconds": round(time.perf_counter() - started, 3),
+            "vram_mb": vram_mb,
+            "ram_mb": ram_mb,
+            "at": time.time(),
+        }
+        return dict(self.last_switch)
+
+    def status(self):
+        return {
+            **self.stats,
+            "leases": self._leases,
+            "switching_to": self._switch_target,
+            "current_model": self.config.get("current_model"),
+            "last_switch": self.last_switch,
+        }
+
+    def summary(self):
+        return {**self.stats, "leases": self._leases}
+'''
+
+SWITCH_ENDPOINT = '''@self.app.post("/v1/models/switch")
+        async def switch_model(request: Request):
+            data = await request.json()
+            model_id = data.get("model")
+            if model_id not in self.manifest_manager.get_models():
+                raise HTTPException(status_code=404, detail=f"Model {model_id} not found")
+
+            residency_manager.set_mode(request.headers.get("X-VRAM-Mode"))
+            try:
+                result = await self.switch_coordinator.acquire(model_id, hold=False)
+            except SwitchError:
+                raise HTTPException(status_code=500, detail="Failed to switch model")
+
+            stats = model_memory_tracker.loaded_models.get(model_id, {})
+            return {
+                "status": "success",
+                "model": model_id,
+                "vram_mb": stats.get("vram_mb", 0),
+                "ram_mb": stats.get("ram_mb", 0),
+                "switched": result["switched"],
+                "coalesced": result["coalesced"],
+                "load_profile": load_profiler.last_profile(model_id)
+            }
+
+        @self.app.get("/v1/models/switch/status")
+        async def switch_status():
+            return self.switch_coordinator.status()
+'''
+
+CHAT_SWITCH = '''            # --- AUTO-START / SWITCH LOGIC ---
+            # One coordinated path: concurrent requests for the same model share one
+            # load, and the lease keeps the model active until this request is done
+            if requested_model and requested_model in self.manifest_manager.get_models():
+                target_model = requested_model
+            elif current_model and self.inference_service.is_running():
+                target_model = current_model
+            else:
+                target_model = requested_model or "moondream-2"
+            residency_manager.set_mode(request.headers.get("X-VRAM-Mode"))
+            try:
+                await self.switch_coordinator.acquire(target_model)
+            except SwitchError:
+                raise HTTPException(status_code=500, detail=f"Failed to switch to model {target_model}")
+            current_model = target_model
+'''
+
+SWITCH_ENDPOINT_RE = re.compile(
+    r'@self\.app\.post\("/v1/models/switch"\)\n.*?detail="Failed to switch model"\)\n',
+    re.DOTALL,
+)
+
+CHAT_SWITCH_RE = re.compile(
+    r'[ \t]*# --- AUTO-START / SWITCH LOGIC ---\n.*?'
+    r'detail=f"Failed to switch to model \{requested_model\}"\)\n',
+    re.DOTALL,
+)
+
+REPLACEMENTS = [
+    (
+        "import",
+        'from .residency_manager import ResidencyManager',
+        'from .residency_manager import ResidencyManager\n'
+        'from .switch_coordinator import SwitchCoordinator, SwitchError',
+    ),
+    (
+        "coordinator setup",
+        '''        residency_manager.attach(self.inference_service)''',
+        '''        residency_manager.attach(self.inference_service)
+        self.switch_coordinator = SwitchCoordinator(
+            self.inference_service, self.config, self.manifest_manager, model_memory_tracker, residency_manager
+        )
+        metrics_sampler.register_provider("switch", self.switch_coordinator.summary)
+
+        @self.app.middleware("http")
+        async def model_lease_scope(request: Request, call_next):
+            """Leases taken while handling a request are released when its response body is sent"""
+            scope = self.switch_coordinator.open_scope()
+            try:
+                response = await call_next(request)
+            except BaseException:
+                await self.switch_coordinator.close_scope(scope)
+                raise
+            return await self.switch_coordinator.close_scope_after(scope, response)
+''',
+    ),
+]
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    core_dir = os.path.join(moondream_dir, "moondream_station/core")
+    rest_server_path = os.path.join(core_dir, "rest_server.py")
+    module_path = os.path.join(core_dir, "switch_coordinator.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(COORDINATOR_MODULE)
+
+    if "from .switch_coordinator import" in content:
+        print("✅ Already patched - switch coordinator found")
+        return True
+
+    for name, old, new in REPLACEMENTS:
+        if old not in content:
+            print(f"❌ Could not find {name} hook (run patch_residency_manager.py first)")
+            return False
+        content = content.replace(old, new, 1)
+        print(f"✓ Patched {name}")
+
+    content, count = SWITCH_ENDPOINT_RE.subn(lambda m: SWITCH_ENDPOINT, content, count=1)
+    if count == 0:
+        print("❌ Could not find /v1/models/switch endpoint")
+        return False
+    print("✓ /v1/models/switch uses the coordinator")
+
+    content, count = CHAT_SWITCH_RE.subn(lambda m: CHAT_SWITCH, content, count=1)
+    if count == 0:
+        print("❌ Could not find auto-start / auto-switch block in _handle_chat_completion")
+        return False
+    print("✓ Chat auto-start / auto-switch uses the coordinator")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_switch_coordinator'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. Fire two chat requests for different models at once - one switch each, no thrash")
+    print("   3. curl http://localhost:2020/v1/models/switch/status")
+
+    return True
+
+if __name__ == "__main__":
+    print("🔀 Moondream Station - Model Switch Coordinator")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+Patch to replace the even-split VRAM estimate with real per-model attribution.
+
+The previous tracker took NVML "total - free" and divided it evenly between
+every loaded model, so as soon as two models were resident the numbers were
+made up. This patch:
+
+1. Installs moondream_station/core/vram_attribution.py, which measures
+   - weights:          bytes of every CUDA parameter/buffer the backend owns
+   - activation peak:  allocator peak above the resting level during inference
+   - cache/reserved:   non-weight allocations kept after load plus allocator
+                       slack (reserved - allocated) the model caused
+2. Wraps inference_service.start / execute_function so each load and the
+   first inference are measured with the torch allocator counters
+3. Replaces ModelMemoryTracker so /metrics reports the measured footprint
+   per model and ghost detection compares NVML usage against real sizes
+
+Usage:
+    python3 patch_vram_attribution.py
+"""
+
+import os
+import re
+import sys
+
+ATTRIBUTION_MODULE = '''"""
+Per-model VRAM attribution.
+
+Measures what each model actually costs on the GPU instead of splitting the
+device total evenly. Loads are assumed to be serialised (the inference service
+only loads one backend at a time), so allocator deltas around a load belong to
+the model being loaded.
+"""
+
+import functools
+import gc
+import time
+import types
+import weakref
+
+try:
+    import torch
+except ImportError:  # CPU-only install
+    torch = None
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+MB = 1024 * 1024
+
+
+def _cuda_available():
+    try:
+        return torch is not None and torch.cuda.is_available()
+    except Exception:
+        return False
+
+
+def _nvml_used_bytes(index=0):
+    if not pynvml:
+        return 0
+    try:
+        handle = pynvml.nvmlDeviceGetHandleByIndex(index)
+        memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        return memory.total - memory.free
+    except Exception:
+        return 0
+
+
+def iter_torch_modules(root, max_depth=3):
+    """Yield every top-level nn.Module reachable from a backend object.
+
+    Backends are plain Python modules (globals like _model), class instances
+    or diffusers pipelines (.components), so we walk module globals, instance
+    attributes, dicts and sequences up to max_depth. Other Python modules are
+    never descended into, otherwise we would walk all of torch.
+    """
+    if torch is None or root is None:
+        return
+    seen = set()
+    stack = [(root, 0)]
+    while stack:
+        obj, depth = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, torch.nn.Module):
+            yield obj
+            continue
+        if depth >= max_depth:
+            continue
+
+        if isinstance(obj, types.ModuleType):
+            if depth > 0:
+                continue
+            children = [v for k, v in vars(obj).items() if not k.startswith("__")]
+        elif isinstance(obj, dict):
+            children = list(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            children = list(obj)
+        elif hasattr(obj, "components") and isinstance(getattr(obj, "components", None), dict):
+            children = list(obj.components.values())
+        elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+            children = list(vars(obj).values())
+        else:
+            continue
+
+        for child in children:
+            if isinstance(child, (type, types.FunctionType, types.BuiltinFunctionType, str, bytes, int, float)):
+                continue
+            if isinstance(child, types.ModuleType):
+                continue
+            stack.append((child, depth + 1))
+
+
+def weight_bytes(backends, device_type="cuda"):
+    """Bytes held by parameters and buffers on device_type, deduplicated by storage."""
+    if torch is None:
+        return 0
+    total = 0
+    seen_storages = set()
+    for backend in backends or []:
+        for module in iter_torch_modules(backend):
+            tensors = list(module.parameters(recurse=True)) + list(module.buffers(recurse=True))
+            for tensor in tensors:
+                try:
+                    if tensor.device.type != device_type:
+                        continue
+                    storage = tensor.untyped_storage()
+                    key = (tensor.device.index, storage.data_ptr())
+                    if key in seen_storages:
+                        continue
+                    seen_storages.add(key)
+                    total += storage.nbytes()
+                except Exception:
+                    continue
+    return total
+
+
+class ModelFootprint:
+    """Measured GPU footprint of one model."""
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.weights_bytes = 0
+        self.activation_peak_bytes = 0
+        self.cache_reserved_bytes = 0
+        self.host_bytes = 0
+        self.load_seconds = 0.0
+        self.first_inference_ms = None
+        self.source = "estimate"  # allocator | nvml | estimate
+        self.measured_at = 0
+
+    @property
+    def measured(self):
+        return self.source != "estimate"
+
+    @property
+    def resident_bytes(self):
+        """What the model holds while idle (weights + cache/reserved)."""
+        return self.weights_bytes + self.cache_reserved_bytes
+
+    @property
+    def admission_bytes(self):
+        """What must be free on the device before this model can load and run."""
+        return self.resident_bytes + self.activation_peak_bytes
+
+    def as_dict(self):
+        return {
+            "weights_mb": round(self.weights_bytes / MB, 1),
+            "activation_peak_mb": round(self.activation_peak_bytes / MB, 1),
+            "cache_reserved_mb": round(self.cache_reserved_bytes / MB, 1),
+            "resident_mb": round(self.resident_bytes / MB, 1),
+            "admission_mb": round(self.admission_bytes / MB, 1),
+            "host_mb": round(self.host_bytes / MB, 1),
+            "load_seconds": round(self.load_seconds, 3),
+            "first_inference_ms": self.first_inference_ms,
+            "source": self.source,
+            "measured_at": self.measured_at,
+        }
+
+
+class AllocatorProbe:
+    """Snapshot torch allocator + NVML counters around a load or an inference."""
+
+    def __init__(self):
+        self.cuda = _cuda_available()
+        self.allocated = 0
+        self.reserved = 0
+        self.device_used = 0
+        self.rss = 0
+        self.started = 0.0
+
+    def begin(self, reset_peak=False):
+        self.started = time.perf_counter()
+        if self.cuda:
+            try:
+                torch.cuda.synchronize()
+                if reset_peak:
+                    torch.cuda.reset_peak_memory_stats()
+                self.allocated = torch.cuda.memory_allocated()
+                self.reserved = torch.cuda.memory_reserved()
+            except Exception:
+                self.cuda = False
+        self.device_used = _nvml_used_bytes()
+        self.rss = _rss_bytes()
+        return self
+
+    def deltas(self):
+        elapsed = time.perf_counter() - self.started
+        allocated = reserved = peak = 0
+        if self.cuda:
+            try:
+                torch.cuda.synchronize()
+                allocated = torch.cuda.memory_allocated()
+                reserved = torch.cuda.memory_reserved()
+                peak = torch.cuda.max_memory_allocated()
+            except Exception:
+                pass
+        return {
+            "elapsed": elapsed,
+            "allocated": allocated,
+            "reserved": reserved,
+            "peak": peak,
+            "allocated_delta": allocated - self.allocated,
+            "slack_delta": (reserved - allocated) - (self.reserved - self.allocated),
+            "device_delta": _nvml_used_bytes() - self.device_used,
+            "rss_delta": _rss_bytes() - self.rss,
+        }
+
+
+def _rss_bytes():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return 0
+
+
+def measure_load(model_id, backends, probe, released_bytes=0):
+    """Build a footprint from a probe taken before inference_service.start().
+
+    released_bytes is the weight size of the previous model if start() freed
+    it, so its release does not hide the new model's allocations.
+    """
+    d = probe.deltas()
+    fp = ModelFootprint(model_id)
+    fp.load_seconds = d["elapsed"]
+    fp.host_bytes = max(0, d["rss_delta"])
+    fp.weights_bytes = weight_bytes(backends)
+
+    if probe.cuda and (fp.weights_bytes or d["allocated_delta"] + released_bytes > 0):
+        load_delta = d["allocated_delta"] + released_bytes
+        persistent_extra = max(0, load_delta - fp.weights_bytes)
+        fp.cache_reserved_bytes = persistent_extra + max(0, d["slack_delta"])
+        fp.source = "allocator"
+    elif d["device_delta"] > 0:
+        # Non-torch backend (or CUDA not visible to torch): fall back to NVML
+        fp.weights_bytes = d["device_delta"]
+        fp.source = "nvml"
+    fp.measured_at = int(time.time())
+    return fp
+
+
+def measure_inference(fp, probe):
+    """Fold one inference measurement into a footprint (peak is a running max)."""
+    d = probe.deltas()
+    if probe.cuda:
+        fp.activation_peak_bytes = max(fp.activation_peak_bytes, max(0, d["peak"] - probe.allocated))
+        fp.cache_reserved_bytes += max(0, d["slack_delta"])
+    if fp.first_inference_ms is None:
+        fp.first_inference_ms = int(d["elapsed"] * 1000)
+    return fp
+
+
+def instrument_inference_service(service, tracker):
+    """Wrap service.start / service.execute_function to feed the tracker.
+
+    Activation peaks are only sampled when no other inference is in flight,
+    because the allocator counters are process-wide.
+    """
+    if getattr(service, "_vram_attribution_installed", False):
+        return
+    service._vram_attribution_installed = True
+
+    original_start = service.start
+    original_execute = service.execute_function
+    state = {"active_model": None, "in_flight": 0}
+
+    @functools.wraps(original_start)
+    def start(model_id, *args, **kwargs):
+        previous = list(getattr(service, "worker_backends", None) or [])
+        previous_bytes = weight_bytes(previous)
+        previous_refs = []
+        for backend in previous:
+            for module in iter_torch_modules(backend):
+                try:
+                    previous_refs.append(weakref.ref(module))
+                except TypeError:
+                    pass
+        del previous
+
+        probe = AllocatorProbe().begin()
+        ok = original_start(model_id, *args, **kwargs)
+        if ok:
+            gc.collect()
+            released = previous_bytes if all(ref() is None for ref in previous_refs) else 0
+            try:
+                fp = measure_load(model_id, getattr(service, "worker_backends", None), probe, released)
+                tracker.record_footprint(model_id, fp)
+            except Exception as e:
+                print(f"[VRAM] Failed to measure load of {model_id}: {e}")
+            state["active_model"] = model_id
+        return ok
+
+    @functools.wraps(original_execute)
+    async def execute_function(*args, **kwargs):
+        model_id = state["active_model"]
+        solo = state["in_flight"] == 0
+        state["in_flight"] += 1
+        probe = AllocatorProbe().begin(reset_peak=solo) if solo and model_id else None
+        try:
+            return await original_execute(*args, **kwargs)
+        finally:
+            state["in_flight"] -= 1
+            if probe is not None:
+                try:
+                    tracker.record_inference(model_id, probe)
+                except Exception as e:
+                    print(f"[VRAM] Failed to measure inference of {model_id}: {e}")
+
+    def attribute_inference_to(model_id):
+        """Charge later inference to model_id without measuring a load (it is already in memory)."""
+        state["active_model"] = model_id
+
+    service.start = start
+    service.execute_function = execute_function
+    service.attribute_inference_to = attribute_inference_to
+'''
+
+TRACKER_CLASS = '''from .vram_attribution import ModelFootprint, measure_inference, instrument_inference_service
+
+
+class ModelMemoryTracker:
+    """Track measured memory footprint per loaded model with Ghost Detection"""
+
+    # Fallback VRAM (MB) for models that have never been measured
+    EXPECTED_VRAM = {
+        "moondream-2": 2600,
+        "moondream-3": 2600,
+        "nsfw-detector": 800,
+        "sdxl-realism": 6000,
+        "sdxl-anime": 6000,
+        "sdxl-base": 6000,
+        "sdxl-surreal": 6000
+    }
+    DEFAULT_EXPECTED_VRAM = 2500
+    GHOST_THRESHOLD_MB = 1500
+
+    def __init__(self):
+        self.loaded_models = {}  # model_id -> {name, vram_mb, ram_mb, loaded_at, footprint}
+        self.footprints = {}  # model_id -> ModelFootprint (persists after unload)
+        self.last_known_vram = {}  # model_id -> vram_mb
+        self.base_vram = 0
+        self.base_ram = 0
+        self.ghost_vram_mb = 0
+        self.unattributed_vram_mb = 0
+        self.zombie_detected = False
+
+    def record_baseline(self):
+        """Record baseline memory before any models loaded"""
+        try:
+            if pynvml:
+                try:
+                    handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+                    memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    self.base_vram = (memory.total - memory.free) / (1024 * 1024)
+                    print(f"Baseline VRAM: {self.base_vram:.0f}MB")
+                except:
+                    pass
+            elif torch.cuda.is_available():
+                self.base_vram = torch.cuda.memory_allocated(0) / (1024 * 1024)
+            self.base_ram = psutil.Process().memory_info().rss / (1024 * 1024)
+        except:
+            pass
+
+    def record_footprint(self, model_id: str, footprint: ModelFootprint):
+        """Store a load measurement from vram_attribution"""
+        self.footprints[model_id] = footprint
+        print(f"[VRAM] {model_id}: weights={footprint.weights_bytes / 1048576:.0f}MB, "
+              f"cache/reserved={footprint.cache_reserved_bytes / 1048576:.0f}MB ({footprint.source})")
+
+    def record_inference(self, model_id: str, probe):
+        """Fold an inference measurement into the model's footprint"""
+        fp = self.footprints.get(model_id)
+        if fp is not None:
+            measure_inference(fp, probe)
+
+    def expected_vram_mb(self, model_id: str) -> int:
+        """Best available size for a model: measured footprint, else the static table"""
+        fp = self.footprints.get(model_id)
+        if fp is not None and fp.measured:
+            return int(fp.resident_bytes / (1024 * 1024))
+        return self.EXPECTED_VRAM.get(model_id, self.DEFAULT_EXPECTED_VRAM)
+
+    def get_footprint(self, model_id: str):
+        """Footprint dict for admission/eviction decisions (None if never measured)"""
+        fp = self.footprints.get(model_id)
+        return fp.as_dict() if fp is not None else None
+
+    def track_model_load(self, model_id: str, model_name: str):
+        import time
+        try:
+            self.loaded_models[model_id] = {
+                "id": model_id,
+                "name": model_name,
+                "vram_mb": 0,
+                "ram_mb": 0,
+                "loaded_at": int(time.time())
+            }
+            self.update_memory_usage()
+        except:
+            pass
+
+    def track_model_unload(self, model_id: str):
+        if model_id in self.loaded_models:
+            del self.loaded_models[model_id]
+            self.update_memory_usage()
+
+    def update_memory_usage(self):
+        """Attribute VRAM per model from measured footprints and calculate Ghost VRAM"""
+        try:
+            current_vram = 0
+
+            # 1. Get Actual Device Usage
+            if pynvml:
+                try:
+                    handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+                    memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    current_vram = (memory.total - memory.free) / (1024 * 1024)
+                except:
+                    pass
+            if current_vram == 0 and torch.cuda.is_available():
+                current_vram = torch.cuda.memory_reserved(0) / (1024 * 1024)
+
+            effective_vram = max(0, current_vram - self.base_vram)
+
+            # 2. Per-model sizes come from measurements, not from a split
+            attributed_vram = 0
+            for mid, entry in self.loaded_models.items():
+                fp = self.footprints.get(mid)
+                if fp is not None and fp.measured:
+                    entry["vram_mb"] = int(fp.resident_bytes / (1024 * 1024))
+                    entry["ram_mb"] = int(fp.host_bytes / (1024 * 1024))
+                    entry["footprint"] = fp.as_dict()
+                else:
+                    entry["vram_mb"] = self.expected_vram_mb(mid)
+                    entry["footprint"] = None
+                attributed_vram += entry["vram_mb"]
+                self.last_known_vram[mid] = entry["vram_mb"]
+
+            # 3. Whatever the device uses beyond our models is unattributed
+            self.unattributed_vram_mb = int(max(0, effective_vram - attributed_vram))
+            if self.unattributed_vram_mb > self.GHOST_THRESHOLD_MB:
+                self.ghost_vram_mb = self.unattributed_vram_mb
+                if not self.zombie_detected:
+                    print(f"[Tracker] ZOMBIE DETECTED! Attributed: {attributed_vram}MB, Actual: {effective_vram:.0f}MB, Ghost: {self.ghost_vram_mb}MB")
+                self.zombie_detected = True
+            else:
+                self.ghost_vram_mb = 0
+                self.zombie_detected = False
+
+        except Exception as e:
+            print(f"Failed to update memory usage: {e}")
+
+    def get_loaded_models(self):
+        """Get list of loaded models"""
+        self.update_memory_usage()
+        return list(self.loaded_models.values())
+
+    def get_ghost_status(self):
+        """Get ghost memory status"""
+        return {
+            "detected": self.zombie_detected,
+            "ghost_vram_mb": self.ghost_vram_mb,
+            "unattributed_vram_mb": self.unattributed_vram_mb
+        }
+
+    def get_last_known_vram(self, model_id: str) -> int:
+        return self.last_known_vram.get(model_id, 0)'''
+
+INSTRUMENT_ANCHOR = 'self.app.include_router(system_router, prefix="/v1/system", tags=["System"])'
+
+
+def apply_patch():
+    """Apply the patch to rest_server.py in moondream-station"""
+
+    # Find moondream-station directory
+    moondream_dir = os.path.expanduser("~/.moondream-station/moondream-station")
+    rest_server_path = os.path.join(moondream_dir, "moondream_station/core/rest_server.py")
+    module_path = os.path.join(moondream_dir, "moondream_station/core/vram_attribution.py")
+
+    if not os.path.exists(rest_server_path):
+        print(f"❌ rest_server.py not found at {rest_server_path}")
+        return False
+
+    print(f"📝 Reading {rest_server_path}")
+    with open(rest_server_path, 'r') as f:
+        content = f.read()
+
+    # 1. Install the attribution module (always refreshed)
+    print(f"📦 Installing {module_path}")
+    with open(module_path, 'w') as f:
+        f.write(ATTRIBUTION_MODULE)
+
+    if "from .vram_attribution import" in content:
+        print("✅ Already patched - vram_attribution tracker found")
+        return True
+
+    # 2. Replace the tracker class (same block boundaries as the ghost patch)
+    pattern = re.compile(r'class ModelMemoryTracker:.*?# Global tracker instance', re.DOTALL)
+    match = pattern.search(content)
+    if not match:
+        print("❌ Could not find ModelMemoryTracker block")
+        return False
+    content = content.replace(match.group(0), TRACKER_CLASS + "\n\n# Global tracker instance")
+    print("✓ Replaced ModelMemoryTracker with measured attribution")
+
+    # 3. Instrument the inference service once routes are being set up
+    if INSTRUMENT_ANCHOR in content:
+        line_start = content.rfind("\n", 0, content.find(INSTRUMENT_ANCHOR)) + 1
+        indent = content[line_start:content.find(INSTRUMENT_ANCHOR)]
+        injection = (
+            f"# Measure per-model VRAM around loads and inference\n"
+            f"{indent}instrument_inference_service(self.inference_service, model_memory_tracker)\n"
+            f"{indent}"
+        )
+        content = content.replace(INSTRUMENT_ANCHOR, injection + INSTRUMENT_ANCHOR, 1)
+        print("✓ Instrumented inference_service.start / execute_function")
+    else:
+        print("⚠️  Could not find router setup hook - loads will not be measured")
+
+    # Write patched content
+    backup_path = rest_server_path + '.backup_attribution'
+    print(f"💾 Creating backup at {backup_path}")
+    with open(backup_path, 'w') as f:
+        with open(rest_server_path, 'r') as orig:
+            f.write(orig.read())
+
+    print(f"✍️  Writing patched content")
+    with open(rest_server_path, 'w') as f:
+        f.write(content)
+
+    print("✅ Patch applied successfully!")
+    print("\n📋 Next steps:")
+    print("   1. Restart moondream-station server")
+    print("   2. Load two models and run one request against each")
+    print("   3. curl http://localhost:2020/metrics - each loaded model has a 'footprint'")
+    print("      with weights_mb, activation_peak_mb and cache_reserved_mb")
+
+    return True
+
+if __name__ == "__main__":
+    print("🔧 Moondream Station - Per-Model VRAM Attribution")
+    print("=" * 60)
+
+    if apply_patch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
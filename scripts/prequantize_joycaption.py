@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Convert JoyCaption Alpha 2 to a pre-quantized 4-bit checkpoint, once.
+
+The backend otherwise reads the 8GB fp16 checkpoint and quantizes it with
+bitsandbytes on every load. This script loads it quantized one time and
+saves the 4-bit weights (safetensors) plus the processor to
+~/.moondream-station/models/quantized/joycaption-alpha-2-nf4/ with a
+prequantized.json recording the source weights' hash. With
+scripts/patches/patch_joycaption_prequantized.py applied, the backend loads
+that copy directly as long as the source is unchanged.
+
+Needs a CUDA GPU (bitsandbytes quantizes on the device).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import torch
+from transformers import AutoProcessor, BitsAndBytesConfig, LlavaForConditionalGeneration
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "patches"))
+
+from patch_joycaption_prequantized import PREQUANTIZED_MODULE  # noqa: E402
+
+# The backend checks staleness with moondream_station/core/prequantized.py: use its helpers
+_prequantized = {"__name__": "prequantized"}
+exec(compile(PREQUANTIZED_MODULE, "prequantized.py", "exec"), _prequantized)
+MANIFEST = _prequantized["MANIFEST"]
+signature = _prequantized["signature"]
+content_hash = _prequantized["content_hash"]
+
+REPO_ID = "fancyfeast/llama-joycaption-alpha-two-hf-llava"
+QUANTIZED_DIR = _prequantized["_root"]()  # MOONDREAM_PREQUANTIZED_DIR or the default
+
+
+def resolve_source(source):
+    if os.path.isdir(source):
+        return os.path.realpath(source), None
+    from huggingface_hub import snapshot_download
+    try:
+        path = snapshot_download(source, local_files_only=True)
+    except Exception:
+        print(f"{source} not in the HF cache, downloading...")
+        path = snapshot_download(source)
+    return os.path.realpath(path), source
+
+
+def dir_size_gb(path):
+    return sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path)) / 1024 ** 3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save JoyCaption as a pre-quantized 4-bit checkpoint")
+    parser.add_argument("--source", default=REPO_ID, help="local model directory or HF repo id")
+    parser.add_argument("--output", default=os.path.join(QUANTIZED_DIR, "joycaption-alpha-2-nf4"))
+    parser.add_argument("--quant-type", default="nf4", choices=["nf4", "fp4"])
+    parser.add_argument("--no-double-quant", action="store_true")
+    parser.add_argument("--force", action="store_true", help="convert even if an up-to-date copy exists")
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        raise SystemExit("✗ bitsandbytes 4-bit quantization needs a CUDA GPU")
+
+    source, repo_id = resolve_source(args.source)
+    print(f"Source: {source} ({dir_size_gb(source):.1f} GB)")
+    manifest_path = os.path.join(args.output, MANIFEST)
+    if not args.force and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            existing = json.load(f)
+        if existing.get("source_files") == signature(source):
+            print(f"✓ {args.output} is up to date (use --force to convert again)")
+            raise SystemExit(0)
+
+    started = time.perf_counter()
+    source_hash = content_hash(source)
+    print(f"✓ Source hash {source_hash} ({time.perf_counter() - started:.0f}s)")
+
+    quantization = {
+        "load_in_4bit": True,
+        "bnb_4bit_quant_type": args.quant_type,
+        "bnb_4bit_use_double_quant": not args.no_double_quant,
+    }
+    started = time.perf_counter()
+    model = LlavaForConditionalGeneration.from_pretrained(
+        source,
+        quantization_config=BitsAndBytesConfig(**quantization, bnb_4bit_compute_dtype=torch.float16),
+        torch_dtype=torch.float16,
+        device_map={"": 0},
+        low_cpu_mem_usage=True,
+    )
+    print(f"✓ Quantized in {time.perf_counter() - started:.0f}s")
+
+    # Write next to the target and swap, so a failed run never leaves a half-written copy
+    partial = args.output + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    model.save_pretrained(partial, safe_serialization=True, max_shard_size="2GB")
+    AutoProcessor.from_pretrained(source).save_pretrained(partial)
+
+    import bitsandbytes
+    import transformers
+    with open(os.path.join(partial, MANIFEST), "w") as f:
+        json.dump({
+            "source": source,
+            "repo_id": repo_id,
+            "source_hash": source_hash,
+            "source_files": signature(source),
+            "quantization": quantization,
+            "versions": {
+                "torch": torch.__version__,
+                "transformers": transformers.__version__,
+                "bitsandbytes": bitsandbytes.__version__,
+            },
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f, indent=2)
+    shutil.rmtree(args.output, ignore_errors=True)
+    os.replace(partial, args.output)
+
+    print()
+    print("=" * 60)
+    print(f"✅ Saved {dir_size_gb(args.output):.1f} GB to {args.output}")
+    print()
+    print("Next steps:")
+    print("1. python3 scripts/patches/patch_joycaption_prequantized.py (once)")
+    print("2. Restart moondream-station server")
+    print("3. python3 scripts/benchmark_joycaption_load.py")
+    print("=" * 60)
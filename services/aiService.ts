@@ -102,7 +102,8 @@ async function executeWithFallback<T>(
     funcName: FunctionName,
     coreArgs: any[],
     onProgress?: (update: { provider: AiProvider, status: 'attempting' | 'failed_attempt', message?: string }) => void,
-    onStatus?: (message: string) => void
+    onStatus?: (message: string) => void,
+    priority?: number
 ): Promise<T> {
     const requiredCapability = getCapabilityForFunction(funcName);
     let providerOrder = settings.routing[requiredCapability] || [];
@@ -152,7 +153,7 @@ async function executeWithFallback<T>(
             logger.info(`Attempting ${funcName} with ${providerId}...`, 'AI Service');
             onProgress?.({ provider: providerId, status: 'attempting' });
             // Call the function on the provider instance
-            return await providerFunc.call(provider, ...finalCoreArgs, settings, onStatus);
+            return await providerFunc.call(provider, ...finalCoreArgs, settings, onStatus, priority);
         } catch (e: any) {
             lastError = e;
             failedAttempts.push({ provider: providerId, error: e.message });
@@ -183,7 +184,8 @@ export const analyzeImage = async (
     image: ImageInfo,
     settings: AdminSettings,
     onProgress?: (update: { provider: AiProvider, status: 'attempting' | 'failed_attempt', message?: string }) => void,
-    onStatus?: (message: string) => void
+    onStatus?: (message: string) => void,
+    priority?: number
 ): Promise<ImageAnalysisResult> => {
     // Check routing configuration
     const captionRoute = settings.routing.captioning || [];
@@ -200,13 +202,13 @@ export const analyzeImage = async (
     // to save time and API costs (most providers do both in one pass).
     // Ensure that provider is also the primary vision provider to use valid routing logic.
     if (effectiveCaptionProvider === effectiveTaggingProvider && effectiveCaptionProvider === visionRoute[0]) {
-        result = await executeWithFallback<ImageAnalysisResult>(settings, 'analyzeImage', [image], onProgress, onStatus);
+        result = await executeWithFallback<ImageAnalysisResult>(settings, 'analyzeImage', [image], onProgress, onStatus, priority);
     } else {
         // Split execution
         if (onStatus) onStatus('Running distributed analysis (Captions + Tags)...');
 
-        const captionPromise = executeWithFallback<string>(settings, 'captionImage', [image], onProgress);
-        const taggingPromise = executeWithFallback<string[]>(settings, 'tagImage', [image], onProgress);
+        const captionPromise = executeWithFallback<string>(settings, 'captionImage', [image], onProgress, undefined, priority);
+        const taggingPromise = executeWithFallback<string[]>(settings, 'tagImage', [image], onProgress, undefined, priority);
 
         const [recreationPrompt, keywords] = await Promise.all([captionPromise, taggingPromise]);
 
@@ -337,7 +339,8 @@ export const animateImage = async (
 
 export const batchTagImages = async (
     images: ImageInfo[],
-    settings: AdminSettings
+    settings: AdminSettings,
+    priority?: number
 ): Promise<{ tags: string[], imageId: string }[]> => {
     // Currently only Moondream Local supports batching via our explicit implementation
     // We bypass the generic executeWithFallback for this specific specialized features
@@ -345,7 +348,7 @@ export const batchTagImages = async (
     if (!provider) throw new Error("Moondream Local provider not found");
 
     if ((provider as any).batchTagImages) {
-        return await (provider as any).batchTagImages(images, settings);
+        return await (provider as any).batchTagImages(images, settings, priority);
     }
     throw new Error("Provider does not support batch tagging");
 };
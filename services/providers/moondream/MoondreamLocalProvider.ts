@@ -94,7 +94,7 @@ export class MoondreamLocalProvider extends BaseProvider {
         }
     }
 
-    async captionImage(image: ImageInfo, settings: AdminSettings): Promise<string> {
+    async captionImage(image: ImageInfo, settings: AdminSettings, onStatus?: (message: string) => void, priority?: number): Promise<string> {
         const config = settings.providers.moondream_local;
         const modelOverride = config.captionModel;
 
@@ -112,11 +112,11 @@ export class MoondreamLocalProvider extends BaseProvider {
             };
         }
 
-        const result = await this.analyzeImage(image, effectiveSettings);
+        const result = await this.analyzeImage(image, effectiveSettings, onStatus, priority);
         return result.recreationPrompt;
     }
 
-    async tagImage(image: ImageInfo, settings: AdminSettings): Promise<string[]> {
+    async tagImage(image: ImageInfo, settings: AdminSettings, onStatus?: (message: string) => void, priority?: number): Promise<string[]> {
         const config = settings.providers.moondream_local;
         const modelOverride = config.taggingModel;
 
@@ -153,13 +153,13 @@ export class MoondreamLocalProvider extends BaseProvider {
 
             let text = "";
             try {
-                const result = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode);
+                const result = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode, priority);
                 text = result.text;
             } catch (err) {
                 if ((modelOverride === "wd-vit-tagger-v3" || !modelOverride) && err instanceof Error) {
                     console.warn("[WD14] V3 failed, attempting fallback to wd14-vit-v2...");
                     body.model = "wd14-vit-v2";
-                    const result = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode);
+                    const result = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode, priority);
                     text = result.text;
                 } else {
                     throw err;
@@ -226,7 +226,7 @@ export class MoondreamLocalProvider extends BaseProvider {
                             max_tokens: 10
                         };
 
-                        const { text: mdAnswer } = await callMoondreamApi(apiUrl, "", handoffBody, false, 60, vramMode);
+                        const { text: mdAnswer } = await callMoondreamApi(apiUrl, "", handoffBody, false, 60, vramMode, priority);
                         const mdRating = mdAnswer.trim().toUpperCase().replace(/[^A-Z0-9-]/g, '');
 
                         if (['PG', 'PG-13', 'R', 'X', 'XXX'].includes(mdRating)) {
@@ -244,11 +244,11 @@ export class MoondreamLocalProvider extends BaseProvider {
             return tags;
         }
 
-        const result = await this.analyzeImage(image, effectiveSettings);
+        const result = await this.analyzeImage(image, effectiveSettings, onStatus, priority);
         return result.keywords;
     }
 
-    async batchTagImages(images: ImageInfo[], settings: AdminSettings): Promise<{ tags: string[], imageId: string }[]> {
+    async batchTagImages(images: ImageInfo[], settings: AdminSettings, priority?: number): Promise<{ tags: string[], imageId: string }[]> {
         const config = settings.providers.moondream_local;
 
         // FAST TAG Mode: Always use WD14 for optimal batch performance
@@ -265,7 +265,7 @@ export class MoondreamLocalProvider extends BaseProvider {
         };
 
         try {
-            const result = await callMoondreamApi(apiUrl, "", body, false, 120, settings.performance?.vramUsage || 'balanced');
+            const result = await callMoondreamApi(apiUrl, "", body, false, 120, settings.performance?.vramUsage || 'balanced', priority);
             const json = JSON.parse(result.text);
             if (!json.captions || !Array.isArray(json.captions)) {
                 throw new Error("Invalid batch response format");
@@ -288,7 +288,8 @@ export class MoondreamLocalProvider extends BaseProvider {
     async analyzeImage(
         image: ImageInfo,
         settings: AdminSettings,
-        onStatus?: (message: string) => void
+        onStatus?: (message: string) => void,
+        priority?: number
     ): Promise<ImageAnalysisResult> {
         const providerConfig = settings?.providers?.moondream_local || {};
         const { endpoint, model, taggingModel } = providerConfig as any;
@@ -301,7 +302,7 @@ export class MoondreamLocalProvider extends BaseProvider {
             const classifyUrl = `${baseUrl}/v1/classify`;
             const body = { image_url: image.dataUrl, model: 'nsfw-detector' };
             const vramMode = settings.performance?.vramUsage || 'balanced';
-            const { text: responseText, stats } = await callMoondreamApi(classifyUrl, "", body, false, 120, vramMode);
+            const { text: responseText, stats } = await callMoondreamApi(classifyUrl, "", body, false, 120, vramMode, priority);
 
             try {
                 const result = JSON.parse(responseText);
@@ -344,7 +345,7 @@ export class MoondreamLocalProvider extends BaseProvider {
                         max_tokens: 1024
                     };
                     const vramMode = settings.performance?.vramUsage || 'balanced';
-                    return await callMoondreamApi(apiUrl, "", body, false, 120, vramMode);
+                    return await callMoondreamApi(apiUrl, "", body, false, 120, vramMode, priority);
                 },
                 onStatus
             );
@@ -358,13 +359,13 @@ export class MoondreamLocalProvider extends BaseProvider {
             };
 
             const vramMode = settings.performance?.vramUsage || 'balanced';
-            const { text: responseText, stats } = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode);
+            const { text: responseText, stats } = await callMoondreamApi(apiUrl, "", body, false, 120, vramMode, priority);
             result = { recreationPrompt: responseText, keywords: [], stats };
         }
 
         if (taggingModel && taggingModel !== model) {
             try {
-                const tags = await this.tagImage(image, settings);
+                const tags = await this.tagImage(image, settings, onStatus, priority);
                 result.keywords = [...(result.keywords || []), ...tags];
             } catch (error) {
                 try {
@@ -379,7 +380,7 @@ export class MoondreamLocalProvider extends BaseProvider {
                         }],
                         max_tokens: 100
                     };
-                    const { text } = await callMoondreamApi(apiUrl, "", fallbackBody, false, 60, "balanced");
+                    const { text } = await callMoondreamApi(apiUrl, "", fallbackBody, false, 60, "balanced", priority);
                     const fallbackTags = text.split(',').map(t => t.trim().toLowerCase()).filter(t => t.length > 0);
                     result.keywords = [...(result.keywords || []), ...fallbackTags];
                 } catch (e) {
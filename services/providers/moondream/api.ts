@@ -22,7 +22,8 @@ export const callMoondreamApi = async (
     body: object,
     isCloud: boolean,
     timeoutSeconds: number = 120,
-    vramMode: string = 'balanced'
+    vramMode: string = 'balanced',
+    priority?: number
 ): Promise<{ text: string, stats?: any }> => {
     if (!fullUrl) {
         throw new Error("Moondream API endpoint URL is missing.");
@@ -33,6 +34,11 @@ export const callMoondreamApi = async (
         'X-VRAM-Mode': vramMode
     };
 
+    // Queue priority (types/queue.ts: 0=Background ... 3=Immediate); the server serves higher first
+    if (priority !== undefined) {
+        headers['X-Priority'] = String(priority);
+    }
+
     if (apiKey) {
         if (isCloud) {
             headers['X-Moondream-Auth'] = apiKey;
@@ -62,7 +68,7 @@ export const callMoondreamApi = async (
             // Catch OOM in 500/Hard Errors
             if (response.status === 500 && errorBody.includes('CUDA out of memory') && vramMode !== 'low') {
                 console.warn(`[Moondream API] OOM Detected (500). Retrying with 'low' VRAM mode...`);
-                return await callMoondreamApi(fullUrl, apiKey, body, isCloud, timeoutSeconds, 'low');
+                return await callMoondreamApi(fullUrl, apiKey, body, isCloud, timeoutSeconds, 'low', priority);
             }
 
             throw new Error(`Moondream API error (${response.status}): ${errorBody}`);
@@ -137,7 +143,7 @@ export const callMoondreamApi = async (
                 const errStr = parsed.error;
                 if (typeof errStr === 'string' && errStr.includes('CUDA out of memory') && vramMode !== 'low') {
                     console.warn(`[Moondream API] OOM Detected. Retrying with 'low' VRAM mode to force unload...`);
-                    return await callMoondreamApi(fullUrl, apiKey, body, isCloud, timeoutSeconds, 'low');
+                    return await callMoondreamApi(fullUrl, apiKey, body, isCloud, timeoutSeconds, 'low', priority);
                 }
                 throw new Error(`Model returned an error: ${parsed.error}`);
             }
@@ -150,9 +156,19 @@ export const callMoondreamApi = async (
             vramUsedMB: parseFloat(response.headers.get('X-VRAM-Used') || '0'),
             vramTotalMB: parseFloat(response.headers.get('X-VRAM-Total') || '0'),
             inferenceTimeMs: parseFloat(response.headers.get('X-Inference-Time') || '0'),
-            modelLoadTimeMs: parseFloat(response.headers.get('X-Model-Load-Time') || '0')
+            modelLoadTimeMs: parseFloat(response.headers.get('X-Model-Load-Time') || '0'),
+            encoderTimeMs: parseFloat(response.headers.get('X-Encoder-Time') || '0'),
+            encoderSavedMs: parseFloat(response.headers.get('X-Encoder-Saved') || '0')
         };
 
+        // Capacity signal (patch_capacity_signal.py); absent on older servers
+        const recommended = response.headers.get('X-Recommended-Concurrency');
+        if (recommended) perfMetrics.recommendedConcurrency = parseInt(recommended, 10);
+        const queueDepth = response.headers.get('X-Queue-Depth');
+        if (queueDepth) perfMetrics.queueDepth = parseInt(queueDepth, 10);
+        const estimatedWait = response.headers.get('X-Estimated-Wait-Ms');
+        if (estimatedWait) perfMetrics.estimatedWaitMs = parseFloat(estimatedWait);
+
         if (perfMetrics.vramTotalMB > 0) {
             perfMetrics.vramUsagePercent = (perfMetrics.vramUsedMB! / perfMetrics.vramTotalMB) * 100;
         }
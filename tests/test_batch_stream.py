@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "patches"))
+
+from patch_batch_stream import STREAM_MODULE  # noqa: E402
+
+
+def load_stream_module():
+    """batch_stream.py as the patch installs it."""
+    namespace = {"__name__": "batch_stream"}
+    exec(compile(STREAM_MODULE, "batch_stream.py", "exec"), namespace)
+    return namespace
+
+
+class FakeImage:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+async def fake_decode(b64_list):
+    """Stand-in decoder: "bad" fails to decode, anything else becomes a FakeImage."""
+    return [ValueError("not an image") if b == "bad" else FakeImage(b) for b in b64_list]
+
+
+class FakeService:
+    """Native batching; an image named "boom" makes any call that contains it raise."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def execute_function(self, function_name, image=None, **kwargs):
+        names = [i.name for i in image] if isinstance(image, list) else image.name
+        self.calls.append(names)
+        if "boom" in (names if isinstance(names, list) else [names]):
+            raise RuntimeError("CUDA error")
+        if isinstance(image, list):
+            return [{"caption": name} for name in names]
+        return {"caption": names}
+
+
+class TestStreamBatch(unittest.TestCase):
+    def setUp(self):
+        module = load_stream_module()
+        self.stream_batch = module["stream_batch"]
+        self.batch_items = module["batch_items"]
+
+    def collect(self, service, images, sub_batch=2, sse=False):
+        items = [[f"id{i}", image] for i, image in enumerate(images)]
+
+        async def main():
+            return [frame async for frame in self.stream_batch(
+                service, "caption", items, sub_batch, {"length": "short"}, sse, decode=fake_decode
+            )]
+
+        return asyncio.run(main())
+
+    def test_one_line_per_image_then_done(self):
+        service = FakeService()
+        lines = [json.loads(frame) for frame in self.collect(service, ["a", "b", "c"])]
+        self.assertEqual([line.get("result") for line in lines[:3]], [{"caption": n} for n in "abc"])
+        self.assertEqual([line["index"] for line in lines[:3]], [0, 1, 2])
+        self.assertEqual(lines[3]["done"], True)
+        self.assertEqual(lines[3]["count"], 3)
+        self.assertEqual(lines[3]["errors"], 0)
+        self.assertEqual(service.calls, [["a", "b"], ["c"]])
+
+    def test_failed_sub_batch_is_replayed_per_image(self):
+        service = FakeService()
+        lines = [json.loads(frame) for frame in self.collect(service, ["a", "boom", "c", "d"])]
+        self.assertEqual(lines[0]["result"], {"caption": "a"})
+        self.assertIn("CUDA error", lines[1]["error"])
+        self.assertEqual(lines[2]["result"], {"caption": "c"})
+        self.assertEqual(lines[3]["result"], {"caption": "d"})
+        self.assertEqual(lines[4]["errors"], 1)
+        self.assertEqual(service.calls, [["a", "boom"], "a", "boom", ["c", "d"]])
+
+    def test_wrong_shaped_result_is_replayed_per_image(self):
+        service = FakeService()
+
+        async def single(function_name, image=None, **kwargs):
+            service.calls.append(image if not isinstance(image, list) else "list")
+            return {"caption": "merged"} if isinstance(image, list) else {"caption": image.name}
+
+        service.execute_function = single
+        lines = [json.loads(frame) for frame in self.collect(service, ["a", "b"])]
+        self.assertEqual([line["result"] for line in lines[:2]], [{"caption": "a"}, {"caption": "b"}])
+
+    def test_decode_error_is_reported_in_place(self):
+        service = FakeService()
+        lines = [json.loads(frame) for frame in self.collect(service, ["a", "bad", "c"], sub_batch=3)]
+        self.assertIn("decode failed", lines[0]["error"])
+        self.assertEqual(lines[0]["index"], 1)
+        self.assertEqual([line["index"] for line in lines[1:3]], [0, 2])
+        self.assertEqual(service.calls, [["a", "c"]])
+        self.assertEqual(lines[3]["errors"], 1)
+
+    def test_sse_frames(self):
+        frames = self.collect(FakeService(), ["a"], sse=True)
+        self.assertTrue(frames[0].startswith("event: result\ndata: "))
+        self.assertTrue(frames[0].endswith("\n\n"))
+        self.assertTrue(frames[-1].startswith("event: done\n"))
+
+    def test_batch_items_forms(self):
+        self.assertEqual(self.batch_items({"items": [{"id": "x", "image": "a"}, {"image": "b"}]}), [["x", "a"], ["1", "b"]])
+        self.assertEqual(self.batch_items({"images": ["a", "b"]}), [["0", "a"], ["1", "b"]])
+        with self.assertRaises(ValueError):
+            self.batch_items({"images": ["a"], "ids": ["x", "y"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
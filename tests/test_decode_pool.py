@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "patches"))
+
+from patch_decode_pool import DECODE_MODULE  # noqa: E402
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def load_decode_module():
+    """decode_pool.py as the patch installs it."""
+    namespace = {"__name__": "decode_pool"}
+    exec(compile(DECODE_MODULE, "decode_pool.py", "exec"), namespace)
+    return namespace
+
+
+def encode(image, fmt="PNG"):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class TestDecodeBytes(unittest.TestCase):
+    def setUp(self):
+        if Image is None:
+            self.skipTest("Pillow not installed")
+        self.decode_bytes = load_decode_module()["decode_bytes"]
+
+    def assert_reduced(self, raw, target):
+        image, full_size = self.decode_bytes(raw, target)
+        self.assertEqual(full_size, (2000, 1500))
+        self.assertEqual(image.mode, "RGB")
+        self.assertGreaterEqual(min(image.size), target)
+        self.assertLess(image.size[0], 2000)
+
+    def test_reduces_modes_reduce_does_not_take(self):
+        sources = {
+            "P": Image.new("RGB", (2000, 1500), (200, 30, 30)).convert("P", palette=Image.Palette.ADAPTIVE),
+            "1": Image.new("1", (2000, 1500), 1),
+            "I;16": Image.new("I;16", (2000, 1500), 40000),
+        }
+        for mode, source in sources.items():
+            for target in (384, 448):
+                with self.subTest(mode=mode, target=target):
+                    self.assert_reduced(encode(source), target)
+
+    def test_reduces_gif(self):
+        self.assert_reduced(encode(Image.new("RGB", (2000, 1500), (0, 90, 0)).convert("P", palette=Image.Palette.ADAPTIVE), "GIF"), 384)
+
+    def test_palette_colour_survives_reduce(self):
+        raw = encode(Image.new("RGB", (2000, 1500), (200, 30, 30)).convert("P", palette=Image.Palette.ADAPTIVE))
+        image, _ = self.decode_bytes(raw, 384)
+        self.assertEqual(image.getpixel((0, 0)), (200, 30, 30))
+
+    def test_full_size_without_target(self):
+        image, full_size = self.decode_bytes(encode(Image.new("L", (640, 480), 128)), None)
+        self.assertEqual(image.size, full_size)
+        self.assertEqual(image.mode, "RGB")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import signal
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+from gpu_process_inspector import (  # noqa: E402
+    ChildRegistry,
+    GpuProcessInspector,
+    kill_orphans,
+    reclaim_in_process,
+)
+
+MB = 1024 * 1024
+
+
+class FakeNvml:
+    """Stands in for NvmlProvider: one device, fixed per-process usage."""
+
+    def __init__(self, processes, total=24000 * MB):
+        self._processes = processes
+        self._total = total
+
+    def device_count(self):
+        return 1
+
+    def device_memory(self, index):
+        return self._total, sum(used for _, used in self._processes) + 300 * MB
+
+    def processes(self, index):
+        return list(self._processes)
+
+
+class FakeProcessTable:
+    def __init__(self, procs, tree=None):
+        self.procs = dict(procs)  # pid -> {ppid, create_time, cmdline}
+        self.tree = tree or {}
+
+    def info(self, pid):
+        proc = self.procs.get(pid)
+        return {"pid": pid, **proc} if proc else None
+
+    def descendants(self, pid):
+        return list(self.tree.get(pid, []))
+
+
+SERVER = 100
+WORKER = 101
+XORG = 200
+
+
+def make_table():
+    return FakeProcessTable(
+        {
+            SERVER: {"ppid": 1, "create_time": 1000.0, "cmdline": "python3 start_server.py"},
+            WORKER: {"ppid": SERVER, "create_time": 1001.0, "cmdline": "python3 -m worker sdxl"},
+            XORG: {"ppid": 1, "create_time": 10.0, "cmdline": "/usr/lib/xorg/Xorg"},
+        },
+        tree={SERVER: [WORKER]},
+    )
+
+
+class TestGpuProcessInspector(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.registry = ChildRegistry(os.path.join(self.tmp.name, "gpu_children.json"))
+        self.nvml = FakeNvml([(SERVER, 3000 * MB), (WORKER, 6000 * MB), (XORG, 500 * MB)])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_classifies_own_children_and_foreign(self):
+        inspector = GpuProcessInspector(self.nvml, make_table(), self.registry, server_pid=SERVER)
+        report = inspector.inspect()
+
+        self.assertTrue(report.available)
+        categories = {p["pid"]: p["category"] for p in report.processes}
+        self.assertEqual(categories, {SERVER: "self", WORKER: "child", XORG: "foreign"})
+        self.assertEqual(report.own_mb, 9000)
+        self.assertEqual(report.foreign_mb, 500)
+        self.assertEqual(report.orphan_mb, 0)
+        self.assertEqual(report.devices[0]["unattributed_mb"], 300)
+
+    def test_child_becomes_orphan_after_server_dies(self):
+        table = make_table()
+        GpuProcessInspector(self.nvml, table, self.registry, server_pid=SERVER).inspect()
+
+        # Server crashes; worker is reparented to init and keeps its VRAM
+        del table.procs[SERVER]
+        table.procs[WORKER]["ppid"] = 1
+        table.tree = {}
+        nvml = FakeNvml([(WORKER, 6000 * MB), (XORG, 500 * MB)])
+        report = GpuProcessInspector(nvml, table, ChildRegistry(self.registry.path)).inspect()
+
+        categories = {p["pid"]: p["category"] for p in report.processes}
+        self.assertEqual(categories[WORKER], "orphan")
+        self.assertEqual(categories[XORG], "foreign")
+        self.assertEqual(report.orphan_mb, 6000)
+
+    def test_reused_pid_is_not_an_orphan(self):
+        table = make_table()
+        GpuProcessInspector(self.nvml, table, self.registry, server_pid=SERVER).inspect()
+
+        del table.procs[SERVER]
+        table.procs[WORKER] = {"ppid": 1, "create_time": 5000.0, "cmdline": "python3 -m worker sdxl"}
+        self.assertFalse(ChildRegistry(self.registry.path).confirmed_orphan(WORKER, table))
+
+    def test_kill_only_targets_confirmed_orphans(self):
+        table = make_table()
+        GpuProcessInspector(self.nvml, table, self.registry, server_pid=SERVER).inspect()
+        del table.procs[SERVER]
+        table.procs[WORKER]["ppid"] = 1
+        table.tree = {}
+
+        signals = []
+
+        def fake_kill(pid, sig):
+            signals.append((pid, sig))
+            table.procs.pop(pid, None)
+
+        nvml = FakeNvml([(WORKER, 6000 * MB), (XORG, 500 * MB)])
+        inspector = GpuProcessInspector(nvml, table, ChildRegistry(self.registry.path))
+        killed = kill_orphans(inspector, kill=fake_kill, sleep=lambda _: None)
+
+        self.assertEqual(signals, [(WORKER, signal.SIGTERM)])
+        self.assertEqual([k["pid"] for k in killed], [WORKER])
+
+    def test_live_child_is_never_killed(self):
+        signals = []
+        inspector = GpuProcessInspector(self.nvml, make_table(), self.registry, server_pid=SERVER)
+        inspector.inspect()
+        kill_orphans(inspector, kill=lambda pid, sig: signals.append(pid), sleep=lambda _: None)
+        self.assertEqual(signals, [])
+
+    def test_nvml_unavailable_reports_nothing(self):
+        inspector = GpuProcessInspector(False, make_table(), self.registry, server_pid=SERVER)
+        report = inspector.inspect()
+        self.assertFalse(report.available)
+        self.assertEqual(report.processes, [])
+
+    def test_reclaim_runs_hooks_before_collecting(self):
+        calls = []
+
+        def drop_sdxl():
+            calls.append("sdxl")
+
+        def failing_hook():
+            raise RuntimeError("backend busy")
+
+        result = reclaim_in_process([drop_sdxl, failing_hook])
+        steps = [s["step"] for s in result["steps"]]
+        self.assertEqual(calls, ["sdxl"])
+        self.assertEqual(steps[:3], ["drop_sdxl", "failing_hook", "gc.collect"])
+        self.assertFalse(result["steps"][1]["ok"])
+        self.assertIsNone(result["reclaimed_mb"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "patches"))
+
+from patch_micro_batching import BATCHER_MODULE  # noqa: E402
+
+
+def load_batcher_module():
+    """micro_batcher.py as the patch installs it."""
+    namespace = {"__name__": "micro_batcher"}
+    exec(compile(BATCHER_MODULE, "micro_batcher.py", "exec"), namespace)
+    return namespace
+
+
+class FakeService:
+    """execute_function that records its calls; lists are batched unless takes_lists is False."""
+
+    def __init__(self, takes_lists=True, bad_image=None):
+        self.takes_lists = takes_lists
+        self.bad_image = bad_image
+        self.calls = []
+
+    async def execute_function(self, function_name, image=None, **kwargs):
+        self.calls.append(image)
+        await asyncio.sleep(0)
+        if isinstance(image, list):
+            if not self.takes_lists:
+                raise TypeError("expected a single image")
+            if self.bad_image in image:
+                raise ValueError("cannot decode")
+            return [f"caption:{i}" for i in image]
+        if image == self.bad_image:
+            raise ValueError("cannot decode")
+        return f"caption:{image}"
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.MicroBatcher = load_batcher_module()["MicroBatcher"]
+
+    def run_captions(self, service, images, config=None, **kwargs):
+        config = {"current_model": "moondream-2", "micro_batch_window_ms": 20, **(config or {})}
+        batcher = self.MicroBatcher(service, config)
+        batcher.attach()
+
+        async def main():
+            calls = [service.execute_function("caption", image=image, **kwargs) for image in images]
+            return await asyncio.gather(*calls, return_exceptions=True)
+
+        return batcher, asyncio.run(main())
+
+    def test_groups_concurrent_calls_into_one_batch(self):
+        service = FakeService()
+        batcher, results = self.run_captions(service, ["a", "b", "c"], length="short")
+        self.assertEqual(results, ["caption:a", "caption:b", "caption:c"])
+        self.assertEqual(service.calls, [["a", "b", "c"]])
+        self.assertTrue(batcher.batchable["moondream-2"])
+
+    def test_different_settings_are_not_grouped(self):
+        service = FakeService()
+        batcher = self.MicroBatcher(service, {"current_model": "moondream-2", "micro_batch_window_ms": 20})
+        batcher.attach()
+
+        async def main():
+            return await asyncio.gather(
+                service.execute_function("caption", image="a", length="short"),
+                service.execute_function("caption", image="b", length="long"),
+            )
+
+        self.assertEqual(asyncio.run(main()), ["caption:a", "caption:b"])
+        self.assertEqual(sorted(service.calls), ["a", "b"])
+
+    def test_max_size_flushes_early(self):
+        service = FakeService()
+        _, results = self.run_captions(service, list("abcde"), config={"micro_batch_max_size": 2})
+        self.assertEqual(results, [f"caption:{i}" for i in "abcde"])
+        self.assertEqual(service.calls, [["a", "b"], ["c", "d"], "e"])
+
+    def test_list_rejecting_backend_is_replayed_and_never_batched_again(self):
+        service = FakeService(takes_lists=False)
+        batcher, results = self.run_captions(service, ["a", "b"])
+        self.assertEqual(results, ["caption:a", "caption:b"])
+        self.assertEqual(service.calls, [["a", "b"], "a", "b"])
+        self.assertIs(batcher.batchable["moondream-2"], False)
+
+        async def again():
+            return await asyncio.gather(*(service.execute_function("caption", image=i) for i in "cd"))
+
+        service.calls.clear()
+        self.assertEqual(asyncio.run(again()), ["caption:c", "caption:d"])
+        self.assertEqual(service.calls, ["c", "d"])
+        self.assertEqual(batcher.stats["passthrough"], 2)
+
+    def test_bad_image_fails_only_its_request_once_batching_is_known(self):
+        service = FakeService(bad_image="b")
+        batcher = self.MicroBatcher(service, {"current_model": "moondream-2", "micro_batch_window_ms": 20})
+        batcher.batchable["moondream-2"] = True
+        batcher.attach()
+
+        async def main():
+            calls = [service.execute_function("caption", image=i) for i in "abc"]
+            return await asyncio.gather(*calls, return_exceptions=True)
+
+        results = asyncio.run(main())
+        self.assertEqual(results[0], "caption:a")
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], "caption:c")
+        self.assertTrue(batcher.batchable["moondream-2"])
+        self.assertEqual(batcher.stats["fallbacks"], 1)
+
+    def test_wrong_shaped_result_disables_batching(self):
+        service = FakeService()
+
+        async def single_answer(function_name, image=None, **kwargs):
+            service.calls.append(image)
+            return "one caption" if isinstance(image, list) else f"caption:{image}"
+
+        service.execute_function = single_answer
+        batcher, results = self.run_captions(service, ["a", "b"])
+        self.assertEqual(results, ["caption:a", "caption:b"])
+        self.assertIs(batcher.batchable["moondream-2"], False)
+
+    def test_contract_without_native_batching_passes_through(self):
+        service = FakeService()
+        service.batch_support = lambda function_name: {"native": False}
+        batcher, results = self.run_captions(service, ["a", "b"])
+        self.assertEqual(results, ["caption:a", "caption:b"])
+        self.assertEqual(service.calls, ["a", "b"])
+        self.assertEqual(batcher.stats["passthrough"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
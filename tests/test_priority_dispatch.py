@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "patches"))
+
+from patch_priority_dispatch import DISPATCH_MODULE, SCHEDULER_MODULE  # noqa: E402
+
+PACKAGE = "_dispatch_test_core"
+
+
+def load_dispatch_module():
+    """priority_dispatch.py as the patch installs it, next to the affinity_scheduler.py it imports."""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = []
+        sys.modules[PACKAGE] = package
+        scheduler = types.ModuleType(f"{PACKAGE}.affinity_scheduler")
+        exec(compile(SCHEDULER_MODULE, "affinity_scheduler.py", "exec"), scheduler.__dict__)
+        sys.modules[scheduler.__name__] = scheduler
+    namespace = {"__name__": f"{PACKAGE}.priority_dispatch", "__package__": PACKAGE}
+    exec(compile(DISPATCH_MODULE, "priority_dispatch.py", "exec"), namespace)
+    return namespace, sys.modules[f"{PACKAGE}.affinity_scheduler"]
+
+
+class FakeService:
+    """Every call takes a few ms and is logged by name (or by its image list)."""
+
+    def __init__(self, workers=1):
+        self.worker_pool = types.SimpleNamespace(n_workers=workers)
+        self.worker_backends = [object()] * workers
+        self.order = []
+
+    async def execute_function(self, function_name, image=None, **kwargs):
+        self.order.append(list(image) if isinstance(image, list) else image)
+        await asyncio.sleep(0.02)
+        return [f"r{i}" for i in image] if isinstance(image, list) else f"r{image}"
+
+
+class TestPriorityDispatch(unittest.TestCase):
+    def setUp(self):
+        module, scheduler = load_dispatch_module()
+        self.PriorityDispatcher = module["PriorityDispatcher"]
+        self.current_priority = scheduler.current_priority
+
+    def dispatcher(self, service, **config):
+        dispatcher = self.PriorityDispatcher(service, {"current_model": "wd14-vit-v2", **config})
+        dispatcher.attach()
+        return dispatcher
+
+    def call(self, service, priority, image):
+        async def run():
+            self.current_priority.set(priority)
+            return await service.execute_function("caption", image=image)
+        return asyncio.get_running_loop().create_task(run())
+
+    def test_slots_default_to_worker_count(self):
+        self.assertEqual(self.dispatcher(FakeService(workers=3)).slots(), 3)
+        self.assertEqual(self.dispatcher(FakeService(workers=3), dispatch_slots=1).slots(), 1)
+        service = FakeService()
+        del service.worker_pool
+        service.worker_backends = [object(), object()]
+        self.assertEqual(self.dispatcher(service).slots(), 2)
+
+    def test_higher_priority_preempts_batch_at_chunk_boundary(self):
+        service = FakeService()
+        dispatcher = self.dispatcher(service, preempt_batch_size=2)
+
+        async def main():
+            batch = self.call(service, 1, [0, 1, 2, 3, 4, 5])
+            await asyncio.sleep(0.005)  # first chunk is running
+            low = self.call(service, 0, "low")
+            high = self.call(service, 3, "high")
+            return await asyncio.gather(batch, low, high)
+
+        batch, low, high = asyncio.run(main())
+        self.assertEqual(batch, [f"r{i}" for i in range(6)])
+        self.assertEqual((low, high), ("rlow", "rhigh"))
+        self.assertEqual(service.order, [[0, 1], "high", [2, 3], [4, 5], "low"])
+        self.assertEqual(dispatcher.stats["preemptions"], 1)
+        self.assertEqual(dispatcher.active, 0)
+
+    def test_queue_is_priority_then_arrival_order(self):
+        service = FakeService()
+        dispatcher = self.dispatcher(service)
+
+        async def main():
+            first = self.call(service, 1, "first")
+            await asyncio.sleep(0.005)
+            tasks = [self.call(service, p, name) for p, name in ((0, "bg"), (2, "a"), (2, "b"), (1, "normal"))]
+            await asyncio.gather(first, *tasks)
+
+        asyncio.run(main())
+        self.assertEqual(service.order, ["first", "a", "b", "normal", "bg"])
+        self.assertGreaterEqual(dispatcher.stats["overtakes"], 1)
+
+    def test_cancel_while_waiting_frees_its_place(self):
+        service = FakeService()
+        dispatcher = self.dispatcher(service)
+
+        async def main():
+            running = self.call(service, 1, "running")
+            await asyncio.sleep(0.005)
+            cancelled = self.call(service, 3, "cancelled")
+            later = self.call(service, 0, "later")
+            await asyncio.sleep(0.001)
+            cancelled.cancel()
+            await asyncio.gather(running, later)
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled
+
+        asyncio.run(main())
+        self.assertEqual(service.order, ["running", "later"])
+        self.assertEqual(dispatcher.active, 0)
+        self.assertEqual(dispatcher.waiting_count(), 0)
+
+    def test_slots_run_calls_concurrently(self):
+        service = FakeService(workers=2)
+        dispatcher = self.dispatcher(service)
+        peak = []
+
+        async def main():
+            tasks = [self.call(service, 1, name) for name in "abcd"]
+            await asyncio.sleep(0.005)
+            peak.append(dispatcher.active)
+            await asyncio.gather(*tasks)
+
+        asyncio.run(main())
+        self.assertEqual(peak, [2])
+        self.assertEqual(sorted(service.order), list("abcd"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "patches"))
+
+from patch_result_cache import CACHE_MODULE  # noqa: E402
+
+
+def load_cache_module():
+    """result_cache.py as the patch installs it."""
+    namespace = {"__name__": "result_cache"}
+    exec(compile(CACHE_MODULE, "result_cache.py", "exec"), namespace)
+    return namespace
+
+
+class FakeImage:
+    """Decoded image as decode_pool leaves it: the content hash in info."""
+
+    def __init__(self, content):
+        self.content = content
+        self.info = {"content_hash": f"hash-{content}"}
+
+
+class FakeService:
+    def __init__(self):
+        self.calls = []
+
+    async def execute_function(self, function_name, image=None, **kwargs):
+        if isinstance(image, list):
+            self.calls.append([i.content for i in image])
+            return [{"caption": f"{i.content}:{kwargs.get('length')}"} for i in image]
+        self.calls.append(image.content)
+        return {"caption": f"{image.content}:{kwargs.get('length')}"}
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.module = load_cache_module()
+        self.service = FakeService()
+
+    def attach(self, **config):
+        cache = self.module["ResultCache"](self.service, {"current_model": "wd14-vit-v2", **config})
+        cache.attach()
+        return cache
+
+    def call(self, image, headers=None, **kwargs):
+        """One request: returns (result, X-Cache outcome)."""
+        async def main():
+            token, state = self.module["open_request"](headers or {})
+            try:
+                result = await self.service.execute_function("caption", image=image, **kwargs)
+            finally:
+                self.module["close_request"](token)
+            return result, self.module["outcome"](state)
+
+        return asyncio.run(main())
+
+    def test_hit_after_miss(self):
+        cache = self.attach()
+        self.assertEqual(self.call(FakeImage("a"), length="short"), ({"caption": "a:short"}, "MISS"))
+        self.assertEqual(self.call(FakeImage("a"), length="short"), ({"caption": "a:short"}, "HIT"))
+        self.assertEqual(self.service.calls, ["a"])
+        self.assertEqual(cache.stats["memory_hits"], 1)
+
+    def test_settings_are_part_of_the_key(self):
+        self.attach()
+        self.call(FakeImage("a"), length="short")
+        self.assertEqual(self.call(FakeImage("a"), length="long")[1], "MISS")
+        self.assertEqual(self.service.calls, ["a", "a"])
+
+    def test_batch_partial_hit_sends_only_misses(self):
+        self.attach()
+        self.call(FakeImage("b"))
+        images = [FakeImage("a"), FakeImage("b"), FakeImage("c")]
+        results, outcome = self.call(images)
+        self.assertEqual(outcome, "PARTIAL")
+        self.assertEqual([r["caption"] for r in results], ["a:None", "b:None", "c:None"])
+        self.assertEqual(self.service.calls, ["b", ["a", "c"]])
+
+    def test_bypass_skips_lookup_but_stores(self):
+        self.attach()
+        self.call(FakeImage("a"))
+        _, outcome = self.call(FakeImage("a"), headers={"cache-control": "no-cache"})
+        self.assertEqual(outcome, "BYPASS")
+        self.assertEqual(self.call(FakeImage("a"))[1], "HIT")
+        self.assertEqual(self.service.calls, ["a", "a"])
+
+    def test_hit_is_a_copy(self):
+        self.attach()
+        result, _ = self.call(FakeImage("a"))
+        result["caption"] = "edited"
+        self.assertEqual(self.call(FakeImage("a"))[0], {"caption": "a:None"})
+
+    def test_memory_lru_eviction(self):
+        cache = self.attach(result_cache_entries=2)
+        for content in "abc":
+            self.call(FakeImage(content))
+        self.assertEqual(cache.stats["memory_evictions"], 1)
+        self.assertEqual(self.call(FakeImage("c"))[1], "HIT")
+        self.assertEqual(self.call(FakeImage("a"))[1], "MISS")
+
+    def test_disk_tier_survives_memory_eviction_and_evicts_by_size(self):
+        with tempfile.TemporaryDirectory() as root:
+            # Each entry is ~20 bytes of JSON: room for two
+            cache = self.attach(result_cache_entries=1, result_cache_dir=root, result_cache_disk_mb=45 / 1024 ** 2)
+            self.call(FakeImage("a"))
+            self.call(FakeImage("b"))
+            self.assertEqual(self.call(FakeImage("a"))[1], "HIT")
+            self.assertEqual(cache.stats["disk_hits"], 1)
+
+            self.call(FakeImage("c"))
+            self.assertEqual(cache.stats["disk_evictions"], 1)
+            self.assertEqual(len(cache.disk.index), 2)
+            self.assertEqual(self.call(FakeImage("b"))[1], "MISS")  # least recently used on disk
+
+            reopened = self.module["_DiskTier"](root, cache.disk.max_bytes)
+            self.assertEqual(set(reopened.index), set(cache.disk.index))
+
+    def test_disabled_with_zero_entries(self):
+        self.attach(result_cache_entries=0)
+        self.assertIsNone(self.call(FakeImage("a"))[1])
+        self.call(FakeImage("a"))
+        self.assertEqual(self.service.calls, ["a", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
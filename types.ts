@@ -58,7 +58,8 @@ export interface IAiProvider {
   analyzeImage?(
     image: ImageInfo,
     settings: AdminSettings,
-    onStatus?: (message: string) => void
+    onStatus?: (message: string) => void,
+    priority?: number // Queue priority (types/queue.ts), for providers that schedule by it
   ): Promise<ImageAnalysisResult>;
 
   /**
@@ -71,7 +72,9 @@ export interface IAiProvider {
    */
   captionImage?(
     image: ImageInfo,
-    settings: AdminSettings
+    settings: AdminSettings,
+    onStatus?: (message: string) => void,
+    priority?: number
   ): Promise<string>;
 
   /**
@@ -80,7 +83,9 @@ export interface IAiProvider {
    */
   tagImage?(
     image: ImageInfo,
-    settings: AdminSettings
+    settings: AdminSettings,
+    onStatus?: (message: string) => void,
+    priority?: number
   ): Promise<string[]>;
 
   detectSubject?(image: ImageInfo, settings: AdminSettings): Promise<{ x: number, y: number }>; // Returns center coordinates (0-100)
@@ -409,6 +414,11 @@ export interface DevicePerformanceMetrics {
   tokensPerSecond?: number;
   inferenceTimeMs?: number;
   modelLoadTimeMs?: number;
+  encoderTimeMs?: number; // vision encoder time for this request
+  encoderSavedMs?: number; // encoder time skipped via the embedding cache
+  recommendedConcurrency?: number; // server's X-Recommended-Concurrency
+  queueDepth?: number; // calls waiting on the server (X-Queue-Depth)
+  estimatedWaitMs?: number; // server's queue wait estimate at this priority
 }
 
 export interface ProviderStats {